@@ -1,16 +1,108 @@
 import sys
 import web
 import time
+import json
+import numpy as np
 
-from config import init_settings_from_argv
+from config import init_settings_from_argv, get_server_mode, \
+get_request_threads
 import models
 import database
+import ingest
+import journal
+import services
+import utils
+import metrics
+import export
+import events
+import cache
+import wire
 from picolog.data import Reading
 
 config, db, server_key, channels, streams = init_settings_from_argv()
 
+"""Default time span of the readings returned by GET requests [ms]"""
+DEFAULT_READINGS_SPAN = 3600000
+
+# how the site is served
+server_mode = get_server_mode(config)
+
+# writer thread for queued ingest, if enabled
+ingest_writer = None
+
+if config.has_option('ingest', 'mode') \
+and config.get('ingest', 'mode') == "queue":
+    ingest_writer = ingest.IngestWriter(db, config)
+    ingest_writer.start()
+
+# journal of uploads loaded into the database in the background, if enabled
+ingest_journal = None
+
+if config.has_option('ingest', 'mode') \
+and config.get('ingest', 'mode') == "journal":
+    ingest_journal = journal.IngestJournal(db, config)
+    ingest_journal.start()
+
+if server_mode == "production":
+    # other worker processes write too, so nothing is kept in memory that
+    # only this process's writes would update
+    models.ChannelState.cache_enabled = False
+elif config.has_option('buffer', 'enabled') \
+and config.getboolean('buffer', 'enabled'):
+    # in-memory buffers of the newest samples
+    models.ChannelSamples.init_ring_buffers(db, config, streams)
+
+# trend updates, compaction and retention; production.py runs these in its
+# own process instead
+trend_service = None
+compactor = None
+retention_service = None
+
+if server_mode != "production":
+    trend_service, compactor, retention_service = \
+    services.start_background_services(db, config, channels, streams)
+
+# cached series responses, if enabled
+response_cache = None
+
+if config.has_option('cache', 'responses') \
+and config.getboolean('cache', 'responses'):
+    response_cache = cache.ResponseCache(config, streams)
+
+    if server_mode == "production":
+        # samples are written by other processes
+        response_cache.watch(db)
+    else:
+        models.ChannelSamples.write_listeners.append(response_cache.notify)
+
+        if trend_service is not None:
+            trend_service.listeners.append(response_cache.notify_streams)
+
+# pushing of new points to browsers, if enabled
+event_hub = None
+
+if config.has_option('events', 'enabled') \
+and config.getboolean('events', 'enabled'):
+    event_hub = events.EventHub(db, config, streams, \
+    get_request_threads(config))
+
+    if server_mode == "production":
+        # samples are written by other processes
+        event_hub.start(watch_interval=event_hub.poll_interval)
+    else:
+        event_hub.start()
+
+        models.ChannelSamples.write_listeners.append(event_hub.notify)
+
+        if trend_service is not None:
+            trend_service.listeners.append(event_hub.notify_streams)
+
 # URL routing
 urls = (
+    "/(.+)/status", "StatusManager",
+    "/(.+)/data/readings", "BulkDataManager",
+    "/(.+)/data/export", "ExportManager",
+    "/(.+)/data/(.+)/series", "SeriesManager",
     "/(.+)/data/(.+)", "DataManager"
 )
 
@@ -19,22 +111,85 @@ app_api = web.application(urls, globals())
 class BaseController(object):
     pass
 
+class StatusManager(BaseController):
+    """Methods to report the state of background work
+
+    The report includes database statements and their query plans, so only
+    the server key is allowed.
+    """
+
+    def GET(self, key):
+        if not is_server_key(key):
+            return web.forbidden()
+
+        status = {}
+
+        if ingest_writer is not None:
+            status["ingest"] = ingest_writer.get_stats()
+
+        if ingest_journal is not None:
+            status["journal"] = ingest_journal.get_stats()
+
+        if trend_service is not None:
+            status["trends"] = trend_service.get_stats()
+
+        if event_hub is not None:
+            status["events"] = event_hub.get_stats()
+
+        if response_cache is not None:
+            status["response_cache"] = response_cache.get_stats()
+
+        if compactor is not None:
+            status["blocks"] = compactor.get_stats()
+
+        if retention_service is not None:
+            status["retention"] = retention_service.get_stats()
+
+        status["slow_queries"] = metrics.get_slow_queries()
+
+        web.header('Content-Type', 'application/json')
+
+        return json.dumps(status)
+
 class DataManager(BaseController):
     """Methods to manage data"""
 
     def GET(self, key, command):
+        # get key from GET data
+        client_key = models.Key(key, db, config)
+
         # handle "latest"
-        if command == "latest/timestamp":
-            # get last time
-            # FIXME: make a Reading class to access last full reading time
-            # HACK: use a single channel's last time
-            last_data_time = last_time = streams[0].get_last_time()
+        if command == "latest":
+            # latest sample of each readable channel
+            states = models.ChannelState.get_all(db)
+
+            latest = dict([(str(channel_num), {"timestamp": \
+            state.last_timestamp, "value": state.last_value, \
+            "count": state.sample_count}) for channel_num, state \
+            in states.iteritems() \
+            if channel_num in client_key.get_readable_channels()])
+
+            web.header('Content-Type', 'application/json')
+
+            return json.dumps({"channels": latest})
+        elif command == "latest/timestamp":
+            # the last full reading is no later than the earliest of the
+            # writable channels' latest samples
+            states = models.ChannelState.get_all(db)
+
+            timestamps = [states[channel_num].last_timestamp \
+            for channel_num in client_key.get_writable_channels() \
+            if channel_num in states]
+
+            # without samples, loggers start from the epoch
+            if len(timestamps) == 0:
+                timestamps = [0]
 
             # set status
             web.ctx.status = '200 OK'
 
             # return UNIX timestamp, in ms
-            return str(time.mktime(last_data_time.utctimetuple()) * 1000)
+            return str(min(timestamps))
         else:
             return web.notfound()
 
@@ -42,22 +197,449 @@ class DataManager(BaseController):
         # get data
         data = web.data()
 
+        # get key from GET data
+        client_key = models.Key(key, db, config)
+
+        if is_binary_upload():
+            return put_binary(client_key, data)
+
         # create reading from data
         reading = Reading.instance_from_json(data)
 
+        # insert data
+        try:
+            insert_count = add_readings(client_key, [reading])
+        except journal.JournalFull, e:
+            return journal_full(e)
+        except Exception, e:
+            print e
+            return e
+
+        # set return status to signify creation
+        set_added_status()
+
+        # return number of samples added
+        return "{0} samples added".format(insert_count)
+
+class BulkDataManager(BaseController):
+    """Methods to manage batches of data"""
+
+    def GET(self, key):
+        """Returns several channels' samples, aligned by time
+
+        Channels are given as a comma separated channels parameter, by
+        default every readable channel, and times as since and until ms
+        timestamps, since defaulting to DEFAULT_READINGS_SPAN ago. By default
+        the samples are returned as a list of readings in the format accepted
+        by PUT; with format=matrix, as an object with the channels and a row
+        [timestamp, value, ...] per time, with null for channels without a
+        sample at that time.
+        """
+
+        params = web.input(channels=None, since=None, until=None, \
+        format="readings")
+
         # get key from GET data
         client_key = models.Key(key, db, config)
 
-        # insert data
+        readable_channels = client_key.get_readable_channels()
+
         try:
-            insert_count = models.ChannelSamples.add_from_reading(db, \
-            client_key, reading)
+            if params.channels:
+                channel_nums = [int(channel_num) for channel_num \
+                in params.channels.split(",")]
+            else:
+                channel_nums = sorted(readable_channels)
+
+            if params.since:
+                since = int(params.since)
+            else:
+                since = int(time.time() * 1000) - DEFAULT_READINGS_SPAN
+
+            until = int(params.until) if params.until else None
+        except ValueError:
+            return web.badrequest()
+
+        # check access
+        for channel_num in channel_nums:
+            if channel_num not in readable_channels:
+                return web.forbidden()
+
+        web.header('Content-Type', 'application/json')
+
+        if params.format == "readings":
+            return "[" + ", ".join([reading.json_repr() for reading \
+            in models.ChannelSamples.read_readings(db, config, channel_nums, \
+            since, until)]) + "]"
+        elif params.format != "matrix":
+            return web.badrequest()
+
+        times, matrix = models.ChannelSamples.read_matrix(db, config, \
+        channel_nums, since, until)
+
+        # values are stored as integers
+        rows = np.column_stack((times, np.where(np.isnan(matrix), 0, \
+        matrix).astype(np.int64))).tolist()
+
+        for row, column in np.argwhere(np.isnan(matrix)).tolist():
+            rows[row][column + 1] = None
+
+        return json.dumps({"channels": channel_nums, "data": rows})
+
+    def PUT(self, key):
+        # get data
+        data = web.data()
+
+        if is_binary_upload():
+            return put_binary(models.Key(key, db, config), data)
+
+        # create readings from data
+        try:
+            readings = readings_from_json(data)
+        except (ValueError, KeyError, TypeError), e:
+            web.ctx.status = '400 Bad Request'
+            return "Invalid readings: {0}".format(e)
+
+        # get key from GET data
+        client_key = models.Key(key, db, config)
+
+        # insert data in one batch
+        try:
+            insert_count = add_readings(client_key, readings)
+        except journal.JournalFull, e:
+            return journal_full(e)
         except Exception, e:
             print e
             return e
 
         # set return status to signify creation
-        web.ctx.status = '201 Created'
+        set_added_status()
 
         # return number of samples added
-        return "{0} samples added".format(insert_count)
+        return "{0} samples added from {1} readings".format(insert_count, \
+        len(readings))
+
+def add_readings(client_key, readings):
+    """Adds readings, through the writer thread if ingest is queued, or to
+    the journal if journalled
+
+    :return: number of samples inserted, once they are committed, or
+    journalled, once they are synced
+    """
+
+    if ingest_journal is not None:
+        return ingest_journal.append(models.ChannelSamples.collect_rows( \
+        client_key, readings), config.getfloat('ingest', 'timeout'))
+
+    if ingest_writer is not None:
+        return ingest_writer.submit(client_key, readings).wait( \
+        config.getfloat('ingest', 'timeout'))
+
+    return models.ChannelSamples.add_from_readings(db, client_key, readings)
+
+def add_rows(rows):
+    """Adds sample rows, through the writer thread if ingest is queued, or to
+    the journal if journalled
+
+    Channel access must already have been checked.
+
+    :return: number of samples inserted, once they are committed, or
+    journalled, once they are synced
+    """
+
+    if ingest_journal is not None:
+        return ingest_journal.append(rows, \
+        config.getfloat('ingest', 'timeout'))
+
+    if ingest_writer is not None:
+        return ingest_writer.submit_rows(rows).wait( \
+        config.getfloat('ingest', 'timeout'))
+
+    return models.ChannelSamples.write_rows(db, config, [rows])[0]
+
+def set_added_status():
+    """Sets the status of a successful upload: 201 Created once the samples
+    are in the database, or 202 Accepted once they are journalled"""
+
+    if ingest_journal is not None:
+        web.ctx.status = '202 Accepted'
+    else:
+        web.ctx.status = '201 Created'
+
+def journal_full(e):
+    """Answers 503 Service Unavailable to an upload the journal can't take
+
+    :return: response text
+    """
+
+    web.ctx.status = '503 Service Unavailable'
+    web.header('Retry-After', str(journal.IngestJournal.RETRY_DELAY))
+
+    return str(e)
+
+def is_binary_upload():
+    """Returns whether the request body is in the binary upload format"""
+
+    return web.ctx.env.get('CONTENT_TYPE', "").split(";")[0].strip() \
+    == wire.CONTENT_TYPE
+
+def put_binary(client_key, data):
+    """Adds samples uploaded in the binary format (see wire)
+
+    The arrays go straight to the batched insert, without creating readings.
+
+    :return: response text
+    """
+
+    try:
+        channels, timestamps, values = wire.decode(data)
+    except ValueError, e:
+        web.ctx.status = '400 Bad Request'
+        return "Invalid samples: {0}".format(e)
+
+    try:
+        insert_count = add_rows(models.ChannelSamples.collect_arrays( \
+        client_key, channels, timestamps, values))
+    except journal.JournalFull, e:
+        return journal_full(e)
+    except Exception, e:
+        print e
+        return e
+
+    # set return status to signify creation
+    set_added_status()
+
+    return "{0} samples added".format(insert_count)
+
+def readings_from_json(data):
+    """Creates readings from a JSON list of readings or a datastore
+
+    The data can either be a list of JSON reading objects, or an object with a
+    "readings" list as produced by a datastore.
+    """
+
+    parsed = json.loads(data)
+
+    # unwrap datastore
+    if isinstance(parsed, dict):
+        parsed = parsed["readings"]
+
+    # create each reading using its own JSON representation
+    return [Reading.instance_from_json(json.dumps(item)) for item in parsed]
+
+class ExportManager(BaseController):
+    """Methods to export data"""
+
+    def GET(self, key):
+        """Returns an export of channels' samples or of a stream
+
+        Channels are given as a comma separated channels parameter, by
+        default every readable channel, or a stream as a stream parameter,
+        and times as since and until ms timestamps, by default the whole
+        history. The format parameter selects csv (the default), npy or npz,
+        as produced by the export module. The export is sent in chunks as it
+        is read, so any range can be exported.
+        """
+
+        params = web.input(channels=None, stream=None, since=None, \
+        until=None, format="csv")
+
+        if params.format not in export.FORMATS:
+            return web.badrequest()
+
+        # get key from GET data
+        client_key = models.Key(key, db, config)
+
+        readable_channels = client_key.get_readable_channels()
+
+        try:
+            since = int(params.since) if params.since else None
+            until = int(params.until) if params.until else None
+
+            if params.stream is None:
+                if params.channels:
+                    channel_nums = [int(channel_num) for channel_num \
+                    in params.channels.split(",")]
+                else:
+                    channel_nums = sorted(readable_channels)
+        except ValueError:
+            return web.badrequest()
+
+        if params.stream is not None:
+            stream = get_stream(streams, params.stream)
+
+            if stream is None:
+                return web.notfound()
+
+            channel_nums = [stream.channel.channel_num]
+            columns = [stream.get_id()]
+            get_chunks = lambda: export.iter_stream_chunks(stream, since, until)
+        else:
+            columns = channel_nums
+            get_chunks = None
+
+        # check access
+        for channel_num in channel_nums:
+            if channel_num not in readable_channels:
+                return web.forbidden()
+
+        if get_chunks is None:
+            get_chunks = export.get_channel_chunks(db, config, channel_nums, \
+            since, until)
+
+        content_type, extension = export.FORMATS[params.format]
+
+        web.header('Content-Type', content_type)
+        web.header('Content-Disposition', \
+        'attachment; filename="export{0}"'.format(extension))
+
+        # sent with chunked transfer encoding as the rows are read
+        return metrics.timed_iter(export.export_chunks(params.format, \
+        columns, get_chunks), metrics.render_seconds, "export")
+
+class SeriesManager(BaseController):
+    """Methods to read stream data"""
+
+    def GET(self, key, stream_id):
+        # find stream
+        stream = get_stream(streams, stream_id)
+
+        if stream is None:
+            return web.notfound()
+
+        # get key from GET data
+        client_key = models.Key(key, db, config)
+
+        # check access
+        if stream.channel.channel_num not in client_key.get_readable_channels():
+            return web.forbidden()
+
+        return series_json(stream)
+
+def is_server_key(key):
+    """Checks if a key is the server's own key, set in the config"""
+
+    return key == server_key.key_value
+
+def get_stream(streams, stream_id):
+    """Returns the stream with the specified id, or None"""
+
+    for stream in streams:
+        if stream.get_id() == stream_id:
+            return stream
+
+    return None
+
+def series_json(stream):
+    """Returns a stream's time series as JSON, or in the binary format
+
+    The range and number of points are taken from the request's since, until
+    and max_points parameters. Times are ms timestamps, and since defaults to
+    the start of the stream's window. max_points defaults to the configured
+    plot size; 0 returns every point, streamed from the database in chunks.
+    With format=binary, the series is returned as utils.arrays_to_binary
+    encodes it.
+
+    Downsampled series are cached until the stream changes, and clients
+    holding the current version get 304 Not Modified.
+    """
+
+    params = web.input(since=None, until=None, max_points=None, format="json")
+
+    try:
+        since = float(params.since) if params.since else None
+        until = float(params.until) if params.until else None
+
+        if params.max_points is None:
+            max_points = stream.get_default_max_points()
+        else:
+            max_points = int(params.max_points) or None
+    except ValueError:
+        return web.badrequest()
+
+    if params.format == "binary":
+        content_type = 'application/octet-stream'
+    elif params.format == "json":
+        content_type = 'application/json'
+    else:
+        return web.badrequest()
+
+    if response_cache is not None:
+        etag, modified = response_cache.get_version(stream.get_id())
+
+        if is_immutable(stream, since, until):
+            web.header('Cache-Control', 'public, max-age={0}'.format( \
+            response_cache.immutable_max_age))
+        else:
+            # clients check with the validators before using their copy
+            web.header('Cache-Control', 'no-cache')
+
+        cache.check_modified(etag, modified)
+
+    web.header('Content-Type', content_type)
+
+    if params.format == "binary":
+        chunks = metrics.timed_iter(utils.arrays_to_binary_chunks( \
+        *stream.get_time_series_arrays(since=since, until=until, \
+        max_points=max_points)), metrics.render_seconds, "series_binary")
+    elif max_points is None:
+        # stream every point without building the whole series
+        chunks = metrics.timed_iter(series_json_chunks(stream, \
+        stream.iter_time_series_arrays(since=since, until=until)), \
+        metrics.render_seconds, "series_json")
+    else:
+        chunks = metrics.timed_iter(series_json_chunks(stream, \
+        [stream.get_time_series_arrays(since=since, until=until, \
+        max_points=max_points)]), metrics.render_seconds, "series_json")
+
+    if response_cache is None or max_points is None:
+        # streamed chunks are read from the database as they are serialized
+        return chunks
+
+    key = (stream.get_id(), since, until, max_points, params.format)
+
+    body = response_cache.get(key, etag)
+
+    if body is None:
+        body = "".join(chunks)
+
+        response_cache.put(key, etag, body)
+
+    return body
+
+def is_immutable(stream, since, until):
+    """Returns whether a series between two times can no longer change
+
+    Trend points are only added after the latest one, so a trend's series
+    ending before its latest point is fixed, unless retention deletes the
+    trend's old points. Without since, the series starts a window before the
+    request time, so it moves.
+
+    :param since: start of the series [ms], or None for the stream's window
+    :param until: end of the series [ms], or None for the latest point
+    """
+
+    if stream.stream_type != "trend" or since is None or until is None:
+        return False
+
+    if stream.channel.keep_trends is not None \
+    and config.has_option('retention', 'enabled') \
+    and config.getboolean('retention', 'enabled'):
+        return False
+
+    last_timestamp = stream.get_last_timestamp()
+
+    return last_timestamp is not None and until <= last_timestamp
+
+def series_json_chunks(stream, chunks):
+    """Yields a stream's series JSON object in pieces
+
+    :param chunks: iterable of (timestamps, values) arrays
+    """
+
+    yield '{{"stream": {0}, "data": '.format(json.dumps(stream.get_id()))
+
+    for text in utils.arrays_to_js_chunks(chunks):
+        yield text
+
+    yield "}"
@@ -0,0 +1,358 @@
+from __future__ import division
+
+import sys
+import os
+import struct
+import datetime
+import numpy as np
+
+"""Columnar archive of closed days of samples
+
+Each channel's samples for one UTC day are stored in one file,
+<path>/<channel>/<YYYY-MM-DD>.col, holding a header followed by the day's
+timestamps as little-endian int64 ms and then its values as little-endian
+int32. Files are read through numpy.memmap, so a time range within a day is a
+slice of the mapped file rather than a copy.
+"""
+
+"""File header: magic, format version, sample count"""
+HEADER_FORMAT = "<4sHxxq"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAGIC = "MGAR"
+VERSION = 1
+
+"""Day length [ms]"""
+DAY = 86400000
+
+"""File name extension"""
+EXTENSION = ".col"
+
+class ChannelArchive(object):
+    """Represents the archived days of a channel"""
+
+    """Channel number"""
+    channel_num = None
+
+    """Directory containing the channel's day files"""
+    path = None
+
+    def __init__(self, channel_num, root_path):
+        """Initialises the channel archive
+
+        :param channel_num: channel number
+        :param root_path: archive directory, containing a directory per channel
+        """
+
+        self.channel_num = int(channel_num)
+        self.path = os.path.join(root_path, str(self.channel_num))
+
+    @classmethod
+    def from_config(cls, channel_num, config):
+        """Returns the channel's archive, or None if archiving is not set up"""
+
+        if config is None or not config.has_option('archive', 'path'):
+            return None
+
+        return cls(channel_num, config.get('archive', 'path'))
+
+    @staticmethod
+    def day_start(timestamp):
+        """Returns the start of the UTC day containing timestamp [ms]"""
+
+        return int(timestamp) // DAY * DAY
+
+    def _day_path(self, day):
+        """Returns the file path for the day starting at day [ms]"""
+
+        date = datetime.datetime.utcfromtimestamp(day // 1000)
+
+        return os.path.join(self.path, date.strftime("%Y-%m-%d") + EXTENSION)
+
+    def get_days(self):
+        """Returns the start times [ms] of the archived days, in order"""
+
+        if not os.path.isdir(self.path):
+            return []
+
+        days = []
+
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith(EXTENSION):
+                continue
+
+            date = datetime.datetime.strptime(file_name[:-len(EXTENSION)], \
+            "%Y-%m-%d")
+
+            days.append(int((date - datetime.datetime(1970, 1, 1)) \
+            .total_seconds()) * 1000)
+
+        return sorted(days)
+
+    def read_day(self, day):
+        """Maps the specified day's file
+
+        :param day: day start [ms]
+        :return: (timestamps, values) memory-mapped arrays, empty if the day
+        is not archived
+        """
+
+        path = self._day_path(day)
+
+        if not os.path.exists(path):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+        with open(path, "rb") as archive_file:
+            magic, version, count = struct.unpack(HEADER_FORMAT, \
+            archive_file.read(HEADER_SIZE))
+
+        if magic != MAGIC or version != VERSION:
+            raise Exception("{0} is not a version {1} archive file".format( \
+            path, VERSION))
+
+        if count == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+        timestamps = np.memmap(path, dtype="<i8", mode="r", \
+        offset=HEADER_SIZE, shape=(count,))
+        values = np.memmap(path, dtype="<i4", mode="r", \
+        offset=HEADER_SIZE + 8 * count, shape=(count,))
+
+        return timestamps, values
+
+    def get_segments(self, since=None, until=None):
+        """Yields the archived samples within a time range, a day at a time
+
+        :param since: earliest timestamp [ms], or None
+        :param until: latest timestamp [ms], or None
+        :return: generator of (timestamps, values) array slices
+        """
+
+        for day in self.get_days():
+            # skip days outside the range
+            if since is not None and day + DAY <= since:
+                continue
+
+            if until is not None and day > until:
+                break
+
+            timestamps, values = self.read_day(day)
+
+            # slice to the range
+            start = 0
+            end = len(timestamps)
+
+            if since is not None:
+                start = np.searchsorted(timestamps, since, side="left")
+
+            if until is not None:
+                end = np.searchsorted(timestamps, until, side="right")
+
+            if end > start:
+                yield timestamps[start:end], values[start:end]
+
+    def write_day(self, day, timestamps, values):
+        """Writes a day's samples, merging them with any already archived
+
+        The file is written under a temporary name and then renamed, so
+        readers never see a partial file.
+
+        :param day: day start [ms]
+        :param timestamps: sample timestamps [ms] within the day
+        :param values: sample values
+        :return: number of samples in the day's file
+        """
+
+        existing_timestamps, existing_values = self.read_day(day)
+
+        # merge, keeping the first of any repeated timestamp
+        timestamps = np.concatenate((existing_timestamps, \
+        np.asarray(timestamps, dtype=np.int64)))
+        values = np.concatenate((existing_values, \
+        np.asarray(values, dtype=np.int32)))
+
+        timestamps, indices = np.unique(timestamps, return_index=True)
+        values = values[indices]
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        path = self._day_path(day)
+        temporary_path = path + ".tmp"
+
+        with open(temporary_path, "wb") as archive_file:
+            archive_file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, \
+            len(timestamps)))
+            archive_file.write(timestamps.astype("<i8").tostring())
+            archive_file.write(values.astype("<i4").tostring())
+
+            # make sure the file is on disk before the rows are deleted
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+
+        os.rename(temporary_path, path)
+
+        return len(timestamps)
+
+    def delete_day(self, day):
+        """Deletes the specified day's file, if it exists
+
+        :param day: day start [ms]
+        :return: True if a file was deleted
+        """
+
+        path = self._day_path(day)
+
+        if not os.path.exists(path):
+            return False
+
+        os.remove(path)
+
+        return True
+
+def merge_segments(segments):
+    """Joins (timestamps, values) segments into one time-ordered series
+
+    Segments may overlap, for example if a day's rows are still in the
+    database while it is archived; repeated timestamps are kept once.
+
+    :param segments: list of (timestamps, values) arrays
+    :return: (timestamps, values) arrays
+    """
+
+    segments = [segment for segment in segments if len(segment[0]) > 0]
+
+    if len(segments) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    elif len(segments) == 1:
+        return segments[0]
+
+    timestamps = np.concatenate([segment[0] for segment in segments])
+    values = np.concatenate([segment[1] for segment in segments])
+
+    # sort by time, dropping repeated timestamps
+    timestamps, indices = np.unique(timestamps, return_index=True)
+
+    return timestamps, values[indices]
+
+def archive_channel(db, config, channel_num, keep_days):
+    """Moves a channel's closed days from the database to the archive
+
+    Samples are taken from both the samples table and compressed blocks.
+
+    :param channel_num: channel to archive
+    :param keep_days: number of most recent days to leave in the database
+    :return: number of samples archived
+    """
+
+    # imported here as models uses this module
+    import models
+
+    archive = ChannelArchive.from_config(channel_num, config)
+
+    if archive is None:
+        raise Exception("No archive path configured")
+
+    # days before this are archived
+    today = ChannelArchive.day_start(models.DatabaseModel.datetime_to_timestamp(\
+    datetime.datetime.utcnow()))
+    cutoff = today - int(keep_days) * DAY
+
+    archived_count = 0
+
+    while True:
+        with db.transaction():
+            # no sample can be added to the day between the read and the
+            # deletion
+            db.begin_write()
+
+            count = _archive_oldest_day(db, config, archive, channel_num, \
+            cutoff)
+
+        if count is None:
+            break
+
+        # the deleted samples are no longer counted
+        models.ChannelState.invalidate_cache()
+
+        archived_count += count
+
+    return archived_count
+
+def _archive_oldest_day(db, config, archive, channel_num, cutoff):
+    """Moves a channel's oldest day before a cutoff to the archive
+
+    This doesn't start a transaction, so it is part of the caller's.
+
+    :param archive: the channel's archive
+    :param cutoff: time before which days are archived [ms]
+    :return: number of samples archived, or None if no day is left
+    """
+
+    # imported here as models uses this module
+    import models
+
+    # find the oldest day left in the database
+    firsts = [db.select_single_cell(models.ChannelSamples.TABLE_NAME, \
+    {"channel": channel_num, "cutoff": cutoff}, what="timestamp", \
+    where="channel = $channel AND timestamp < $cutoff", \
+    order="timestamp ASC"), \
+    db.select_single_cell(models.ChannelBlocks.TABLE_NAME, \
+    {"channel": channel_num, "cutoff": cutoff}, what="first_timestamp", \
+    where="channel = $channel AND start < $cutoff", order="start ASC")]
+
+    firsts = [first for first in firsts if first is not None]
+
+    if len(firsts) == 0:
+        return None
+
+    day = ChannelArchive.day_start(min(firsts))
+    day_range = {"channel": channel_num, "start": day, "end": day + DAY}
+
+    # blocks are whole spans within the day
+    segments = list(models.ChannelBlocks.get_segments(db, config, \
+    channel_num, day, day + DAY - 1))
+
+    segments.append(db.query_arrays("""
+        SELECT timestamp, value
+        FROM {0}
+        WHERE channel = $channel AND timestamp >= $start
+        AND timestamp < $end
+        ORDER BY timestamp ASC
+    """.format(models.ChannelSamples.TABLE_NAME), day_range, \
+    dtypes=(np.int64, np.int32)))
+
+    timestamps, values = merge_segments(segments)
+
+    archive.write_day(day, timestamps, values)
+
+    # remove the archived rows
+    block_count = db.query("""
+        SELECT SUM(count) AS count
+        FROM {0}
+        WHERE channel = $channel AND start >= $start AND start < $end
+    """.format(models.ChannelBlocks.TABLE_NAME), day_range)[0].count or 0
+
+    sample_count = db.delete(models.ChannelSamples.TABLE_NAME, \
+    where="channel = $channel AND timestamp >= $start \
+AND timestamp < $end", vars=day_range)
+
+    db.delete(models.ChannelBlocks.TABLE_NAME, \
+    where="channel = $channel AND start >= $start AND start < $end", \
+    vars=day_range)
+
+    models.ChannelState.remove(db, channel_num, sample_count + block_count)
+
+    print "Archived {0} samples of channel {1} for {2}".format( \
+    len(timestamps), channel_num, \
+    datetime.datetime.utcfromtimestamp(day // 1000).date())
+
+    return len(timestamps)
+
+if __name__ == "__main__":
+    from config import init_settings_from_argv
+
+    config, db, server_key, channels, streams = init_settings_from_argv()
+
+    for channel in channels:
+        archive_channel(db, config, channel.channel_num, \
+        config.getint('archive', 'keep_days'))
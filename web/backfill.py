@@ -0,0 +1,243 @@
+from __future__ import division
+
+import time
+import multiprocessing
+import numpy as np
+import web
+
+import models
+import metrics
+from config import get_database_pragmas
+from database import Database
+
+"""Parallel computation of a trend over the stored history
+
+The samples between the trend's progress and the start of the window
+containing the latest sample are divided into time ranges aligned to the
+trend windows, so every window lies within one range and each range's trend
+points can be computed independently. Ranges are computed in worker
+processes and committed in order, in batches, with the trend's progress, so
+an interrupted backfill continues where it stopped when run again. The
+window containing the latest sample is left to the normal trend updates.
+
+While it is filled, the trend is marked in the trend_backfill table. Trend
+updates, including the trend service's, leave a marked trend alone, and
+continue from the backfill's progress once the mark is removed. A second
+backfill of the same trend refuses to start.
+"""
+
+"""Default length of the time range computed by each task [ms]"""
+DEFAULT_RANGE_LENGTH = 86400000
+
+"""Default minimum number of trend points committed per transaction"""
+DEFAULT_BATCH_POINTS = 100000
+
+# each worker process's database and config
+_worker_db = None
+_worker_config = None
+
+def _init_worker(config):
+    """Opens a database connection for a worker process"""
+
+    global _worker_db, _worker_config
+
+    _worker_config = config
+    _worker_db = Database(config.get('database', 'path'), \
+    pragmas=get_database_pragmas(config))
+
+def _compute_range(task):
+    """Computes the trend points of the windows within a time range
+
+    :param task: (channel number, window length, range start, range end,
+    state) where the range end is aligned to a window and state is the
+    progress at the range start as (last_timestamp, partial_count,
+    partial_total)
+    :return: (range end, number of samples, trend times, trend values)
+    """
+
+    channel_num, timestamp_avg, start, end, state = task
+
+    state = web.utils.storage(last_timestamp=state[0], \
+    partial_count=state[1], partial_total=state[2])
+
+    times, values = models.ChannelSamples.read_arrays(_worker_db, \
+    _worker_config, channel_num, since=start, until=end - 1)
+
+    values = values.astype(np.float64)
+
+    if len(times) == 0:
+        trend_times = np.empty(0, dtype=np.int64)
+        trend_values = np.empty(0, dtype=np.float64)
+    else:
+        trend_times, trend_values, state = \
+        models.ChannelSampleTrends._calculate_trends(times, values, \
+        timestamp_avg, state)
+
+    # the range ends on a window boundary, so its last window is complete
+    if state.partial_count > 0:
+        trend_times = np.append(trend_times, state.last_timestamp)
+        trend_values = np.append(trend_values, \
+        state.partial_total / state.partial_count)
+
+    return end, len(times), trend_times, trend_values
+
+def get_ranges(start, end, timestamp_avg, range_length):
+    """Divides a time span into ranges ending on window boundaries
+
+    :param start: first timestamp [ms]
+    :param end: end of the span [ms], on a window boundary
+    :return: list of (start, end) ranges, ends exclusive
+    """
+
+    # range length as a whole number of windows
+    range_length = max(1, int(range_length) // timestamp_avg) * timestamp_avg
+
+    ranges = []
+
+    while start < end:
+        range_end = min(end, (start // range_length + 1) * range_length)
+
+        ranges.append((start, range_end))
+
+        start = range_end
+
+    return ranges
+
+def get_first_timestamp(db, config, channel_num):
+    """Returns the time of a channel's first sample [ms], or None
+
+    This may be archived, compressed or in the samples table.
+    """
+
+    timestamps, values = models.ChannelSamples.read_arrays(db, config, \
+    channel_num, limit=1)
+
+    if len(timestamps) == 0:
+        return None
+
+    return int(timestamps[0])
+
+def backfill(db, config, trend, workers=None, range_length=None, \
+batch_points=None):
+    """Computes a trend's points up to the window of the latest sample
+
+    :param trend: trend stream to fill
+    :param workers: number of worker processes (default the number of CPUs)
+    :param range_length: length of the time range of each task [ms]
+    :param batch_points: minimum number of points committed per transaction
+    :return: number of new trend points
+    """
+
+    if range_length is None:
+        range_length = DEFAULT_RANGE_LENGTH
+
+        if config.has_option('trends', 'backfill_range'):
+            range_length = config.getint('trends', 'backfill_range')
+
+    if batch_points is None:
+        batch_points = DEFAULT_BATCH_POINTS
+
+    # make sure the progress table exists for older databases
+    trend.init_state_schema(db)
+
+    channel_num = trend.channel.channel_num
+    timestamp_avg = int(trend.timestamp_avg)
+
+    if not trend.start_backfill():
+        print "Trend {0} is already being backfilled by process {1}".format( \
+        trend.get_id(), trend.get_backfill_pid())
+
+        return 0
+
+    try:
+        return _backfill(db, config, trend, channel_num, timestamp_avg, \
+        workers, range_length, batch_points)
+    finally:
+        trend.end_backfill()
+
+def _backfill(db, config, trend, channel_num, timestamp_avg, workers, \
+range_length, batch_points):
+    """Fills a trend marked as being backfilled by this process
+
+    :return: number of new trend points
+    """
+
+    channel_state = models.ChannelState.get(db, channel_num)
+
+    if channel_state is None:
+        print "No samples for channel {0}".format(channel_num)
+
+        return 0
+
+    # the window of the latest sample may still receive samples
+    end = channel_state.last_timestamp // timestamp_avg * timestamp_avg
+
+    state = trend._get_trend_state()
+
+    if state.last_timestamp >= 0:
+        start = int(state.last_timestamp) + 1
+    else:
+        # a new trend starts at the first sample
+        start = get_first_timestamp(db, config, channel_num)
+
+    ranges = get_ranges(start, end, timestamp_avg, range_length)
+
+    if len(ranges) == 0:
+        print "Trend {0} is already filled".format(trend.get_id())
+
+        return 0
+
+    # only the first range continues the stored progress
+    tasks = [(channel_num, timestamp_avg, range_start, range_end, \
+    (range_start - 1, 0, 0)) for range_start, range_end in ranges]
+    tasks[0] = tasks[0][:4] + ((int(state.last_timestamp), \
+    int(state.partial_count), float(state.partial_total)),)
+
+    pool = multiprocessing.Pool(workers, _init_worker, (config,))
+
+    start_time = time.time()
+    sample_count = 0
+    point_count = 0
+
+    # trend points waiting to be committed
+    pending_times = []
+    pending_values = []
+    pending_count = 0
+
+    try:
+        # results arrive in order, so progress is always a prefix of the ranges
+        for number, (range_end, range_sample_count, trend_times, \
+        trend_values) in enumerate(pool.imap(_compute_range, tasks)):
+            sample_count += range_sample_count
+
+            pending_times.append(trend_times)
+            pending_values.append(trend_values)
+            pending_count += len(trend_times)
+
+            if pending_count < batch_points and number < len(tasks) - 1:
+                continue
+
+            with db.transaction():
+                insert_count = trend._add_trend_data( \
+                np.concatenate(pending_times).tolist(), \
+                np.concatenate(pending_values).tolist())
+
+                # every sample before the range end has been used
+                trend._set_trend_state(web.utils.storage( \
+                last_timestamp=range_end - 1, partial_count=0, \
+                partial_total=0))
+
+            point_count += insert_count
+            metrics.trend_points.inc(insert_count)
+
+            pending_times = []
+            pending_values = []
+            pending_count = 0
+
+            print "{0}/{1} ranges, {2} samples, {3} trend points, \
+{4:.1f} s".format(number + 1, len(tasks), sample_count, point_count, \
+            time.time() - start_time)
+    finally:
+        pool.terminate()
+
+    return point_count
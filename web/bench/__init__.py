@@ -0,0 +1,10 @@
+"""Benchmarks
+
+Run from the web directory:
+
+    python -m bench.run [--sizes day,month,year] [--rate 1] [--output file]
+
+Synthetic magnetometer data for each size is generated once into a work
+directory and reused, then each benchmark runs against a copy of it in a
+separate process. Results are written as JSON.
+"""
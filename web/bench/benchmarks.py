@@ -0,0 +1,243 @@
+from __future__ import division
+
+import sys
+import time
+import json
+import math
+import numpy as np
+import web
+
+from bench import generator
+
+"""Benchmarks run against one generated database
+
+Usage: python -m bench.benchmarks config output rate
+
+The application modules read their configuration from the command line when
+imported, so each database is benchmarked in its own process. Queries use
+fixed times relative to the end of the generated data rather than the
+current time, so results don't depend on when they are run.
+"""
+
+"""Default number of repetitions of each timed operation"""
+DEFAULT_REPEAT = 20
+
+def timed(function, repeat=DEFAULT_REPEAT):
+    """Runs a function repeatedly, returning timing statistics
+
+    :return: dict with the number of runs and their mean, median, 95th
+    percentile, minimum and maximum times [ms]
+    """
+
+    durations = []
+
+    for number in range(repeat):
+        start_time = time.time()
+        function()
+        durations.append((time.time() - start_time) * 1000)
+
+    durations = np.array(durations)
+
+    return {"runs": repeat, "mean_ms": float(durations.mean()), \
+    "median_ms": float(np.median(durations)), \
+    "p95_ms": float(np.percentile(durations, 95)), \
+    "min_ms": float(durations.min()), "max_ms": float(durations.max())}
+
+def bench_raw_window(streams, end):
+    """Times get_time_series over each raw stream's window"""
+
+    results = []
+
+    for stream in streams:
+        if stream.stream_type != "raw":
+            continue
+
+        since = end - int(stream.window)
+
+        for max_points in [stream.get_default_max_points(), None]:
+            result = timed(lambda: stream.get_time_series(since=since, \
+            until=end, max_points=max_points))
+            result.update({"name": "raw_window", "stream": stream.get_id(), \
+            "max_points": max_points})
+
+            results.append(result)
+
+    return results
+
+def bench_trend_update(db, streams, end, max_rows=2500):
+    """Times update_trends bringing each trend up to date from a day back
+
+    Each trend is reset to the start of the last day of data first.
+    """
+
+    import models
+
+    results = []
+
+    for stream in streams:
+        if stream.stream_type != "trend":
+            continue
+
+        # forget the last day of trend points
+        reset = (end - generator.DAY) // stream.timestamp_avg \
+        * stream.timestamp_avg
+
+        with db.transaction():
+            db.delete(stream._table_name(), where="timestamp >= $reset", \
+            vars={"reset": reset})
+
+            stream._set_trend_state(web.utils.storage( \
+            last_timestamp=reset - 1, partial_count=0, partial_total=0))
+
+        sample_count = db.query("""
+            SELECT COUNT(*) AS count
+            FROM {0}
+            WHERE channel = $channel AND timestamp >= $reset
+        """.format(models.ChannelSamples.TABLE_NAME), \
+        {"channel": stream.channel.channel_num, "reset": reset})[0].count
+
+        calls = int(math.ceil(sample_count / max_rows)) + 1
+
+        start_time = time.time()
+
+        for number in range(calls):
+            stream.update_trends(max_rows=max_rows)
+
+        duration = time.time() - start_time
+
+        results.append({"name": "trend_update", "stream": stream.get_id(), \
+        "samples": sample_count, "calls": calls, \
+        "total_ms": duration * 1000, \
+        "samples_per_s": sample_count / duration})
+
+    return results
+
+def bench_index_page(app, streams, end):
+    """Times rendering the index page, and loading it with every series"""
+
+    results = []
+
+    result = timed(lambda: app.request("/"))
+    result["name"] = "index_page"
+
+    results.append(result)
+
+    # the page, then each plot's series as the browser requests them
+    def load_page():
+        app.request("/")
+
+        for stream in streams:
+            app.request("/series/{0}?since={1}&until={2}".format( \
+            stream.get_id(), end - int(stream.window), end))
+
+    result = timed(load_page)
+    result["name"] = "page_load"
+
+    results.append(result)
+
+    return results
+
+def bench_ingest(db, config, key, app, end, rate):
+    """Times adding readings through the models and the API
+
+    Readings follow on from the end of the generated data.
+    """
+
+    import models
+
+    results = []
+
+    def ingest_readings(count):
+        """Returns the next count readings after those already added"""
+
+        start = models.ChannelState.get(db, generator.CHANNELS[0]) \
+        .last_timestamp + 1000 / rate
+
+        return generator.generate_readings(start, count * 1000 / rate, rate)
+
+    # one reading per call
+    readings = ingest_readings(500)
+
+    start_time = time.time()
+
+    for reading in readings:
+        models.ChannelSamples.add_from_reading(db, key, reading)
+
+    duration = time.time() - start_time
+
+    results.append({"name": "ingest_add_from_reading", \
+    "readings": len(readings), "total_ms": duration * 1000, \
+    "readings_per_s": len(readings) / duration})
+
+    # one reading per request
+    readings = ingest_readings(200)
+
+    start_time = time.time()
+
+    for reading in readings:
+        app.request("/api/{0}/data/reading".format(key.key_value), \
+        method="PUT", data=reading.json_repr())
+
+    duration = time.time() - start_time
+
+    results.append({"name": "ingest_put", "readings": len(readings), \
+    "total_ms": duration * 1000, "readings_per_s": len(readings) / duration})
+
+    # a minute of readings per request
+    batch_size = int(60 * rate) or 1
+    readings = ingest_readings(batch_size * 50)
+
+    start_time = time.time()
+
+    for first in range(0, len(readings), batch_size):
+        app.request("/api/{0}/data/readings".format(key.key_value), \
+        method="PUT", data="[" + ",".join([reading.json_repr() \
+        for reading in readings[first:first + batch_size]]) + "]")
+
+    duration = time.time() - start_time
+
+    results.append({"name": "ingest_put_bulk", "readings": len(readings), \
+    "batch_size": batch_size, "total_ms": duration * 1000, \
+    "readings_per_s": len(readings) / duration})
+
+    return results
+
+def run(rate):
+    """Runs every benchmark against the configured database
+
+    :param rate: sample rate of the generated data [samples/s]
+    :return: list of results
+    """
+
+    # imported here as the modules are configured from the command line
+    import models
+    import server
+
+    db = server.db
+    streams = server.streams
+
+    # end of the generated data
+    end = max([state.last_timestamp for state \
+    in models.ChannelState.get_all(db).values()]) + 1
+
+    results = []
+    results.extend(bench_raw_window(streams, end))
+    results.extend(bench_index_page(server.app, streams, end))
+    results.extend(bench_trend_update(db, streams, end))
+
+    # last, as it adds samples
+    results.extend(bench_ingest(db, server.config, server.server_key, \
+    server.app, end, rate))
+
+    return results
+
+if __name__ == "__main__":
+    config_path, output_path, rate = sys.argv[1:4]
+
+    # leave only the config for the application modules
+    sys.argv = sys.argv[:2]
+
+    results = run(float(rate))
+
+    with open(output_path, "w") as output_file:
+        json.dump(results, output_file)
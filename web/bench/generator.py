@@ -0,0 +1,150 @@
+from __future__ import division
+
+import numpy as np
+
+from picolog.data import DataStore, Reading
+
+"""Synthetic magnetometer data
+
+Channels 13, 14 and 16 are the East/West, Up/Down and North/South field
+axes, and channel 15 is the temperature. Each field axis is a baseline with
+a daily variation, slow drift, noise and occasional disturbances; the
+temperature follows the day with a slower response. Values are integer ADC
+counts, as logged. The data depends only on the seed, start time and
+sample rate, so runs are reproducible.
+"""
+
+"""Channels in the order they are read"""
+CHANNELS = [13, 14, 15, 16]
+
+"""Field channels: (baseline, daily amplitude, noise) in counts"""
+FIELD_CHANNELS = {
+    13: (250000, 4000, 60),
+    14: (-410000, 2500, 40),
+    16: (180000, 6000, 80)
+}
+
+"""Temperature channel: (baseline, daily amplitude, noise) in counts"""
+TEMPERATURE_CHANNEL = (15, (21000, 3000, 5))
+
+"""Day length [ms]"""
+DAY = 86400000
+
+"""Default samples per second per channel"""
+DEFAULT_RATE = 1
+
+"""Default random seed"""
+DEFAULT_SEED = 20150101
+
+def get_timestamps(start, duration, rate=DEFAULT_RATE):
+    """Returns evenly spaced sample times
+
+    :param start: first sample time [ms]
+    :param duration: length of the data [ms]
+    :param rate: samples per second
+    :return: array of timestamps [ms]
+    """
+
+    period = 1000 / rate
+
+    return (int(start) + np.arange(int(duration / period)) * period) \
+    .astype(np.int64)
+
+def generate_channel(channel_num, timestamps, rate=DEFAULT_RATE, \
+seed=DEFAULT_SEED):
+    """Returns a channel's values at the specified times
+
+    The random state is seeded from the channel and the first timestamp, so
+    a long span can be generated in consecutive pieces.
+
+    :param channel_num: channel number
+    :param timestamps: array of sample times [ms]
+    :param rate: samples per second
+    :return: array of values
+    """
+
+    if len(timestamps) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    random_state = np.random.RandomState((seed + channel_num * 1000003 \
+    + int(timestamps[0]) // 1000) % 2 ** 32)
+
+    # time of day and time in days
+    phase = 2 * np.pi * (timestamps % DAY) / DAY
+    days = timestamps / DAY
+
+    if channel_num == TEMPERATURE_CHANNEL[0]:
+        baseline, amplitude, noise = TEMPERATURE_CHANNEL[1]
+
+        # the building lags the day by a few hours
+        values = baseline + amplitude * np.sin(phase - 2.5) \
+        + noise * random_state.standard_normal(len(timestamps))
+    else:
+        baseline, amplitude, noise = FIELD_CHANNELS[channel_num]
+
+        # daily variation, seasonal drift and noise
+        values = baseline + amplitude * np.sin(phase + channel_num) \
+        + 0.5 * amplitude * np.sin(2 * np.pi * days / 365.25) \
+        + noise * random_state.standard_normal(len(timestamps))
+
+        # disturbances: steps decaying over minutes, about hourly
+        disturbances = random_state.rand(len(timestamps)) < 1 / (3600 * rate)
+
+        for index in np.flatnonzero(disturbances):
+            length = min(len(timestamps) - index, int(600 * rate) + 1)
+
+            values[index:index + length] += amplitude \
+            * random_state.uniform(-1, 1) \
+            * np.exp(-np.arange(length) / (120 * rate))
+
+    return np.round(values).astype(np.int64)
+
+def generate_arrays(start, duration, rate=DEFAULT_RATE, seed=DEFAULT_SEED):
+    """Returns every channel's samples over a time span
+
+    :return: (timestamps, dict of channel number to values)
+    """
+
+    timestamps = get_timestamps(start, duration, rate)
+
+    return timestamps, dict([(channel_num, generate_channel(channel_num, \
+    timestamps, rate, seed)) for channel_num in CHANNELS])
+
+def generate_readings(start, duration, rate=DEFAULT_RATE, seed=DEFAULT_SEED):
+    """Returns readings of every channel over a time span
+
+    :return: list of readings
+    """
+
+    timestamps, values = generate_arrays(start, duration, rate, seed)
+
+    columns = [values[channel_num].tolist() for channel_num in CHANNELS]
+
+    return [Reading(timestamp, CHANNELS, list(reading_values)) \
+    for timestamp, reading_values in zip(timestamps.tolist(), zip(*columns))]
+
+def generate_datastore(start, duration, rate=DEFAULT_RATE, \
+seed=DEFAULT_SEED):
+    """Returns a datastore of readings over a time span"""
+
+    readings = generate_readings(start, duration, rate, seed)
+
+    datastore = DataStore(len(readings))
+    datastore.insert(readings)
+
+    return datastore
+
+def generate_rows(start, duration, rate=DEFAULT_RATE, seed=DEFAULT_SEED):
+    """Returns (channel, timestamp, value) sample rows over a time span"""
+
+    timestamps, values = generate_arrays(start, duration, rate, seed)
+
+    timestamps = timestamps.tolist()
+
+    rows = []
+
+    for channel_num in CHANNELS:
+        rows.extend(zip([channel_num] * len(timestamps), timestamps, \
+        values[channel_num].tolist()))
+
+    return rows
@@ -0,0 +1,214 @@
+from __future__ import division
+
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import web
+
+import models
+import backfill
+from bench import generator
+from config import get_config, get_database_pragmas, parse_channels, \
+parse_streams
+from database import Database
+from populate import populate
+
+"""Generates benchmark databases and runs the benchmarks against them
+
+Usage: python -m bench.run [--sizes day,month,year] [--rate samples/s]
+[--seed seed] [--work directory] [--output file]
+
+Each size of data ends at the same fixed time, so a database generated with
+the same rate and seed always holds the same samples. Databases are kept in
+the work directory and reused by later runs.
+"""
+
+"""Data sizes: name and length [ms]"""
+SIZES = [("day", generator.DAY), ("month", 30 * generator.DAY), \
+("year", 365 * generator.DAY)]
+
+"""End of the generated data [ms]: 2015-01-01 00:00 UTC"""
+DATA_END = 1420070400000
+
+"""Length of data written per transaction while generating [ms]"""
+GENERATE_CHUNK = 3600000
+
+def get_configs(config_path=None):
+    """Returns the config, channel config and stream config"""
+
+    return get_config(config_path, "config" + os.path.sep \
+    + "config.default"), get_config(None, "config" + os.path.sep \
+    + "channel_config.default"), get_config(None, "config" + os.path.sep \
+    + "stream_config.default")
+
+def generate_database(path, duration, rate, seed):
+    """Creates a database of generated data ending at DATA_END
+
+    Samples are written through ChannelSamples.write_rows, so summaries and
+    channel states are maintained as on ingest, and trends are backfilled.
+    """
+
+    config, channel_config, stream_config = get_configs()
+
+    # don't print every query
+    web.config.debug = False
+
+    # build under a temporary name, so an interrupted run isn't reused
+    temporary_path = path + ".tmp"
+
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+
+    # for the backfill worker processes
+    config.set('database', 'path', temporary_path)
+
+    db = Database(temporary_path, pragmas=get_database_pragmas(config))
+
+    key = populate(db, config, channel_config)
+
+    channels = parse_channels(channel_config, db=db, config=config)
+    streams = parse_streams(stream_config, channels=channels, key=key, \
+    db=db, config=config)
+
+    start_time = time.time()
+
+    for start in range(DATA_END - duration, DATA_END, GENERATE_CHUNK):
+        models.ChannelSamples.write_rows(db, config, \
+        [generator.generate_rows(start, min(GENERATE_CHUNK, DATA_END - start), \
+        rate, seed)])
+
+        print >> sys.stderr, "\rGenerated {0:.1f}% in {1:.0f} s".format(100 \
+        * (start - DATA_END + duration + GENERATE_CHUNK) / duration, \
+        time.time() - start_time),
+
+    print >> sys.stderr
+
+    # generated trends
+    for stream in streams:
+        if stream.stream_type == "trend":
+            stream.init_schema()
+
+            backfill.backfill(db, config, stream)
+
+    # move everything from the log into the database file
+    db.query("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    os.rename(temporary_path, path)
+
+def write_config(path, database_path, work_path):
+    """Writes the benchmark config file
+
+    Trends are left to the benchmarks rather than updated in the background,
+    and debug mode is disabled.
+    """
+
+    config = get_configs()[0]
+
+    config.set('general', 'debug', '')
+    config.set('database', 'path', database_path)
+    config.set('archive', 'path', os.path.join(work_path, "archive"))
+
+    if not config.has_section('trends'):
+        config.add_section('trends')
+
+    config.set('trends', 'mode', "external")
+
+    with open(path, "w") as config_file:
+        config.write(config_file)
+
+def get_revision():
+    """Returns the current git commit, or None"""
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], \
+        stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes, rate, seed, work_path):
+    """Runs the benchmarks for each size of data
+
+    :return: dict of run information and results
+    """
+
+    if not os.path.isdir(work_path):
+        os.makedirs(work_path)
+
+    report = {"revision": get_revision(), "time": int(time.time()), \
+    "python": platform.python_version(), "rate": rate, "seed": seed, \
+    "results": []}
+
+    for name, duration in SIZES:
+        if name not in sizes:
+            continue
+
+        database_path = os.path.join(work_path, \
+        "bench-{0}-{1}-{2}.db".format(name, rate, seed))
+
+        if not os.path.exists(database_path):
+            print >> sys.stderr, "Generating {0} of data".format(name)
+
+            generate_database(database_path, duration, rate, seed)
+
+        # benchmarks write to the database, so run them on a copy
+        run_path = os.path.join(work_path, "run.db")
+
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(run_path + suffix):
+                os.remove(run_path + suffix)
+
+        shutil.copyfile(database_path, run_path)
+
+        config_path = os.path.join(work_path, "bench.conf")
+        write_config(config_path, run_path, work_path)
+
+        print >> sys.stderr, "Running benchmarks with a {0} of data".format( \
+        name)
+
+        output_file, output_path = tempfile.mkstemp(suffix=".json")
+        os.close(output_file)
+
+        try:
+            # keep stdout for the report
+            subprocess.check_call([sys.executable, "-m", "bench.benchmarks", \
+            config_path, output_path, str(rate)], stdout=sys.stderr)
+
+            with open(output_path) as output:
+                results = json.load(output)
+        finally:
+            os.remove(output_path)
+
+        for result in results:
+            result["size"] = name
+
+        report["results"].extend(results)
+
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the benchmarks")
+    parser.add_argument("--sizes", default="day,month,year", \
+    help="comma separated data sizes: day, month and/or year")
+    parser.add_argument("--rate", type=float, default=generator.DEFAULT_RATE, \
+    help="samples per second per channel")
+    parser.add_argument("--seed", type=int, default=generator.DEFAULT_SEED, \
+    help="random seed of the generated data")
+    parser.add_argument("--work", default="bench-data", \
+    help="directory for the generated databases")
+    parser.add_argument("--output", help="results file (default stdout)")
+
+    args = parser.parse_args()
+
+    report = run(args.sizes.split(","), args.rate, args.seed, args.work)
+
+    if args.output is None:
+        print json.dumps(report, indent=2)
+    else:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
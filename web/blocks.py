@@ -0,0 +1,156 @@
+import struct
+import numpy as np
+
+"""Compressed encoding of blocks of samples
+
+A block holds one channel's samples over a fixed time span in time order.
+Timestamps are stored as the first timestamp followed by the
+delta-of-deltas of the rest, which are zero for samples at a regular
+cadence, and values as the first value followed by the differences between
+consecutive values. Both sequences are zig-zag encoded, so small negative
+numbers stay small, then written as little-endian base 128 varints: one byte
+for each 7 bits, with the top bit set on all but the last byte of a number.
+
+Layout: header (format version, sample count, first timestamp, first value,
+length of the timestamp varints), timestamp varints, value varints.
+"""
+
+"""Block header: version, sample count, first timestamp, first value, bytes
+of timestamp varints"""
+HEADER_FORMAT = "<BxxxIqqI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+VERSION = 1
+
+"""Maximum number of bytes in a 64 bit varint"""
+MAX_VARINT_BYTES = 10
+
+def zigzag_encode(values):
+    """Maps signed integers to unsigned, interleaving negative and positive
+
+    0, -1, 1, -2, 2... become 0, 1, 2, 3, 4...
+    """
+
+    values = np.asarray(values, dtype=np.int64)
+
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+def zigzag_decode(values):
+    """Inverts zigzag_encode"""
+
+    values = np.asarray(values, dtype=np.uint64)
+
+    return ((values >> np.uint64(1)).view(np.int64) \
+    ^ -(values & np.uint64(1)).view(np.int64))
+
+def varint_encode(values):
+    """Returns unsigned integers as concatenated varints
+
+    :param values: array of unsigned integers
+    :return: byte string
+    """
+
+    values = np.asarray(values, dtype=np.uint64)
+
+    if len(values) == 0:
+        return ""
+
+    # number of 7 bit groups needed by each value
+    lengths = np.ones(len(values), dtype=np.int64)
+
+    for shift in range(7, 64, 7):
+        lengths += values >= np.uint64(1 << shift)
+
+    groups = np.arange(MAX_VARINT_BYTES)
+
+    # every group of every value, least significant first
+    digits = (values[:, np.newaxis] >> (7 * groups).astype(np.uint64)) \
+    & np.uint64(0x7f)
+
+    # continuation bit on all but each value's last group
+    digits |= (groups < lengths[:, np.newaxis] - 1).astype(np.uint64) << \
+    np.uint64(7)
+
+    return digits[groups < lengths[:, np.newaxis]].astype(np.uint8) \
+    .tostring()
+
+def varint_decode(data):
+    """Returns the unsigned integers in concatenated varints
+
+    :param data: byte string
+    :return: array of unsigned integers
+    """
+
+    data = np.frombuffer(data, dtype=np.uint8)
+
+    if len(data) == 0:
+        return np.empty(0, dtype=np.uint64)
+
+    # last byte of each value
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+
+    # position of each byte within its value
+    positions = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+
+    digits = (data & 0x7f).astype(np.uint64) << (7 * positions) \
+    .astype(np.uint64)
+
+    return np.bitwise_or.reduceat(digits, starts)
+
+def encode(timestamps, values):
+    """Encodes a block of samples
+
+    :param timestamps: timestamps [ms] in increasing order
+    :param values: integer values
+    :return: byte string
+    """
+
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+
+    if len(timestamps) == 0:
+        return struct.pack(HEADER_FORMAT, VERSION, 0, 0, 0, 0)
+
+    # differences between consecutive timestamps, then between those
+    deltas = np.diff(timestamps)
+    timestamp_data = varint_encode(zigzag_encode(np.diff( \
+    np.concatenate(([0], deltas)))))
+
+    value_data = varint_encode(zigzag_encode(np.diff(values)))
+
+    return struct.pack(HEADER_FORMAT, VERSION, len(timestamps), \
+    timestamps[0], values[0], len(timestamp_data)) + timestamp_data \
+    + value_data
+
+def decode(data):
+    """Decodes a block of samples
+
+    :param data: byte string returned by encode
+    :return: (timestamps, values) arrays
+    """
+
+    data = str(data)
+
+    version, count, first_timestamp, first_value, timestamp_length = \
+    struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+
+    if version != VERSION:
+        raise Exception("Unsupported block version {0}".format(version))
+
+    if count == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    timestamp_end = HEADER_SIZE + timestamp_length
+
+    deltas = np.cumsum(zigzag_decode(varint_decode( \
+    data[HEADER_SIZE:timestamp_end])))
+    timestamps = first_timestamp + np.concatenate(([0], np.cumsum(deltas))) \
+    .astype(np.int64)
+
+    values = first_value + np.concatenate(([0], np.cumsum(zigzag_decode( \
+    varint_decode(data[timestamp_end:]))))).astype(np.int64)
+
+    if len(timestamps) != count or len(values) != count:
+        raise Exception("Corrupt block: expected {0} samples".format(count))
+
+    return timestamps, values
@@ -0,0 +1,239 @@
+from __future__ import division
+
+import time
+import datetime
+import threading
+import hashlib
+import web
+
+from collections import OrderedDict
+
+import models
+
+"""Caching of rendered responses, and HTTP validators
+
+Each stream has a generation, bumped whenever its channel is written to or
+its trend gains points. Rendered series are cached under their request
+parameters along with the ETag they were rendered for, which combines the
+stream's generation with the start time of this process, so a generation is
+never reused, and the current lifetime period, so series whose default
+window slides with time, or which other processes update, are rendered again
+at least that often. A cached response is used only while the stream's ETag
+is unchanged, and clients holding a response with the current ETag get
+304 Not Modified.
+"""
+
+class ResponseCache(object):
+    """Cache of rendered stream responses invalidated as streams change"""
+
+    """Default maximum number of cached responses"""
+    DEFAULT_MAX_ENTRIES = 1000
+
+    """Default maximum time a response is used for [s]"""
+    DEFAULT_TTL = 60
+
+    """Default time clients may keep ranges that can no longer change [s]"""
+    DEFAULT_IMMUTABLE_MAX_AGE = 86400
+
+    """Default interval between checks for samples written by other
+    processes [ms]"""
+    DEFAULT_POLL_INTERVAL = 1000
+
+    def __init__(self, config, streams):
+        """Initialises the cache
+
+        :param streams: streams whose responses are cached
+        """
+
+        self.max_entries = self.DEFAULT_MAX_ENTRIES
+        self.ttl = self.DEFAULT_TTL
+        self.immutable_max_age = self.DEFAULT_IMMUTABLE_MAX_AGE
+        self.poll_interval = self.DEFAULT_POLL_INTERVAL
+
+        if config.has_option('cache', 'response_entries'):
+            self.max_entries = config.getint('cache', 'response_entries')
+
+        if config.has_option('cache', 'response_ttl'):
+            self.ttl = config.getfloat('cache', 'response_ttl')
+
+        if config.has_option('cache', 'immutable_max_age'):
+            self.immutable_max_age = config.getint('cache', \
+            'immutable_max_age')
+
+        if config.has_option('cache', 'poll_interval'):
+            self.poll_interval = config.getfloat('cache', 'poll_interval')
+
+        # ETags from before a restart must not match
+        self.boot = "{0:x}".format(int(time.time() * 1000))
+
+        # stream ids by channel
+        self.channel_streams = {}
+
+        for stream in streams:
+            self.channel_streams.setdefault(stream.channel.channel_num, \
+            []).append(stream.get_id())
+
+        # generation of each stream, and the time it started [s]
+        start_time = time.time()
+
+        self._versions = dict([(stream.get_id(), (0, start_time)) \
+        for stream in streams])
+
+        # cached responses by key, least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+    def watch(self, db):
+        """Starts a thread finding samples written by other processes
+
+        Trend points added by other processes are only found once the ETags'
+        lifetime period ends.
+        """
+
+        thread = threading.Thread(target=models.ChannelState.watch, \
+        args=(db, self.poll_interval, self.notify), name="cache-watch")
+
+        # don't keep the process alive for the thread
+        thread.daemon = True
+        thread.start()
+
+    def notify(self, channel_nums):
+        """Starts a new generation of the streams of channels with new samples
+
+        :param channel_nums: iterable of channel numbers
+        """
+
+        stream_ids = []
+
+        for channel_num in channel_nums:
+            stream_ids.extend(self.channel_streams.get(channel_num, []))
+
+        self.notify_streams(stream_ids)
+
+    def notify_streams(self, stream_ids):
+        """Starts a new generation of streams
+
+        :param stream_ids: iterable of stream ids
+        """
+
+        now = time.time()
+
+        with self._lock:
+            for stream_id in stream_ids:
+                generation, modified = self._versions.get(stream_id, (0, now))
+                self._versions[stream_id] = (generation + 1, now)
+
+    def get_version(self, stream_id):
+        """Returns a stream's current ETag and modification time
+
+        :return: (ETag, time [s])
+        """
+
+        now = time.time()
+
+        with self._lock:
+            generation, modified = self._versions.get(stream_id, (0, now))
+
+        return "{0}-{1}-{2}".format(self.boot, generation, \
+        int(now // self.ttl)), modified
+
+    def get(self, key, etag):
+        """Returns a cached response, or None
+
+        :param key: request parameters
+        :param etag: current ETag of the response's stream
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+
+                return None
+
+            # most recently used
+            self._entries[key] = entry
+
+            self.hits += 1
+
+            return entry[1]
+
+    def put(self, key, etag, response):
+        """Caches a response
+
+        :param key: request parameters
+        :param etag: ETag of the stream the response was rendered for
+        :param response: response body
+        """
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (etag, response)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_stats(self):
+        """Returns the number of cached responses, hits and misses"""
+
+        return {"entries": len(self._entries), "hits": self.hits, \
+        "misses": self.misses}
+
+def get_etag(body):
+    """Returns an ETag for a fixed response body"""
+
+    return hashlib.md5(body).hexdigest()
+
+def check_modified(etag, modified=None):
+    """Sets the validator headers, and answers 304 if the client is current
+
+    If-None-Match takes precedence over If-Modified-Since. Last-Modified is
+    only sent once the second of the modification has passed, as a later
+    change within the same second would otherwise look unmodified.
+
+    :param etag: ETag of the response
+    :param modified: time of the last change [s], or None
+    :raises web.notmodified: if the client's copy is current
+    """
+
+    web.header('ETag', '"{0}"'.format(etag))
+
+    if modified is not None and int(modified) + 1 <= time.time():
+        web.lastmodified(datetime.datetime.utcfromtimestamp(int(modified)))
+    else:
+        modified = None
+
+    if_none_match = web.ctx.env.get('HTTP_IF_NONE_MATCH')
+
+    if if_none_match is not None:
+        etags = set()
+
+        for value in if_none_match.split(","):
+            value = value.strip()
+
+            # weak comparison
+            if value.startswith("W/"):
+                value = value[2:]
+
+            etags.add(value.strip('"'))
+
+        if etag in etags or "*" in etags:
+            raise web.notmodified()
+
+        return
+
+    if modified is None:
+        return
+
+    if_modified_since = web.net.parsehttpdate(web.ctx.env.get( \
+    'HTTP_IF_MODIFIED_SINCE', "").split(";")[0])
+
+    if if_modified_since is not None \
+    and datetime.datetime.utcfromtimestamp(int(modified)) \
+    <= if_modified_since:
+        raise web.notmodified()
@@ -0,0 +1,126 @@
+from __future__ import division
+
+import sys
+import time
+import threading
+
+import models
+
+"""Compaction of older samples into compressed blocks
+
+Samples are written to the samples table, where recent data is read and
+updated quickly. Spans of samples older than the [blocks] keep period are
+periodically moved into compressed blocks (see models.ChannelBlocks), which
+take a fraction of the space and are read a block at a time.
+
+Usage: python compaction.py [config] [channel config] [stream config]
+"""
+
+class BlockCompactor(object):
+    """Compacts older samples periodically in a background thread"""
+
+    """Default interval between runs [s]"""
+    DEFAULT_INTERVAL = 600
+
+    """Default pause between blocks [ms]"""
+    DEFAULT_BATCH_PAUSE = 100
+
+    def __init__(self, db, config, channels):
+        """Initialises the compactor
+
+        :param channels: channels to compact
+        """
+
+        self.db = db
+        self.config = config
+        self.channels = channels
+
+        self.interval = self.DEFAULT_INTERVAL
+        self.keep = models.ChannelBlocks.DEFAULT_KEEP
+        self.batch_pause = self.DEFAULT_BATCH_PAUSE
+
+        if config.has_option('blocks', 'interval'):
+            self.interval = config.getfloat('blocks', 'interval')
+
+        if config.has_option('blocks', 'keep'):
+            self.keep = config.getint('blocks', 'keep')
+
+        if config.has_option('blocks', 'batch_pause'):
+            self.batch_pause = config.getfloat('blocks', 'batch_pause')
+
+        # check the span before starting
+        models.ChannelBlocks.get_span(config)
+
+        # statistics
+        self.last_run = None
+        self.block_count = 0
+        self.sample_count = 0
+        self.error_count = 0
+
+    def start(self):
+        """Starts the background thread"""
+
+        thread = threading.Thread(target=self._work, name="compaction")
+
+        # don't keep the process alive for the thread
+        thread.daemon = True
+        thread.start()
+
+    def _work(self):
+        while True:
+            try:
+                self.run()
+            except Exception, e:
+                print >> sys.stderr, "Error compacting samples: {0}".format(e)
+
+                self.error_count += 1
+
+            time.sleep(self.interval)
+
+    def run(self):
+        """Compacts each channel's samples older than the keep period
+
+        :return: number of samples compacted
+        """
+
+        states = models.ChannelState.get_all(self.db)
+
+        count = 0
+
+        for channel in self.channels:
+            state = states.get(channel.channel_num)
+
+            if state is None or state.last_timestamp is None:
+                continue
+
+            block_count, sample_count = models.ChannelBlocks( \
+            channel.channel_num, self.db, self.config).compact( \
+            state.last_timestamp - self.keep, self.batch_pause / 1000)
+
+            self.block_count += block_count
+            self.sample_count += sample_count
+            count += sample_count
+
+        self.last_run = int(time.time() * 1000)
+
+        return count
+
+    def get_stats(self):
+        """Returns the amounts compacted and the size of the stored blocks"""
+
+        stats = models.ChannelBlocks.get_stats(self.db)
+        stats.update({"last_run": self.last_run, \
+        "blocks_written": self.block_count, \
+        "samples_compacted": self.sample_count, "errors": self.error_count})
+
+        return stats
+
+if __name__ == "__main__":
+    from config import init_settings_from_argv
+
+    config, db, server_key, channels, streams = init_settings_from_argv()
+
+    compactor = BlockCompactor(db, config, channels)
+
+    print "Compacted {0} samples".format(compactor.run())
+    print compactor.get_stats()
@@ -5,8 +5,10 @@ import web
 
 from collections import OrderedDict
 
-from models import Channel, ChannelSamples, ChannelSampleTrends, Key
-from database import Database
+from models import Channel, ChannelSamples, ChannelSampleTrends, \
+ChannelRollups, ChannelBlocks, ChannelState, Key
+from database import Database, SCHEMA_VERSION
+import metrics
 
 def parse_config(config_path, default_path):
     # create the config object
@@ -31,8 +33,21 @@ def init_settings(config, channel_config, stream_config):
     # set debug mode etc.
     set_web_settings(config)
 
+    # instrumentation settings
+    metrics.configure(config)
+
     # create database
-    db = Database(config.get('database', 'path'))
+    db = Database(config.get('database', 'path'), \
+    pragmas=get_database_pragmas(config))
+
+    # warn about databases still using an older layout
+    if db.get_schema_version() < SCHEMA_VERSION:
+        print "Database schema is out of date: run migrate.py to upgrade it"
+
+    # create summary tables maintained on ingest, if necessary
+    ChannelRollups.init_schema(db)
+    ChannelBlocks.init_schema(db)
+    ChannelState.init_schema(db)
 
     # create key
     key = Key(config.get('general', 'key'), db, config)
@@ -48,6 +63,15 @@ def init_settings(config, channel_config, stream_config):
     return (config, db, key, channels, streams)
 
 def init_settings_from_argv():
+    return init_settings(*get_configs_from_argv())
+
+def get_configs_from_argv():
+    """Returns the config, channel config and stream config
+
+    Each is read from the path given on the command line, if any, over the
+    defaults in the config directory.
+    """
+
     # path to config files, if specified
     config_path = None
     channel_config_path = None
@@ -66,15 +90,39 @@ def init_settings_from_argv():
     stream_config = get_config(stream_config_path, \
     "config" + os.path.sep + "stream_config.default")
 
-    return init_settings(config, channel_config, stream_config)
+    return config, channel_config, stream_config
 
 def parse_channels(channel_config, *args, **kwargs):
     """Returns channels based on the specified info"""
 
-    # parse and return channels
-    return [Channel(int(channel_config.get(section, "channel")), \
-    channel_config.get(section, "name"), *args, **kwargs) \
-    for section in channel_config.sections()]
+    channels = []
+
+    for section in channel_config.sections():
+        channel = Channel(int(channel_config.get(section, "channel")), \
+        channel_config.get(section, "name"), *args, **kwargs)
+
+        # retention periods
+        channel.keep_raw = parse_retention(channel_config, section, \
+        "keep_raw")
+        channel.keep_trends = parse_retention(channel_config, section, \
+        "keep_trends")
+
+        channels.append(channel)
+
+    return channels
+
+def parse_retention(channel_config, section, option):
+    """Returns a retention period in days, or None to keep data forever"""
+
+    if not channel_config.has_option(section, option):
+        return None
+
+    value = channel_config.get(section, option).strip().lower()
+
+    if value in ("", "forever"):
+        return None
+
+    return float(value)
 
 def parse_streams(stream_config, *args, **kwargs):
     return [parse_stream(stream_config, section, *args, **kwargs) \
@@ -109,6 +157,41 @@ def parse_stream(stream_config, section, channels, key, db, config):
     else:
         raise TypeError("Unrecognised stream type")
 
+def get_database_pragmas(config):
+    """Returns the database connection settings specified in the config"""
+
+    return dict([(name, config.get('database', name)) \
+    for name in Database.DEFAULT_PRAGMAS \
+    if config.has_option('database', name)])
+
+"""Number of threads of web.py's simple server"""
+SIMPLE_SERVER_THREADS = 10
+
+def get_server_mode(config):
+    """Returns how the site is served: simple, by web.py's own server, or
+    production, by production.py's pools of worker processes"""
+
+    if config.has_option('server', 'mode'):
+        return config.get('server', 'mode')
+
+    return "simple"
+
+def get_request_threads(config):
+    """Returns the number of threads serving requests in each server process
+
+    :return: the threads of web.py's simple server, or the fewest threads of
+    a production pool's workers
+    """
+
+    if get_server_mode(config) == "production":
+        # imported here, as production imports this module
+        import production
+
+        return min([production.get_pool_options(config, pool)["threads"] \
+        for pool in production.POOLS])
+
+    return SIMPLE_SERVER_THREADS
+
 def set_web_settings(config):
     # debug mode
     web.config.debug = bool(config.get('general', 'debug'))
@@ -1,15 +1,120 @@
+import time
+import itertools
 import web.db
+import numpy as np
+
+from collections import OrderedDict
+
+import metrics
+
+"""Current database schema version, stored as the SQLite user_version
+
+Version 1 is the original layout with DATETIME(3) timestamps. Version 2 uses
+integer ms timestamps in WITHOUT ROWID tables clustered on (channel,
+timestamp); migrate.py converts version 1 databases."""
+SCHEMA_VERSION = 2
 
 class Database(web.db.SqliteDB):
     """Magnetometer database class"""
 
-    def __init__(self, path):
+    """Default connection settings, applied as PRAGMA statements"""
+    DEFAULT_PRAGMAS = OrderedDict([
+        # turn on foreign key support
+        ("foreign_keys", "ON"),
+        # let deleted pages be freed a few at a time; this only applies to
+        # new databases, or existing ones after a VACUUM
+        ("auto_vacuum", "INCREMENTAL"),
+        # let readers continue while the ingest writer commits
+        ("journal_mode", "WAL"),
+        # in WAL mode, only checkpoints need to wait for the disk
+        ("synchronous", "NORMAL"),
+        # page cache size, in KiB when negative
+        ("cache_size", "-16000"),
+        # bytes of the file to access through memory mapping
+        ("mmap_size", "268435456")
+    ])
+
+    def __init__(self, path, pragmas=None):
+        """Initialises the database
+
+        :param path: path to the database file
+        :param pragmas: dict of connection settings overriding the defaults
+        """
+
+        # connection settings
+        self.pragmas = OrderedDict(self.DEFAULT_PRAGMAS)
+
+        if pragmas is not None:
+            self.pragmas.update(pragmas)
+
         # call parent - the old style way because web.db doesn't use new style
         # classes
         web.db.SqliteDB.__init__(self, db=path)
 
-        # turn on foreign key support
-        self.query("PRAGMA foreign_keys=ON")
+    def _connect(self, keywords):
+        """Opens a connection and applies the connection settings
+
+        web.db opens a connection for each thread, so the settings are applied
+        to each one here.
+        """
+
+        connection = web.db.SqliteDB._connect(self, keywords)
+
+        for name, value in self.pragmas.iteritems():
+            connection.execute("PRAGMA {0}={1}".format(name, value))
+
+        return connection
+
+    def _db_execute(self, cursor, sql_query):
+        """Executes a statement, recording its execution time
+
+        Every query, select, insert, update and delete made through web.db
+        passes through here.
+        """
+
+        if not metrics.enabled:
+            return web.db.SqliteDB._db_execute(self, cursor, sql_query)
+
+        start_time = time.time()
+
+        result = web.db.SqliteDB._db_execute(self, cursor, sql_query)
+
+        duration = time.time() - start_time
+
+        sql, params = self._process_query(sql_query)
+
+        metrics.record_query(sql, duration, \
+        lambda: self._explain(sql, params))
+
+        return result
+
+    def _explain(self, sql, params=()):
+        """Returns the query plan of a statement as a list of strings
+
+        A separate connection is used, as the sqlite3 module commits any open
+        transaction before statements other than data changes and selects.
+        The connection settings aren't applied to it, as some of them wait for
+        the write lock.
+        """
+
+        connection = web.db.SqliteDB._connect(self, dict(self.keywords))
+
+        try:
+            # the last column describes each step
+            return [str(row[-1]) for row in connection.execute( \
+            "EXPLAIN QUERY PLAN " + sql, params)]
+        finally:
+            connection.close()
+
+    def get_schema_version(self):
+        """Returns the schema version of the database"""
+
+        return self.query("PRAGMA user_version")[0].user_version
+
+    def set_schema_version(self, version):
+        """Sets the schema version of the database"""
+
+        self.query("PRAGMA user_version={0}".format(int(version)))
 
     def select_single_row(self, *args, **kwargs):
         """Selects and returns a single row"""
@@ -47,3 +152,143 @@ class Database(web.db.SqliteDB):
             return row[kwargs['what']]
         else:
             return None
+
+    def insert_many(self, tablename, columns, rows):
+        """Inserts many rows using a single batched statement
+
+        Unlike web.db's multiple_insert, which falls back to one INSERT per row
+        on SQLite, this prepares the statement once and executes it for every
+        row with the cursor's executemany.
+
+        :param tablename: table to insert into
+        :param columns: sequence of column names
+        :param rows: sequence of value tuples, in the same order as columns
+        :return: number of rows actually inserted
+        """
+
+        if not rows:
+            return 0
+
+        # build the statement with one (qmark style) parameter per column
+        sql = "INSERT INTO {0} ({1}) VALUES ({2})".format(tablename, \
+        ", ".join(columns), ", ".join(["?"] * len(columns)))
+
+        cursor = self._db_cursor()
+
+        start_time = time.time()
+
+        try:
+            cursor.executemany(sql, rows)
+        except:
+            # roll back like web.db does for failed single statements
+            if self.ctx.transactions:
+                self.ctx.transactions[-1].rollback()
+            else:
+                self.ctx.rollback()
+
+            raise
+
+        # commit if we're not inside a transaction
+        if not self.ctx.transactions:
+            self.ctx.commit()
+
+        if metrics.enabled:
+            metrics.record_query(sql, time.time() - start_time, \
+            lambda: self._explain(sql, rows[0]))
+
+        return cursor.rowcount
+
+    def begin_write(self):
+        """Takes the write lock for the current transaction
+
+        Python's sqlite3 module only begins a transaction at its first write,
+        so earlier reads see other connections' commits. Call this first in a
+        transaction whose writes depend on what it reads; other writers wait
+        until it ends.
+        """
+
+        self.query("BEGIN IMMEDIATE")
+
+    def incremental_vacuum(self, pages):
+        """Returns up to a number of free pages to the file system
+
+        The pragma frees one page per step of its statement, so every result
+        row is read: web.db's query takes only the first step, freeing a
+        single page.
+
+        :param pages: maximum number of pages to free
+        """
+
+        cursor = self._db_cursor()
+
+        list(cursor.execute("PRAGMA incremental_vacuum({0})".format( \
+        int(pages))))
+
+        # commit if we're not inside a transaction
+        if not self.ctx.transactions:
+            self.ctx.commit()
+
+    def query_arrays(self, sql_query, vars=None, dtypes=None):
+        """Executes a query and returns each result column as a NumPy array
+
+        Rows are read straight from the cursor into a flat array, so no
+        Storage object is created per row.
+
+        :param sql_query: query, with $name style variables
+        :param vars: dict of variables to substitute into the query
+        :param dtypes: sequence of column data types (default float64)
+        :return: tuple of arrays, one per column
+        """
+
+        if vars is None:
+            vars = {}
+
+        cursor = self._db_cursor()
+        self._db_execute(cursor, web.db.reparam(sql_query, vars))
+
+        return self._rows_to_arrays(cursor, len(cursor.description), dtypes)
+
+    def iter_arrays(self, sql_query, vars=None, dtypes=None, chunk_size=10000):
+        """Executes a query and yields its result columns in chunks
+
+        Like query_arrays, but rows are fetched from the cursor chunk_size at
+        a time, so a long result is never held in memory at once.
+
+        :param sql_query: query, with $name style variables
+        :param vars: dict of variables to substitute into the query
+        :param dtypes: sequence of column data types (default float64)
+        :param chunk_size: maximum number of rows per chunk
+        :return: generator of tuples of arrays, one per column
+        """
+
+        if vars is None:
+            vars = {}
+
+        cursor = self._db_cursor()
+        self._db_execute(cursor, web.db.reparam(sql_query, vars))
+
+        column_count = len(cursor.description)
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+
+            if len(rows) == 0:
+                break
+
+            yield self._rows_to_arrays(rows, column_count, dtypes)
+
+    @staticmethod
+    def _rows_to_arrays(rows, column_count, dtypes=None):
+        """Converts an iterable of rows into a tuple of column arrays"""
+
+        if dtypes is None:
+            dtypes = [np.float64] * column_count
+
+        # read all cells into one array, then split into columns
+        cells = np.fromiter(itertools.chain.from_iterable(rows), \
+        dtype=np.float64).reshape(-1, column_count)
+
+        metrics.rows_read.inc(len(cells))
+
+        return tuple([cells[:, column].astype(dtype) \
+        for column, dtype in enumerate(dtypes)])
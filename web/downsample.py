@@ -0,0 +1,119 @@
+from __future__ import division
+
+import numpy as np
+
+"""Visual downsampling of time series"""
+
+"""Downsampling methods"""
+METHOD_MINMAX = "minmax"
+METHOD_LTTB = "lttb"
+
+def downsample(timestamps, values, max_points, method=METHOD_MINMAX):
+    """Reduces a time series to at most max_points points
+
+    :param timestamps: array of timestamps, in ascending order
+    :param values: array of values
+    :param max_points: maximum number of points to return
+    :param method: downsampling method, METHOD_MINMAX or METHOD_LTTB
+    :return: (timestamps, values) arrays
+    """
+
+    timestamps = np.asarray(timestamps)
+    values = np.asarray(values)
+
+    # nothing to do if the series already fits
+    if max_points is None or len(timestamps) <= max_points:
+        return timestamps, values
+
+    if method == METHOD_MINMAX:
+        return min_max(timestamps, values, max_points)
+    elif method == METHOD_LTTB:
+        return lttb(timestamps, values, max_points)
+    else:
+        raise ValueError("Unrecognised downsampling method")
+
+def min_max(timestamps, values, max_points):
+    """Keeps the minimum and maximum of each of max_points / 2 time buckets
+
+    Buckets are equal spans of time, like pixel columns in a plot, so spikes
+    are always kept. The first and last points are always included.
+    """
+
+    count = len(timestamps)
+
+    # number of buckets, each contributing up to two points, leaving room for
+    # the end points
+    bucket_count = max(1, (max_points - 2) // 2)
+
+    # assign each point to a time bucket
+    start = timestamps[0]
+    span = max(timestamps[-1] - start, 1)
+    buckets = ((timestamps - start) * bucket_count // span).astype(np.int64)
+    np.clip(buckets, 0, bucket_count - 1, out=buckets)
+
+    # sort by bucket then value, so bucket minima and maxima are at the
+    # bucket edges (buckets are already in order as timestamps are sorted)
+    order = np.lexsort((values, buckets))
+    sorted_buckets = buckets[order]
+
+    # first and last positions of each non-empty bucket in the sorted order
+    edges = np.flatnonzero(np.diff(sorted_buckets)) + 1
+    firsts = np.concatenate(([0], edges))
+    lasts = np.concatenate((edges - 1, [count - 1]))
+
+    # indices of minima and maxima, plus the end points, in time order
+    indices = np.unique(np.concatenate((order[firsts], order[lasts], \
+    [0, count - 1])))
+
+    return timestamps[indices], values[indices]
+
+def lttb(timestamps, values, max_points):
+    """Largest-Triangle-Three-Buckets downsampling
+
+    Keeps the first and last points, and from each of max_points - 2 buckets
+    the point forming the largest triangle with the previously selected point
+    and the average of the next bucket. Each bucket is evaluated with array
+    operations.
+    """
+
+    count = len(timestamps)
+
+    if max_points < 3:
+        indices = np.array([0, count - 1])
+
+        return timestamps[indices], values[indices]
+
+    x = timestamps.astype(np.float64)
+    y = values.astype(np.float64)
+
+    # bucket boundaries over the points between the end points
+    edges = np.linspace(1, count - 1, max_points - 1).astype(np.int64)
+
+    indices = np.empty(max_points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = count - 1
+
+    # average of each bucket, used as the third triangle vertex
+    next_x = np.add.reduceat(x[:count - 1], edges[:-1]) / np.diff(edges)
+    next_y = np.add.reduceat(y[:count - 1], edges[:-1]) / np.diff(edges)
+
+    # the last bucket's next point is the final point
+    next_x = np.append(next_x[1:], x[-1])
+    next_y = np.append(next_y[1:], y[-1])
+
+    selected = 0
+
+    for bucket in range(max_points - 2):
+        bucket_start = edges[bucket]
+        bucket_end = edges[bucket + 1]
+
+        # twice the triangle areas for every candidate point in the bucket
+        areas = np.abs((x[selected] - next_x[bucket]) \
+        * (y[bucket_start:bucket_end] - y[selected]) \
+        - (x[selected] - x[bucket_start:bucket_end]) \
+        * (next_y[bucket] - y[selected]))
+
+        selected = bucket_start + int(np.argmax(areas))
+        indices[bucket + 1] = selected
+
+    return timestamps[indices], values[indices]
@@ -0,0 +1,371 @@
+from __future__ import division
+
+import sys
+import time
+import threading
+import Queue
+
+import models
+import utils
+
+"""Publishing of new stream points to connected browsers
+
+Writes and trend updates mark the streams of the channels they touch as
+dirty. A single publisher thread reads each dirty stream's points after the
+last ones it published, once per batch however many clients are connected,
+and puts them on the queue of every subscription to that stream. Request
+threads serving /events turn their subscription's queue into a Server-Sent
+Events response.
+
+A subscription whose client doesn't keep up is closed rather than allowed to
+grow: the browser reconnects and fetches what it missed from /series.
+"""
+
+class Subscription(object):
+    """A client's queue of events for a set of streams"""
+
+    def __init__(self, stream_ids, queue_size):
+        """Initialises the subscription
+
+        :param stream_ids: ids of the streams to receive points of
+        :param queue_size: maximum number of events waiting to be sent
+        """
+
+        self.stream_ids = frozenset(stream_ids)
+        self.queue = Queue.Queue(queue_size)
+        self.closed = False
+
+    def put(self, event):
+        """Queues an event, closing the subscription if the queue is full
+
+        :return: False if the subscription is closed
+        """
+
+        if self.closed:
+            return False
+
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            self.close()
+
+            return False
+
+        return True
+
+    def get(self, timeout):
+        """Waits for the next event
+
+        :param timeout: maximum time to wait [s]
+        :return: event text, or None if none arrived or the subscription is
+        closed
+        """
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        """Closes the subscription, waking its request thread"""
+
+        self.closed = True
+
+        try:
+            # wake the request thread if it is waiting
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            pass
+
+class EventHub(object):
+    """Publishes new points of streams to subscriptions"""
+
+    """Default maximum number of connected clients"""
+    DEFAULT_MAX_CLIENTS = 2
+
+    """Default maximum number of events waiting for a client"""
+    DEFAULT_QUEUE_SIZE = 100
+
+    """Default interval between comments keeping idle connections open [s]"""
+    DEFAULT_KEEPALIVE = 15
+
+    """Default minimum interval between reads of the same stream [ms]"""
+    DEFAULT_MIN_INTERVAL = 250
+
+    """Default interval between checks for samples written by other
+    processes [ms]"""
+    DEFAULT_POLL_INTERVAL = 1000
+
+    def __init__(self, db, config, streams, request_threads=None):
+        """Initialises the hub
+
+        Each client holds a request thread while connected, so at most half
+        the threads serving requests are given to clients, leaving the rest
+        for uploads and page loads.
+
+        :param streams: streams whose points can be subscribed to
+        :param request_threads: number of threads serving requests in this
+        process, if known
+        """
+
+        self.db = db
+        self.config = config
+
+        self.max_clients = self.DEFAULT_MAX_CLIENTS
+        self.queue_size = self.DEFAULT_QUEUE_SIZE
+        self.keepalive = self.DEFAULT_KEEPALIVE
+        self.min_interval = self.DEFAULT_MIN_INTERVAL
+
+        if config.has_option('events', 'max_clients'):
+            self.max_clients = config.getint('events', 'max_clients')
+
+        if request_threads is not None \
+        and self.max_clients > request_threads // 2:
+            print >> sys.stderr, "Limiting event clients to {0}, half of the \
+{1} request threads".format(request_threads // 2, request_threads)
+
+            self.max_clients = request_threads // 2
+
+        if config.has_option('events', 'queue_size'):
+            self.queue_size = config.getint('events', 'queue_size')
+
+        if config.has_option('events', 'keepalive'):
+            self.keepalive = config.getfloat('events', 'keepalive')
+
+        if config.has_option('events', 'min_interval'):
+            self.min_interval = config.getfloat('events', 'min_interval')
+
+        self.poll_interval = self.DEFAULT_POLL_INTERVAL
+
+        if config.has_option('events', 'poll_interval'):
+            self.poll_interval = config.getfloat('events', 'poll_interval')
+
+        # streams by id, and stream ids by channel
+        self.streams = {}
+        self.channel_streams = {}
+
+        for stream in streams:
+            self.streams[stream.get_id()] = stream
+            self.channel_streams.setdefault(stream.channel.channel_num, \
+            []).append(stream.get_id())
+
+        # time of each stream's last published point [ms]
+        self._last_timestamps = {}
+
+        self._subscriptions = []
+        self._dirty = set()
+        self._condition = threading.Condition()
+
+        # statistics
+        self.event_count = 0
+        self.dropped_count = 0
+        self.error_count = 0
+
+    def start(self, watch_interval=None):
+        """Starts the publisher thread
+
+        Streams are published from their latest point at this time.
+
+        :param watch_interval: if specified, the interval between checks for
+        samples written by other processes [ms]; otherwise the hub must be
+        notified of writes
+        """
+
+        threads = [threading.Thread(target=self._work, name="events")]
+
+        if watch_interval is not None:
+            threads.append(threading.Thread(target=models.ChannelState.watch, \
+            args=(self.db, watch_interval, self.notify), name="events-watch"))
+
+        for thread in threads:
+            # don't keep the process alive for the thread
+            thread.daemon = True
+            thread.start()
+
+    def _init_last_timestamps(self):
+        """Sets the time of each stream's latest point
+
+        Streams whose tables can't be read yet are left to be set when they
+        are first published.
+        """
+
+        for stream_id, stream in self.streams.iteritems():
+            try:
+                self._last_timestamps[stream_id] = \
+                self._get_last_timestamp(stream)
+            except Exception, e:
+                print >> sys.stderr, \
+                "Error reading stream {0}: {1}".format(stream_id, e)
+
+    def _get_last_timestamp(self, stream):
+        """Returns the time of a stream's latest point [ms], or -1"""
+
+        if stream.stream_type == "raw":
+            state = models.ChannelState.get(self.db, stream.channel.channel_num)
+
+            if state is None:
+                return -1
+
+            return state.last_timestamp
+
+        last_timestamp = stream.get_last_timestamp()
+
+        if last_timestamp is None:
+            return -1
+
+        return last_timestamp
+
+    def notify(self, channel_nums):
+        """Marks the streams of channels with new samples as dirty
+
+        Trends are included, so their new points are found even when they
+        are updated by another process.
+
+        :param channel_nums: iterable of channel numbers
+        """
+
+        stream_ids = []
+
+        for channel_num in channel_nums:
+            stream_ids.extend(self.channel_streams.get(channel_num, []))
+
+        self.notify_streams(stream_ids)
+
+    def notify_streams(self, stream_ids):
+        """Marks streams as having new points
+
+        :param stream_ids: iterable of stream ids
+        """
+
+        with self._condition:
+            self._dirty.update(stream_ids)
+            self._condition.notify()
+
+    def subscribe(self, stream_ids):
+        """Returns a new subscription to streams' points
+
+        :param stream_ids: ids of the streams
+        :return: subscription, or None if the maximum number of clients are
+        connected
+        """
+
+        with self._condition:
+            if len(self._subscriptions) >= self.max_clients:
+                return None
+
+            subscription = Subscription(stream_ids, self.queue_size)
+
+            self._subscriptions.append(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Removes a subscription"""
+
+        subscription.close()
+
+        with self._condition:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def _work(self):
+        self._init_last_timestamps()
+
+        while True:
+            with self._condition:
+                while len(self._dirty) == 0:
+                    self._condition.wait()
+
+                stream_ids = self._dirty
+                self._dirty = set()
+
+                subscriptions = list(self._subscriptions)
+
+            for stream_id in stream_ids:
+                # nothing is read for streams nobody is watching
+                stream_subscriptions = [subscription for subscription \
+                in subscriptions if stream_id in subscription.stream_ids]
+
+                try:
+                    self._publish(self.streams[stream_id], \
+                    stream_subscriptions)
+                except Exception, e:
+                    print >> sys.stderr, \
+                    "Error publishing stream {0}: {1}".format(stream_id, e)
+
+                    self.error_count += 1
+
+            # let more samples arrive before reading again
+            time.sleep(self.min_interval / 1000)
+
+    def _publish(self, stream, subscriptions):
+        """Reads a stream's new points and queues them for its subscribers"""
+
+        stream_id = stream.get_id()
+
+        if len(subscriptions) == 0 \
+        or self._last_timestamps.get(stream_id) is None:
+            # start from the latest point when a client subscribes
+            self._last_timestamps[stream_id] = self._get_last_timestamp(stream)
+
+            return
+
+        timestamps, values = stream.get_time_series_arrays( \
+        since=self._last_timestamps[stream_id] + 1)
+
+        # at most a plot's worth of points, however many arrived
+        timestamps, values = stream._downsample_arrays(timestamps, values, \
+        stream.get_default_max_points())
+
+        if len(timestamps) == 0:
+            return
+
+        self._last_timestamps[stream_id] = int(timestamps[-1])
+
+        event = format_event("points", '{{"stream": "{0}", "data": {1}}}' \
+        .format(stream_id, utils.arrays_to_js(timestamps, values)))
+
+        for subscription in subscriptions:
+            if not subscription.put(event):
+                self.unsubscribe(subscription)
+                self.dropped_count += 1
+
+        self.event_count += 1
+
+    def iter_events(self, subscription):
+        """Yields a subscription's events as a Server-Sent Events stream
+
+        Comments are sent while no events arrive, so idle connections are
+        kept open and closed connections are noticed. The subscription is
+        removed when the client disconnects.
+        """
+
+        try:
+            # clients wait a few seconds before reconnecting
+            yield "retry: {0}\n\n".format(int(self.keepalive * 1000))
+
+            while not subscription.closed:
+                event = subscription.get(self.keepalive)
+
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield event
+        finally:
+            self.unsubscribe(subscription)
+
+    def get_stats(self):
+        """Returns the number of clients and of events published"""
+
+        return {"clients": len(self._subscriptions), \
+        "events": self.event_count, "dropped_clients": self.dropped_count, \
+        "errors": self.error_count}
+
+def format_event(event_type, data):
+    """Returns a Server-Sent Event
+
+    :param event_type: event name
+    :param data: event data, on a single line
+    """
+
+    return "event: {0}\ndata: {1}\n\n".format(event_type, data)
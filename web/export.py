@@ -0,0 +1,412 @@
+from __future__ import division
+
+import sys
+import os
+import struct
+import zipfile
+import tempfile
+import argparse
+import numpy as np
+
+import models
+
+"""Streamed export of samples and trends as CSV, .npy or .npz
+
+An export is a table with a timestamp column and a value column per source,
+either a set of channels, whose samples are aligned by time, or a single
+stream. Rows are produced a chunk at a time, so memory use doesn't depend on
+the length of the export: channels are read a time window at a time with
+ChannelSamples.read_matrix, and streams through their
+iter_time_series_arrays cursors.
+
+CSV leaves values missing at a time empty. A .npy file holds one record per
+row, with an int64 timestamp field and a float64 field per source, NaN where
+missing; as its header gives the number of rows, the rows are read twice,
+first to count them. A .npz archive holds a timestamps array and an array
+per source, each written to a temporary file first.
+
+Usage: python export.py [--channels 13,14] [--stream id] [--since ms]
+[--until ms] [--format csv|npy|npz] output [config] [channel config]
+[stream config]
+"""
+
+"""Export formats: content type and file extension"""
+FORMATS = {
+    "csv": ("text/csv", ".csv"),
+    "npy": ("application/octet-stream", ".npy"),
+    "npz": ("application/zip", ".npz")
+}
+
+"""Default time span of channel samples read at once [ms]"""
+DEFAULT_SPAN = 3600000
+
+"""Default number of stream points read at once"""
+DEFAULT_CHUNK_SIZE = 10000
+
+"""Multiple of which .npy headers are padded to [bytes]"""
+NPY_HEADER_ALIGNMENT = 64
+
+"""Length of the .npy magic string, version and header length [bytes]"""
+NPY_PREFIX_SIZE = 10
+
+"""Size of the pieces files are returned in [bytes]"""
+FILE_CHUNK_SIZE = 1048576
+
+def iter_channel_chunks(db, config, channel_nums, since, until, \
+span=DEFAULT_SPAN):
+    """Yields several channels' samples aligned by time, a window at a time
+
+    :param channel_nums: channels to export
+    :param since: earliest timestamp [ms]
+    :param until: latest timestamp [ms]
+    :param span: length of the time window read at once [ms]
+    :return: generator of (timestamps, values) arrays, with a column of
+    values per channel
+    """
+
+    start = int(since)
+
+    while start <= until:
+        end = min(until, start + span - 1)
+
+        timestamps, values = models.ChannelSamples.read_matrix(db, config, \
+        channel_nums, start, end)
+
+        if len(timestamps) > 0:
+            yield timestamps, values
+
+        start = end + 1
+
+def iter_stream_chunks(stream, since, until, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields a stream's time series, a chunk at a time
+
+    :param stream: raw or trend stream
+    :return: generator of (timestamps, values) arrays, with a single column
+    of values
+    """
+
+    for timestamps, values in stream.iter_time_series_arrays(since=since, \
+    until=until, chunk_size=chunk_size):
+        if len(timestamps) > 0:
+            yield timestamps, np.asarray(values, \
+            dtype=np.float64)[:, np.newaxis]
+
+def get_channel_range(db, config, channel_nums):
+    """Returns the times of the first and last samples of the channels [ms]
+
+    :return: (first, last), or None if the channels have no samples
+    """
+
+    states = models.ChannelState.get_all(db)
+
+    last_timestamps = [states[channel_num].last_timestamp \
+    for channel_num in channel_nums if channel_num in states]
+
+    if len(last_timestamps) == 0:
+        return None
+
+    first_timestamps = []
+
+    for channel_num in channel_nums:
+        timestamps, values = models.ChannelSamples.read_arrays(db, config, \
+        channel_num, limit=1)
+
+        first_timestamps.extend(timestamps.tolist())
+
+    return min(first_timestamps), max(last_timestamps)
+
+def get_channel_chunks(db, config, channel_nums, since=None, until=None):
+    """Returns a function yielding an export of channels' samples
+
+    The time range is limited to that of the channels' samples.
+
+    :param since: earliest timestamp [ms], or None
+    :param until: latest timestamp [ms], or None
+    :return: function returning a generator of (timestamps, values) arrays
+    """
+
+    span = DEFAULT_SPAN
+
+    if config.has_option('export', 'span'):
+        span = config.getint('export', 'span')
+
+    channel_range = get_channel_range(db, config, channel_nums)
+
+    if channel_range is None:
+        return lambda: iter([])
+
+    if since is None or since < channel_range[0]:
+        since = channel_range[0]
+
+    if until is None or until > channel_range[1]:
+        until = channel_range[1]
+
+    return lambda: iter_channel_chunks(db, config, channel_nums, since, \
+    until, span)
+
+def csv_chunks(columns, chunks):
+    """Yields an export as CSV text
+
+    :param columns: names of the value columns
+    :param chunks: iterable of (timestamps, values) arrays
+    """
+
+    yield ",".join(["timestamp"] + [str(column) for column in columns]) \
+    + "\n"
+
+    for timestamps, values in chunks:
+        missing = np.isnan(values)
+
+        # values are integers, or trend means
+        text = timestamps.astype(str)
+
+        for column in range(values.shape[1]):
+            column_values = values[:, column]
+
+            if np.all(np.mod(column_values[~missing[:, column]], 1) == 0):
+                column_text = np.where(missing[:, column], 0, \
+                column_values).astype(np.int64).astype(str)
+            else:
+                column_text = column_values.astype(str)
+
+            column_text = np.where(missing[:, column], "", column_text)
+
+            text = np.char.add(np.char.add(text, ","), column_text)
+
+        yield "\n".join(text.tolist()) + "\n"
+
+def get_record_dtype(columns):
+    """Returns the dtype of an exported row"""
+
+    return np.dtype([("timestamp", "<i8")] + [(str(column), "<f8") \
+    for column in columns])
+
+def _npy_dict(dtype, length):
+    """Returns the header dictionary of a one dimensional .npy array"""
+
+    return repr({"descr": np.lib.format.dtype_to_descr(dtype), \
+    "fortran_order": False, "shape": (length,)})
+
+def npy_header(dtype, length):
+    """Returns a version 1.0 .npy header for a one dimensional array
+
+    The header's size depends only on the dtype, so it can be written before
+    the length is known and replaced afterwards.
+
+    :param dtype: array dtype
+    :param length: number of elements
+    """
+
+    # room for any length, and the terminating newline
+    size = NPY_PREFIX_SIZE + len(_npy_dict(dtype, 2 ** 63 - 1)) + 1
+    size += -size % NPY_HEADER_ALIGNMENT
+
+    header = _npy_dict(dtype, length)
+
+    return "\x93NUMPY\x01\x00" + struct.pack("<H", size - NPY_PREFIX_SIZE) \
+    + header + " " * (size - NPY_PREFIX_SIZE - len(header) - 1) + "\n"
+
+def records(dtype, timestamps, values):
+    """Returns rows as the bytes of .npy records"""
+
+    rows = np.empty(len(timestamps), dtype=dtype)
+    rows["timestamp"] = timestamps
+
+    for column, name in enumerate(dtype.names[1:]):
+        rows[name] = values[:, column]
+
+    return rows.tostring()
+
+def npy_chunks(columns, get_chunks):
+    """Yields an export as a .npy file of records
+
+    :param columns: names of the value columns
+    :param get_chunks: function returning an iterable of (timestamps,
+    values) arrays, called twice
+    """
+
+    # count the rows for the header
+    count = 0
+
+    for timestamps, values in get_chunks():
+        count += len(timestamps)
+
+    dtype = get_record_dtype(columns)
+
+    yield npy_header(dtype, count)
+
+    written = 0
+
+    for timestamps, values in get_chunks():
+        # samples written since counting don't fit
+        timestamps = timestamps[:count - written]
+
+        if len(timestamps) == 0:
+            break
+
+        yield records(dtype, timestamps, values[:len(timestamps)])
+
+        written += len(timestamps)
+
+    if written < count:
+        raise Exception("Export ended {0} rows short".format(count - written))
+
+def write_npz(path, columns, chunks):
+    """Writes an export to a compressed .npz file
+
+    The archive holds a timestamps array and an array per value column, each
+    first written to its own temporary .npy file.
+
+    :param columns: names of the value columns
+    :param chunks: iterable of (timestamps, values) arrays
+    :return: number of rows written
+    """
+
+    names = ["timestamps"] + [str(column) for column in columns]
+    dtypes = [np.dtype("<i8")] + [np.dtype("<f8")] * len(columns)
+
+    array_files = [tempfile.TemporaryFile() for name in names]
+
+    try:
+        for array_file, dtype in zip(array_files, dtypes):
+            array_file.write(npy_header(dtype, 0))
+
+        count = 0
+
+        for timestamps, values in chunks:
+            array_files[0].write(timestamps.astype("<i8").tostring())
+
+            for column, array_file in enumerate(array_files[1:]):
+                array_file.write(values[:, column].astype("<f8").tostring())
+
+            count += len(timestamps)
+
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, \
+        allowZip64=True) as archive_file:
+            for name, array_file, dtype in zip(names, array_files, dtypes):
+                # now the length is known
+                array_file.seek(0)
+                array_file.write(npy_header(dtype, count))
+                array_file.seek(0)
+
+                _write_zip_entry(archive_file, name + ".npy", array_file)
+    finally:
+        for array_file in array_files:
+            array_file.close()
+
+    return count
+
+def _write_zip_entry(archive_file, name, source_file):
+    """Adds an open file's contents to a zip archive
+
+    zipfile only copies files by name, so the file is copied to a named
+    temporary file first.
+    """
+
+    fd, path = tempfile.mkstemp(suffix=".npy")
+
+    try:
+        with os.fdopen(fd, "wb") as named_file:
+            while True:
+                data = source_file.read(FILE_CHUNK_SIZE)
+
+                if len(data) == 0:
+                    break
+
+                named_file.write(data)
+
+        archive_file.write(path, name)
+    finally:
+        os.remove(path)
+
+def npz_chunks(columns, chunks):
+    """Yields an export as a .npz archive, built in a temporary file"""
+
+    fd, path = tempfile.mkstemp(suffix=".npz")
+    os.close(fd)
+
+    try:
+        write_npz(path, columns, chunks)
+
+        with open(path, "rb") as archive_file:
+            while True:
+                data = archive_file.read(FILE_CHUNK_SIZE)
+
+                if len(data) == 0:
+                    break
+
+                yield data
+    finally:
+        os.remove(path)
+
+def export_chunks(export_format, columns, get_chunks):
+    """Yields an export in the specified format
+
+    :param export_format: csv, npy or npz
+    :param columns: names of the value columns
+    :param get_chunks: function returning an iterable of (timestamps, values)
+    arrays; it may be called more than once
+    :raises ValueError: if the format is not recognised
+    """
+
+    if export_format == "csv":
+        return csv_chunks(columns, get_chunks())
+    elif export_format == "npy":
+        return npy_chunks(columns, get_chunks)
+    elif export_format == "npz":
+        return npz_chunks(columns, get_chunks())
+
+    raise ValueError("Unrecognised export format {0}".format(export_format))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports samples or a \
+stream's time series")
+    parser.add_argument("--channels", help="comma separated channels (default \
+every channel)")
+    parser.add_argument("--stream", help="stream id, instead of channels")
+    parser.add_argument("--since", type=int, help="earliest timestamp, in ms")
+    parser.add_argument("--until", type=int, help="latest timestamp, in ms \
+(default the latest sample)")
+    parser.add_argument("--format", choices=sorted(FORMATS.keys()), \
+    help="export format (default from the output file extension)")
+    parser.add_argument("output", help="output file")
+    parser.add_argument("configs", nargs="*", help="config, channel config and \
+stream config files")
+
+    args = parser.parse_args()
+
+    # leave only the config paths for the settings
+    sys.argv = sys.argv[:1] + args.configs
+
+    from config import init_settings_from_argv
+
+    config, db, server_key, channels, streams = init_settings_from_argv()
+
+    export_format = args.format
+
+    if export_format is None:
+        export_format = os.path.splitext(args.output)[1].lstrip(".") or "csv"
+
+    if args.stream is not None:
+        stream = [stream for stream in streams \
+        if stream.get_id() == args.stream]
+
+        if len(stream) == 0:
+            sys.exit("Unknown stream {0}".format(args.stream))
+
+        columns = [args.stream]
+        get_chunks = lambda: iter_stream_chunks(stream[0], args.since, \
+        args.until)
+    else:
+        if args.channels is None:
+            columns = [channel.channel_num for channel in channels]
+        else:
+            columns = [int(channel_num) for channel_num \
+            in args.channels.split(",")]
+
+        get_chunks = get_channel_chunks(db, config, columns, args.since, \
+        args.until)
+
+    with open(args.output, "wb") as output_file:
+        for data in export_chunks(export_format, columns, get_chunks):
+            output_file.write(data)
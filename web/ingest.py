@@ -0,0 +1,187 @@
+import sys
+import time
+import threading
+import Queue
+
+from models import ChannelSamples
+
+"""Queued ingest with a single writer thread
+
+Request threads check channel access and put their samples on a queue. One
+writer thread takes everything queued within a short interval, up to a
+sample limit, and commits it in a single transaction. Each request waits on
+a future until its samples are committed. With one writer, uploads no longer
+contend for the SQLite write lock, and throughput grows with the batch size
+rather than being limited by one commit per request.
+"""
+
+class IngestFuture(object):
+    """The pending result of a queued write"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        """Sets the result and wakes waiting threads"""
+
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        """Sets the failure and wakes waiting threads"""
+
+        self._exception = exception
+        self._event.set()
+
+    def wait(self, timeout=None):
+        """Waits for the write to be committed
+
+        :param timeout: maximum time to wait [s], or None to wait indefinitely
+        :return: number of samples inserted
+        :raises Exception: if the write failed or timed out
+        """
+
+        if not self._event.wait(timeout):
+            raise Exception("Timed out waiting for samples to be written")
+
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+class IngestWriter(threading.Thread):
+    """Writer thread committing queued samples in batches"""
+
+    """Default time to gather a batch [ms]"""
+    DEFAULT_BATCH_INTERVAL = 50
+
+    """Default maximum number of samples per batch"""
+    DEFAULT_BATCH_SAMPLES = 50000
+
+    def __init__(self, db, config):
+        """Initialises the writer
+
+        The writer uses the database's connection for its own thread, so it
+        doesn't share a connection with request threads.
+        """
+
+        super(IngestWriter, self).__init__(name="ingest-writer")
+
+        # don't keep the process alive for the writer
+        self.daemon = True
+
+        self.db = db
+        self.config = config
+
+        self.batch_interval = self.DEFAULT_BATCH_INTERVAL
+        self.batch_samples = self.DEFAULT_BATCH_SAMPLES
+
+        if config.has_option('ingest', 'batch_interval'):
+            self.batch_interval = config.getfloat('ingest', 'batch_interval')
+
+        if config.has_option('ingest', 'batch_samples'):
+            self.batch_samples = config.getint('ingest', 'batch_samples')
+
+        # queue of (rows, future)
+        self.queue = Queue.Queue()
+
+        # statistics
+        self.batch_count = 0
+        self.sample_count = 0
+
+    def submit(self, key, readings):
+        """Queues readings to be written
+
+        Channel access is checked before the readings are queued.
+
+        :return: future resolving to the number of samples inserted
+        :raises Exception: if a sample's channel cannot be written to
+        """
+
+        return self.submit_rows(ChannelSamples.collect_rows(key, readings))
+
+    def submit_rows(self, rows):
+        """Queues sample rows to be written
+
+        Channel access must already have been checked.
+
+        :param rows: rows as accepted by ChannelSamples.write_rows
+        :return: future resolving to the number of samples inserted
+        """
+
+        future = IngestFuture()
+
+        self.queue.put((rows, future))
+
+        return future
+
+    def run(self):
+        while True:
+            self._write(self._get_batch())
+
+    def _get_batch(self):
+        """Waits for queued rows, then gathers more for up to the interval"""
+
+        batch = [self.queue.get()]
+        sample_count = len(batch[0][0])
+
+        deadline = time.time() + self.batch_interval / 1000.0
+
+        while sample_count < self.batch_samples:
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                break
+
+            try:
+                item = self.queue.get(timeout=remaining)
+            except Queue.Empty:
+                break
+
+            batch.append(item)
+            sample_count += len(item[0])
+
+        return batch
+
+    def _write(self, batch):
+        """Writes a batch in one transaction, resolving its futures
+
+        Only a failed transaction fails the batch: errors once it is
+        committed are logged, as the samples are stored.
+        """
+
+        row_sets = [rows for rows, future in batch]
+
+        try:
+            insert_counts, changes = ChannelSamples.commit_rows(self.db, \
+            self.config, row_sets)
+        except Exception, e:
+            if len(batch) > 1:
+                # write separately so only the failing request fails
+                for item in batch:
+                    self._write([item])
+            else:
+                batch[0][1].set_exception(e)
+
+            return
+
+        try:
+            ChannelSamples.after_commit(row_sets, changes)
+        except Exception, e:
+            print >> sys.stderr, \
+            "Error updating caches after writing samples: {0}".format(e)
+
+        self.batch_count += 1
+
+        for (rows, future), insert_count in zip(batch, insert_counts):
+            self.sample_count += insert_count
+
+            future.set_result(insert_count)
+
+    def get_stats(self):
+        """Returns the queue depth and the number of batches and samples"""
+
+        return {"queue_depth": self.queue.qsize(), \
+        "batches": self.batch_count, "samples": self.sample_count}
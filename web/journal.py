@@ -0,0 +1,588 @@
+from __future__ import division
+
+import sys
+import os
+import re
+import time
+import zlib
+import fcntl
+import struct
+import sqlite3
+import threading
+import numpy as np
+
+from models import ChannelSamples
+import wire
+
+"""Crash-safe journal of uploads, loaded into the database in the background
+
+Uploads are appended to the current segment file of an append-only journal
+and acknowledged once synced to disk, without waiting for the database.
+Request threads only write; a sync thread calls fsync once for everything
+appended within the sync interval, so each sync acknowledges many uploads.
+A loader thread reads the synced records and writes them to the samples
+table in large transactions, deleting segments once they are written.
+
+Segments left over from a previous run are loaded again when the journal
+starts. Samples already written before a crash are ignored by the samples
+table's primary key, so loading a record twice is harmless. A record
+partially written when the process stopped was never acknowledged, and is
+skipped along with the rest of its segment. A record the database refuses,
+e.g. for a channel removed since, is moved to the directory's rejected
+segment and logged, so it doesn't stop the loader.
+
+Each process has a journal of its own in a numbered directory under the
+journal path, locked while in use, so worker processes don't load each
+other's segments; a directory whose process stopped is taken over, and its
+segments loaded, by the next process to start.
+
+Records are a header (payload length, CRC-32 of the payload) followed by the
+samples in the binary upload format (see wire).
+"""
+
+"""Record header: payload length, CRC-32 of the payload"""
+RECORD_HEADER_FORMAT = "<II"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+
+"""Segment file names, numbered in order of creation"""
+SEGMENT_NAME = "{0:012d}.seg"
+SEGMENT_PATTERN = re.compile(r"^(\d{12})\.seg$")
+
+"""Lock file held by the process using a journal directory"""
+LOCK_NAME = "lock"
+
+"""Segment of records the database refused, in the same format"""
+REJECTED_NAME = "rejected.seg"
+
+class JournalFull(Exception):
+    """Raised when too much of the journal is waiting to be loaded"""
+    pass
+
+def encode_record(rows):
+    """Returns sample rows as a journal record
+
+    :param rows: list of (channel, timestamp, value) tuples, or an integer
+    array with a (channel, timestamp, value) row per sample
+    :raises ValueError: if a channel or value doesn't fit the upload format
+    """
+
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+
+    payload = wire.encode(rows[:, 0], rows[:, 1], rows[:, 2])
+
+    return struct.pack(RECORD_HEADER_FORMAT, len(payload), \
+    zlib.crc32(payload) & 0xffffffff) + payload
+
+def set_close_on_exec(fd):
+    """Closes a descriptor when this process execs another program, so the
+    program doesn't hold the journal's files or lock"""
+
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) \
+    | fcntl.FD_CLOEXEC)
+
+def read_records(path, offset=0, end=None):
+    """Reads a segment's records
+
+    Reading stops at the first incomplete or corrupt record, as left by a
+    write interrupted by a crash.
+
+    :param offset: position of the first record to read
+    :param end: position to read up to, or None for the end of the file
+    :return: (list of ((channels, timestamps, values) arrays, position after
+    the record), whether an incomplete or corrupt record was found)
+    """
+
+    with open(path, "rb") as segment:
+        segment.seek(offset)
+
+        if end is None:
+            data = segment.read()
+        else:
+            data = segment.read(end - offset)
+
+    records = []
+    position = 0
+
+    while position < len(data):
+        if position + RECORD_HEADER_SIZE > len(data):
+            return records, True
+
+        length, checksum = struct.unpack(RECORD_HEADER_FORMAT, \
+        data[position:position + RECORD_HEADER_SIZE])
+
+        start = position + RECORD_HEADER_SIZE
+        payload = data[start:start + length]
+
+        if len(payload) < length \
+        or zlib.crc32(payload) & 0xffffffff != checksum:
+            return records, True
+
+        try:
+            arrays = wire.decode(payload)
+        except ValueError:
+            return records, True
+
+        position = start + length
+
+        records.append((arrays, offset + position))
+
+    return records, False
+
+class IngestJournal(object):
+    """Journal of uploads with a sync thread and a loader thread"""
+
+    """Default directory holding the journals"""
+    DEFAULT_PATH = "journal"
+
+    """Default time appends are gathered into one sync [ms]"""
+    DEFAULT_SYNC_INTERVAL = 10
+
+    """Default size after which a new segment is started [bytes]"""
+    DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+    """Default maximum size of the journal waiting to be loaded, beyond which
+    uploads are refused [bytes]"""
+    DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+    """Default time the loader gathers records into one transaction [ms]"""
+    DEFAULT_BATCH_INTERVAL = 50
+
+    """Default maximum number of samples per transaction"""
+    DEFAULT_BATCH_SAMPLES = 50000
+
+    """Time to wait before loading again after a failed transaction [s]"""
+    RETRY_DELAY = 5
+
+    def __init__(self, db, config):
+        """Initialises the journal
+
+        The loader uses the database's connection for its own thread, so it
+        doesn't share a connection with request threads.
+        """
+
+        self.db = db
+        self.config = config
+
+        self.path = self.DEFAULT_PATH
+        self.sync_interval = self.DEFAULT_SYNC_INTERVAL
+        self.segment_size = self.DEFAULT_SEGMENT_SIZE
+        self.max_size = self.DEFAULT_MAX_SIZE
+        self.batch_interval = self.DEFAULT_BATCH_INTERVAL
+        self.batch_samples = self.DEFAULT_BATCH_SAMPLES
+
+        if config.has_option('ingest', 'journal_path'):
+            self.path = config.get('ingest', 'journal_path')
+
+        if config.has_option('ingest', 'sync_interval'):
+            self.sync_interval = config.getfloat('ingest', 'sync_interval')
+
+        if config.has_option('ingest', 'segment_size'):
+            self.segment_size = config.getint('ingest', 'segment_size')
+
+        if config.has_option('ingest', 'journal_max_size'):
+            self.max_size = config.getint('ingest', 'journal_max_size')
+
+        if config.has_option('ingest', 'batch_interval'):
+            self.batch_interval = config.getfloat('ingest', 'batch_interval')
+
+        if config.has_option('ingest', 'batch_samples'):
+            self.batch_samples = config.getint('ingest', 'batch_samples')
+
+        # this process's directory, and the lock file holding it
+        self.directory = None
+        self._lock_file = None
+
+        # numbers of the segments waiting to be loaded, oldest first, the
+        # last being the one appended to
+        self._segments = []
+
+        # descriptor and size of the current segment
+        self._fd = None
+        self._size = 0
+
+        # bytes appended and synced in total, and the synced size of each
+        # segment
+        self._appended = 0
+        self._synced = 0
+        self._synced_sizes = {}
+
+        # segment and position the loader has reached, and the bytes loaded
+        # in total
+        self._load_segment = None
+        self._load_offset = 0
+        self._loaded = 0
+
+        # guards the current segment and the counters above
+        self._condition = threading.Condition()
+
+        # statistics
+        self.record_count = 0
+        self.sync_count = 0
+        self.batch_count = 0
+        self.sample_count = 0
+        self.corrupt_count = 0
+        self.rejected_count = 0
+        self.error_count = 0
+
+    def start(self):
+        """Opens this process's journal, then starts the sync and loader
+        threads
+
+        Segments left by a previous run are loaded first, before new
+        records.
+        """
+
+        self._open_directory()
+
+        self._segments = self._find_segments()
+
+        # earlier segments count as synced, so they are loaded and reported
+        for number in self._segments:
+            size = os.path.getsize(self._get_segment_path(number))
+
+            self._synced_sizes[number] = size
+            self._appended += size
+
+        self._synced = self._appended
+
+        if len(self._segments) > 0:
+            print >> sys.stderr, "Loading {0} journal segments from {1}" \
+            .format(len(self._segments), self.directory)
+
+        # append to a new segment, after any partial record of the last run
+        self._start_segment(self._segments[-1] + 1 \
+        if len(self._segments) > 0 else 0)
+
+        self._load_segment = self._segments[0]
+
+        for target, name in ((self._sync, "journal-sync"), \
+        (self._load, "journal-loader")):
+            thread = threading.Thread(target=target, name=name)
+
+            # don't keep the process alive for the thread
+            thread.daemon = True
+            thread.start()
+
+    def _open_directory(self):
+        """Takes the first journal directory not locked by another process"""
+
+        number = 0
+
+        while True:
+            directory = os.path.join(self.path, str(number))
+
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            lock_file = open(os.path.join(directory, LOCK_NAME), "a")
+            set_close_on_exec(lock_file.fileno())
+
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # used by another process
+                lock_file.close()
+                number += 1
+
+                continue
+
+            self.directory = directory
+            self._lock_file = lock_file
+
+            return
+
+    def _find_segments(self):
+        """Returns the numbers of the directory's segments, oldest first"""
+
+        numbers = []
+
+        for name in os.listdir(self.directory):
+            match = SEGMENT_PATTERN.match(name)
+
+            if match is not None:
+                numbers.append(int(match.group(1)))
+
+        return sorted(numbers)
+
+    def _get_segment_path(self, number):
+        return os.path.join(self.directory, SEGMENT_NAME.format(number))
+
+    def _start_segment(self, number):
+        """Creates a segment to append to, closing the current one once synced
+
+        Must be called with the condition held, or before the threads start.
+        """
+
+        fd = os.open(self._get_segment_path(number), \
+        os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        set_close_on_exec(fd)
+
+        # make the new file's entry durable
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+
+            self._synced_sizes[self._segments[-1]] = self._size
+
+        self._fd = fd
+        self._size = 0
+
+        self._segments.append(number)
+        self._synced_sizes[number] = 0
+
+    def append(self, rows, timeout=None):
+        """Appends sample rows to the journal, returning once they are synced
+
+        Channel access must already have been checked.
+
+        :param rows: rows as accepted by ChannelSamples.write_rows
+        :param timeout: maximum time to wait for the sync [s], or None to wait
+        indefinitely
+        :return: number of samples journalled
+        :raises ValueError: if a channel or value doesn't fit the record format
+        :raises JournalFull: if too much of the journal is waiting to be loaded
+        :raises Exception: if the sync timed out
+        """
+
+        record = encode_record(rows)
+
+        with self._condition:
+            if self._appended - self._loaded > self.max_size:
+                raise JournalFull("Journal full: samples are not being \
+written to the database")
+
+            # appends to regular files are written whole
+            os.write(self._fd, record)
+
+            self._size += len(record)
+            self._appended += len(record)
+            self.record_count += 1
+
+            end = self._appended
+
+            self._condition.notify_all()
+
+            if timeout is not None:
+                deadline = time.time() + timeout
+
+            while self._synced < end:
+                if timeout is None:
+                    self._condition.wait()
+
+                    continue
+
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    raise Exception("Timed out waiting for the journal to be \
+synced")
+
+                self._condition.wait(remaining)
+
+        return len(rows)
+
+    def _sync(self):
+        while True:
+            with self._condition:
+                while self._synced == self._appended:
+                    self._condition.wait()
+
+            # let more records arrive before syncing
+            time.sleep(self.sync_interval / 1000)
+
+            try:
+                self._sync_segment()
+            except Exception, e:
+                # appends wait until a sync succeeds
+                print >> sys.stderr, "Error syncing journal: {0}".format(e)
+
+                self.error_count += 1
+
+                time.sleep(self.RETRY_DELAY)
+
+    def _sync_segment(self):
+        """Syncs the records appended so far, starting a new segment once the
+        current one is full"""
+
+        with self._condition:
+            fd = self._fd
+            number = self._segments[-1]
+            size = self._size
+            appended = self._appended
+
+        # appends continue while syncing; only this thread closes segments
+        os.fsync(fd)
+
+        with self._condition:
+            self._synced_sizes[number] = size
+
+            if self._size >= self.segment_size:
+                # records appended meanwhile are synced as the segment closes
+                appended = self._appended
+
+                self._start_segment(number + 1)
+
+            self._synced = appended
+            self.sync_count += 1
+
+            self._condition.notify_all()
+
+    def _load(self):
+        while True:
+            with self._condition:
+                while self._load_segment == self._segments[-1] \
+                and self._synced_sizes[self._load_segment] \
+                <= self._load_offset:
+                    self._condition.wait()
+
+            # let more records be synced before writing
+            time.sleep(self.batch_interval / 1000)
+
+            try:
+                self._load_batch()
+            except Exception, e:
+                print >> sys.stderr, "Error loading journal: {0}".format(e)
+
+                self.error_count += 1
+
+                time.sleep(self.RETRY_DELAY)
+
+    def _load_batch(self):
+        """Writes the next synced records in one transaction, then deletes
+        the segments written up to their end"""
+
+        with self._condition:
+            segments = [number for number in self._segments \
+            if number >= self._load_segment]
+            synced_sizes = dict(self._synced_sizes)
+
+        rows = []
+        sample_count = 0
+
+        # segment and position after the records read
+        number = self._load_segment
+        offset = self._load_offset
+
+        for number in segments:
+            if number != self._load_segment:
+                offset = 0
+
+            records, corrupt = read_records(self._get_segment_path(number), \
+            offset, synced_sizes[number])
+
+            for (channels, timestamps, values), end in records:
+                if sample_count >= self.batch_samples:
+                    break
+
+                rows.append(np.column_stack((channels.astype(np.int64), \
+                timestamps, values.astype(np.int64))))
+
+                sample_count += len(timestamps)
+                offset = end
+            else:
+                if corrupt:
+                    print >> sys.stderr, "Skipping corrupt end of journal \
+segment {0}".format(self._get_segment_path(number))
+
+                    self.corrupt_count += 1
+
+                # read up to its synced size; the current segment is read
+                # again once more is synced
+                offset = synced_sizes[number]
+
+                if number != segments[-1]:
+                    continue
+
+            break
+
+        if len(rows) > 0:
+            self._write(rows)
+
+        with self._condition:
+            for finished in [finished for finished in self._segments \
+            if finished < number]:
+                os.remove(self._get_segment_path(finished))
+
+                self._loaded += self._synced_sizes.pop(finished) \
+                - self._load_offset
+                self._load_offset = 0
+
+                self._segments.remove(finished)
+
+            self._loaded += offset - self._load_offset
+
+            self._load_segment = number
+            self._load_offset = offset
+
+    def _write(self, rows):
+        """Writes records' rows in one transaction
+
+        If the transaction fails other than because the database can't be
+        written to at the moment, the records are written one by one, and
+        any failing alone is rejected.
+
+        :param rows: list of each record's rows
+        :raises sqlite3.OperationalError: if the database is locked, or
+        otherwise can't be written to; the records are loaded again later
+        """
+
+        try:
+            insert_counts, changes = ChannelSamples.commit_rows(self.db, \
+            self.config, [np.concatenate(rows)])
+        except sqlite3.OperationalError:
+            raise
+        except Exception, e:
+            if len(rows) > 1:
+                for record_rows in rows:
+                    self._write([record_rows])
+            else:
+                self._reject(rows[0], e)
+
+            return
+
+        try:
+            ChannelSamples.after_commit([np.concatenate(rows)], changes)
+        except Exception, e:
+            print >> sys.stderr, \
+            "Error updating caches after loading samples: {0}".format(e)
+
+        self.sample_count += insert_counts[0]
+        self.batch_count += 1
+
+    def _reject(self, rows, e):
+        """Moves a record the database refused to the rejected segment
+
+        :param e: the database's error
+        """
+
+        path = os.path.join(self.directory, REJECTED_NAME)
+
+        print >> sys.stderr, "Moving journal record of {0} samples to {1}: \
+{2}".format(len(rows), path, e)
+
+        with open(path, "ab") as rejected:
+            rejected.write(encode_record(rows))
+            rejected.flush()
+
+            os.fsync(rejected.fileno())
+
+        self.rejected_count += 1
+
+    def get_stats(self):
+        """Returns the journal size waiting to be loaded, and the number of
+        records, syncs, batches and samples"""
+
+        return {"directory": self.directory, \
+        "segments": len(self._segments), \
+        "pending_bytes": self._appended - self._loaded, \
+        "records": self.record_count, "syncs": self.sync_count, \
+        "batches": self.batch_count, "samples": self.sample_count, \
+        "corrupt_segments": self.corrupt_count, \
+        "rejected_records": self.rejected_count, "errors": self.error_count}
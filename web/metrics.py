@@ -0,0 +1,391 @@
+import re
+import sys
+import time
+import threading
+
+from collections import deque
+
+"""Process metrics in the Prometheus text format
+
+Counters and histograms are kept in memory for the life of the process and
+rendered by render() for the /<key>/metrics route. Database statements are
+timed by fingerprint: the statement with its whitespace collapsed and its
+literals replaced by ?, so the same query with different values is one series.
+Statements slower than the configured threshold are also printed with their
+EXPLAIN QUERY PLAN and kept in a short log.
+"""
+
+"""Whether metrics are recorded"""
+enabled = True
+
+"""Statements taking longer than this are logged [s], or None"""
+slow_query_time = 0.1
+
+"""Default number of slow statements kept"""
+DEFAULT_SLOW_QUERY_LOG = 50
+
+"""Recent slow statements, newest last"""
+slow_queries = deque(maxlen=DEFAULT_SLOW_QUERY_LOG)
+
+"""Histogram buckets for database statements [s]"""
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+"""Histogram buckets for requests and rendering [s]"""
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value):
+    """Escapes a label value"""
+
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+    .replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    """Formats label names and values as {name="value",...}"""
+
+    pairs = ['{0}="{1}"'.format(name, _escape(value)) \
+    for name, value in zip(names, values)]
+
+    if extra is not None:
+        pairs.append(extra)
+
+    if len(pairs) == 0:
+        return ""
+
+    return "{" + ",".join(pairs) + "}"
+
+class Metric(object):
+    """A named set of series, one per combination of label values"""
+
+    """Prometheus metric type"""
+    TYPE = None
+
+    def __init__(self, name, help_text, label_names=()):
+        """Initialises the metric
+
+        :param name: metric name
+        :param help_text: description
+        :param label_names: names of the labels distinguishing series
+        """
+
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+
+        # series by label values
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        """Returns the metric in the Prometheus text format"""
+
+        lines = ["# HELP {0} {1}".format(self.name, self.help_text), \
+        "# TYPE {0} {1}".format(self.name, self.TYPE)]
+
+        with self._lock:
+            series = sorted(self._series.items())
+
+        for label_values, value in series:
+            lines.extend(self._render_series(label_values, value))
+
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, *label_values):
+        """Adds to the count of the series with the specified labels"""
+
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) \
+            + amount
+
+    def get(self, *label_values):
+        """Returns the count of the series with the specified labels"""
+
+        with self._lock:
+            return self._series.get(label_values, 0)
+
+    def _render_series(self, label_values, value):
+        return ["{0}{1} {2}".format(self.name, _format_labels( \
+        self.label_names, label_values), value)]
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    TYPE = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), \
+    buckets=REQUEST_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label_names)
+
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        """Records a value in the series with the specified labels"""
+
+        with self._lock:
+            series = self._series.get(label_values)
+
+            if series is None:
+                # bucket counts, then the sum and count
+                series = self._series[label_values] = \
+                [0] * len(self.buckets) + [0.0, 0]
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, *label_values):
+        """Returns a context manager observing the time spent in it"""
+
+        return _Timer(self, label_values)
+
+    def _render_series(self, label_values, series):
+        lines = []
+
+        for bound, count in zip(self.buckets, series):
+            lines.append("{0}_bucket{1} {2}".format(self.name, \
+            _format_labels(self.label_names, label_values, \
+            'le="{0}"'.format(bound)), count))
+
+        lines.append("{0}_bucket{1} {2}".format(self.name, \
+        _format_labels(self.label_names, label_values, 'le="+Inf"'), \
+        series[-1]))
+
+        labels = _format_labels(self.label_names, label_values)
+
+        lines.append("{0}_sum{1} {2!r}".format(self.name, labels, series[-2]))
+        lines.append("{0}_count{1} {2}".format(self.name, labels, series[-1]))
+
+        return lines
+
+class _Timer(object):
+    """Context manager observing elapsed time in a histogram"""
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start_time = time.time()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if enabled:
+            self.histogram.observe(time.time() - self.start_time, \
+            *self.label_values)
+
+###
+# metrics
+
+query_seconds = Histogram("magnetometer_db_query_seconds", \
+"Time executing database statements, by statement fingerprint", \
+["statement"], QUERY_BUCKETS)
+
+request_seconds = Histogram("magnetometer_http_request_duration_seconds", \
+"Time handling HTTP requests, by route and method", ["route", "method"])
+
+requests_total = Counter("magnetometer_http_requests_total", \
+"HTTP requests, by route, method and status", ["route", "method", "status"])
+
+render_seconds = Histogram("magnetometer_render_seconds", \
+"Time rendering templates and serializing series, by output", ["output"])
+
+samples_ingested = Counter("magnetometer_samples_ingested_total", \
+"Samples inserted into the database")
+
+rows_read = Counter("magnetometer_rows_read_total", \
+"Rows read from the database into arrays")
+
+trend_points = Counter("magnetometer_trend_points_total", \
+"Trend points computed and stored")
+
+"""Every metric, in rendering order"""
+METRICS = [request_seconds, requests_total, render_seconds, query_seconds, \
+samples_ingested, rows_read, trend_points]
+
+def configure(config):
+    """Applies the [metrics] settings"""
+
+    global enabled, slow_query_time, slow_queries
+
+    if config.has_option('metrics', 'enabled'):
+        enabled = config.getboolean('metrics', 'enabled')
+
+    if config.has_option('metrics', 'slow_query'):
+        slow_query_time = config.getfloat('metrics', 'slow_query') / 1000
+
+    if config.has_option('metrics', 'slow_query_log'):
+        slow_queries = deque(slow_queries, \
+        maxlen=config.getint('metrics', 'slow_query_log'))
+
+def render():
+    """Returns every metric in the Prometheus text format"""
+
+    return "\n".join([metric.render() for metric in METRICS]) + "\n"
+
+###
+# statements
+
+# string and number literals
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+
+# parameter markers
+_PARAMETER = re.compile(r"%s|\?")
+
+_WHITESPACE = re.compile(r"\s+")
+
+def fingerprint(sql):
+    """Returns the statement with its literals and parameters replaced by ?"""
+
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _PARAMETER.sub("?", sql)
+
+    return _WHITESPACE.sub(" ", sql).strip()
+
+def record_query(sql, duration, explain=None):
+    """Records the execution time of a statement
+
+    :param sql: statement, with parameter markers
+    :param duration: execution time [s]
+    :param explain: function returning the statement's query plan as a list
+    of strings, called if the statement was slow
+    """
+
+    statement = fingerprint(sql)
+
+    query_seconds.observe(duration, statement)
+
+    if slow_query_time is None or duration < slow_query_time:
+        return
+
+    plan = []
+
+    if explain is not None:
+        try:
+            plan = explain()
+        except Exception, e:
+            plan = ["(no plan: {0})".format(e)]
+
+    slow_queries.append({"time": int(time.time() * 1000), \
+    "duration_ms": duration * 1000, "statement": statement, "plan": plan})
+
+    print >> sys.stderr, "Slow query ({0:.1f} ms): {1}".format( \
+    duration * 1000, statement)
+
+    for line in plan:
+        print >> sys.stderr, "    " + line
+
+def get_slow_queries():
+    """Returns the recent slow statements, newest last"""
+
+    return list(slow_queries)
+
+###
+# requests
+
+def route_for(mapping, path):
+    """Returns the URL pattern of a web.py mapping matching a path
+
+    Patterns of sub-applications are joined to the prefix they are mounted
+    at.
+
+    :param mapping: web.py application mapping of (pattern, handler) pairs
+    :param path: request path
+    :return: pattern, or None if none match
+    """
+
+    for pattern, handler in mapping:
+        if hasattr(handler, "mapping"):
+            # sub-application, matched by prefix
+            if path.startswith(pattern):
+                route = route_for(handler.mapping, path[len(pattern):])
+
+                if route is not None:
+                    return pattern + route
+        elif re.match("^" + pattern + "$", path):
+            return pattern
+
+    return None
+
+def request_processor(app):
+    """Returns a web.py processor timing each request to an application
+
+    Requests are labelled with the URL pattern they matched, so paths with
+    keys or stream ids in them don't each get their own series.
+    """
+
+    import web
+
+    def processor(handle):
+        if not enabled:
+            return handle()
+
+        route = route_for(app.mapping, web.ctx.path) or "unmatched"
+        method = web.ctx.method
+
+        start_time = time.time()
+
+        def record():
+            request_seconds.observe(time.time() - start_time, route, method)
+            requests_total.inc(1, route, method, \
+            str(web.ctx.status).split(" ")[0])
+
+        try:
+            result = handle()
+        except:
+            record()
+
+            raise
+
+        if hasattr(result, "next"):
+            # streamed response: record once the body has been produced
+            return _record_after(result, record)
+
+        record()
+
+        return result
+
+    return processor
+
+def _record_after(iterator, record):
+    """Yields from an iterator, then calls record"""
+
+    try:
+        for item in iterator:
+            yield item
+    finally:
+        record()
+
+def timed_iter(iterator, histogram, *label_values):
+    """Yields from an iterator, observing the time spent producing items
+
+    Time spent by the consumer between items isn't counted.
+    """
+
+    total = 0.0
+
+    iterator = iter(iterator)
+
+    while True:
+        start_time = time.time()
+
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            total += time.time() - start_time
+
+        yield item
+
+    if enabled:
+        histogram.observe(total, *label_values)
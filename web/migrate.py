@@ -0,0 +1,142 @@
+import sys
+import os
+import models
+
+from config import get_config, get_database_pragmas
+from database import Database, SCHEMA_VERSION
+
+"""Upgrades a database to the current schema version
+
+Usage: python migrate.py [config]
+
+Version 1 samples and trend tables, with DATETIME(3) timestamps, a rowid and
+a separate (channel, timestamp) index, are rebuilt with integer ms timestamps
+as WITHOUT ROWID tables clustered on (channel, timestamp), and the summaries
+used to plot downsampled series are computed from them. The database is then
+switched to WAL journal mode and vacuumed.
+
+An interrupted migration can be resumed by running this again.
+"""
+
+"""Suffix of tables being rebuilt"""
+MIGRATING_SUFFIX = "_migrating"
+
+def get_sample_tables(db):
+    """Returns the names of the samples table and every trend table"""
+
+    rows = db.query("""
+        SELECT name
+        FROM sqlite_master
+        WHERE type = 'table' AND (name = $samples OR name LIKE $trends)
+    """, {"samples": models.ChannelSamples.TABLE_NAME, \
+    "trends": models.ChannelSamples.TABLE_NAME + "_trend_%"})
+
+    return [row.name for row in rows \
+    if not row.name.endswith(MIGRATING_SUFFIX)]
+
+def table_exists(db, table_name):
+    """Checks if the specified table exists"""
+
+    return db.select_single_cell("sqlite_master", {"name": table_name}, \
+    what="name", where="type = 'table' AND name = $name") is not None
+
+def migrate_sample_table(db, table_name):
+    """Rebuilds a samples or trend table in the current layout
+
+    :param table_name: table to rebuild
+    """
+
+    new_table_name = table_name + MIGRATING_SUFFIX
+
+    # discard the remains of an interrupted copy
+    if table_exists(db, new_table_name):
+        db.query("DROP TABLE {0}".format(new_table_name))
+
+    models.ChannelSamples.create_table(db, new_table_name)
+
+    # copy rows in clustered order, rounding timestamps to integer ms
+    with db.transaction():
+        db.query("""
+            INSERT INTO {0} (channel, timestamp, value)
+            SELECT channel, CAST(ROUND(timestamp) AS INTEGER), value
+            FROM {1}
+            ORDER BY channel, timestamp
+        """.format(new_table_name, table_name))
+
+    # replace the old table
+    db.query("DROP TABLE {0}".format(table_name))
+    db.query("ALTER TABLE {0} RENAME TO {1}".format(new_table_name, table_name))
+
+def finish_interrupted_migrations(db):
+    """Renames rebuilt tables whose original was dropped before renaming"""
+
+    rows = db.query("""
+        SELECT name
+        FROM sqlite_master
+        WHERE type = 'table' AND name LIKE $pattern
+    """, {"pattern": "%" + MIGRATING_SUFFIX})
+
+    for row in rows.list():
+        table_name = row.name[:-len(MIGRATING_SUFFIX)]
+
+        if not table_exists(db, table_name):
+            db.query("ALTER TABLE {0} RENAME TO {1}".format(row.name, \
+            table_name))
+
+def rebuild_rollups(db, config):
+    """Computes the summaries of every channel with samples"""
+
+    # samples are read from the blocks too
+    models.ChannelBlocks.init_schema(db)
+    models.ChannelRollups.init_schema(db)
+
+    rows = db.query("""
+        SELECT DISTINCT channel
+        FROM {0}
+    """.format(models.ChannelSamples.TABLE_NAME))
+
+    for row in rows.list():
+        print "Summarising channel {0}".format(row.channel)
+
+        models.ChannelRollups(row.channel, db, config).rebuild()
+
+def migrate(db, config):
+    """Upgrades the database to the current schema version"""
+
+    version = db.get_schema_version()
+
+    if version >= SCHEMA_VERSION:
+        print "Database is already at schema version {0}".format(version)
+
+        return
+
+    finish_interrupted_migrations(db)
+
+    for table_name in get_sample_tables(db):
+        print "Migrating {0}".format(table_name)
+
+        migrate_sample_table(db, table_name)
+
+    # older databases have no summaries
+    rebuild_rollups(db, config)
+
+    db.set_schema_version(SCHEMA_VERSION)
+
+    # reclaim the space used by the old tables
+    print "Vacuuming"
+
+    db.query("VACUUM")
+
+    print "Database upgraded to schema version {0}".format(SCHEMA_VERSION)
+
+if __name__ == "__main__":
+    # path to config file, if specified
+    config_path = None
+
+    if len(sys.argv) > 1:
+        config_path = sys.argv[1]
+
+    config = get_config(config_path, "config" + os.path.sep + "config.default")
+
+    migrate(Database(config.get('database', 'path'), \
+    pragmas=get_database_pragmas(config)), config)
@@ -1,594 +1,2525 @@
-from __future__ import division
-
-import web.db
-import datetime
-
-from picolog.data import Sample
-from picolog.constants import Channel
-import utils
-
-"""Data models"""
-
-class DatabaseModel(object):
-    """Represents a database model"""
-
-    """The database connection"""
-    db = None
-
-    """The configuration file"""
-    config = None
-
-    def __init__(self, db, config):
-        """Initialises the magnetometer data model
-
-        :param db: database object
-        """
-
-        # set database
-        self.db = db
-
-        # set config
-        self.config = config
-
-    @staticmethod
-    def datetime_to_timestamp(dateobj):
-        """Returns a timestamp for use in database queries
-
-        Assumes ms units, which should be used everywhere in the data models.
-        """
-
-        # subtract Unix epoch and convert to seconds, then multiply by 1000
-        return 1000 * (dateobj - datetime.datetime(1970, 1, 1)).total_seconds()
-
-    @staticmethod
-    def timestamp_to_datetime(timestamp):
-        """Returns a datetime object using a database timestamp
-
-        Assumes ms units for the timestamp
-        """
-
-        # check if it is valid
-        if timestamp is not None:
-            # convert to s
-            timestamp = int(timestamp) / 1000
-        else:
-            timestamp = 0
-
-        # return date object
-        return datetime.datetime.utcfromtimestamp(timestamp)
-
-class Channel(DatabaseModel):
-    """Represents a channel"""
-
-    """Channel"""
-    channel_num = None
-
-    """Name"""
-    name = None
-
-    def __init__(self, channel_num, name, *args, **kwargs):
-        """Initialises a database channel model"""
-
-        super(Channel, self).__init__(*args, **kwargs)
-
-        # set channel
-        self.channel_num = int(channel_num)
-
-        # set name
-        self.name = name
-
-    @classmethod
-    def init_schema(cls, db):
-        """Initialises the database schema"""
-
-        # create table
-        with db.transaction():
-            db.query("""
-                CREATE TABLE channels (
-	               channel INTEGER UNSIGNED NOT NULL,
-                   name TEXT NOT NULL,
-                   CONSTRAINT channel_index UNIQUE (channel)
-                )
-            """)
-
-    def add(self, name):
-        """Adds a channel to the database
-
-        :param name: the name to add
-        :raises Exception: if channel is invalid
-        """
-
-        # check that channel is valid
-        if not Channel.is_valid(self.channel_num):
-            raise Exception("Specified channel is not valid")
-
-        # start a transaction
-        with self.db.transaction():
-            # insert channel
-            self.db.insert('channels', channel=self.channel_num, name=name)
-
-class Key(DatabaseModel):
-    """Represents a key"""
-
-    """Key value"""
-    key_value = None
-
-    def __init__(self, key_value, *args, **kwargs):
-        super(Key, self).__init__(*args, **kwargs)
-
-        self.key_value = key_value
-
-    @classmethod
-    def init_schema(cls, db):
-        """Initialises the database schema"""
-
-        # create table
-        with db.transaction():
-            db.query("""
-                CREATE TABLE access_keys (
-	               key_id INTEGER PRIMARY KEY,
-                   key TEXT NOT NULL
-                )
-            """)
-
-    def add(self):
-        """Adds a new key"""
-
-        # start a transaction
-        with self.db.transaction():
-            # insert key
-            return self.db.insert('access_keys', key=self.key_value)
-
-    def get_id(self):
-        """Returns the key id for the predefined key"""
-
-        return int(self.db.select_single_cell('access_keys', \
-        {"key": self.key_value}, what="key_id", where="key = $key"))
-
-    def get_writable_channels(self):
-        """Returns a list of writable channels for the specified key"""
-
-        result = self.db.query("""
-            SELECT channel
-            FROM channel_access
-            INNER JOIN access_keys
-            ON channel_access.key_id = access_keys.key_id
-            WHERE access_keys.key = $key AND mode = $mode
-        """, {'key': self.key_value, 'mode': ChannelAccess.MODE_RW})
-
-        return [allowed_channel.channel for allowed_channel in result.list()]
-
-    def get_readable_channels(self):
-        """Returns a list of writable channels for the specified key"""
-
-        result = self.db.query("""
-            SELECT channel
-            FROM channel_access
-            INNER JOIN access_keys
-            ON channel_access.key_id = access_keys.key_id
-            WHERE access_keys.key = $key AND mode >= $mode
-        """, {'key': self.key_value, 'mode': ChannelAccess.MODE_R})
-
-        return [allowed_channel.channel for allowed_channel in result.list()]
-
-class ChannelAccess(DatabaseModel):
-    """Represents the channel access model"""
-
-    # access modes, in ascending order of access
-    MODE_NONE = 0 # no access
-    MODE_R = 1 # read-only
-    MODE_RW = 2 # read and write
-
-    """Channel"""
-    channel = None
-
-    """Key"""
-    key = None
-
-    def __init__(self, channel, key, *args, **kwargs):
-        super(ChannelAccess, self).__init__(*args, **kwargs)
-
-        self.channel = channel
-        self.key = key
-
-    @classmethod
-    def init_schema(cls, db):
-        """Initialises the database schema"""
-
-        # create table
-        with db.transaction():
-            db.query("""
-                CREATE TABLE channel_access (
-	               channel INTEGER UNSIGNED NOT NULL,
-                   key_id INTEGER NOT NULL,
-                   mode TINYINT UNSIGNED NOT NULL,
-                   FOREIGN KEY(channel) REFERENCES channels(channel),
-                   FOREIGN KEY(key_id) REFERENCES access_keys(key_id)
-                )
-            """)
-
-    def add(self, mode):
-        """Allows channel access to the specified key"""
-
-        # start a transaction
-        with self.db.transaction():
-            # insert access
-            return self.db.insert('channel_access', \
-            channel=self.channel.get_id(), key_id=self.key.get_id(), mode=mode)
-
-class ChannelSamples(DatabaseModel):
-    """Represents the magnetometer data"""
-
-    """Channel"""
-    channel = None
-
-    """Stream type"""
-    stream_type = None
-
-    """Window"""
-    window = None
-
-    """Key"""
-    key = None
-
-    """Table name"""
-    TABLE_NAME = "samples"
-
-    def __init__(self, channel, stream_type, window, key, *args, **kwargs):
-        super(ChannelSamples, self).__init__(*args, **kwargs)
-
-        self.channel = channel
-        self.stream_type = stream_type
-        self.window = window
-        self.key = key
-
-    @classmethod
-    def init_schema(cls, db):
-        """Initialises the database schema"""
-
-        # create table
-        db.query("""
-            CREATE TABLE {0} (
-	            channel INTEGER UNSIGNED NOT NULL,
-                timestamp DATETIME(3) NOT NULL,
-	            value INTEGER NOT NULL,
-                FOREIGN KEY(channel) REFERENCES channels(channel),
-                CONSTRAINT sample_index UNIQUE (channel, timestamp)
-                ON CONFLICT IGNORE
-            )
-        """.format(cls.TABLE_NAME))
-
-    @classmethod
-    def add_from_datastore(cls, db, key, datastore):
-        """Adds readings from a datastore to the database
-
-        :param datastore: the datastore object to add readings from
-        """
-
-        # get allowed channels
-        allowed_channels = key.get_writable_channels()
-
-        insert_count = 0
-
-        # insert readings
-        for reading in datastore.readings:
-            # add samples, incrementing insert count
-            insert_count += cls.add_from_reading(db, key, reading)
-
-        return insert_count
-
-    @classmethod
-    def add_from_reading(cls, db, key, reading):
-        """Adds a reading to the database
-
-        :param reading: the reading to add
-        """
-
-        # get allowed channels
-        allowed_channels = key.get_writable_channels()
-
-        insert_count = 0
-
-        # start a transaction
-        with db.transaction():
-            # insert samples, checking channel access
-            for sample in reading.sample_dict_gen():
-                if sample["channel"] not in allowed_channels:
-                    raise Exception("Channel {0} cannot be writen to with \
-specified key".format(sample["channel"]))
-
-                db.insert(cls.TABLE_NAME, \
-                channel=sample["channel"], timestamp=sample["timestamp"], \
-                value=sample["value"])
-
-                insert_count += 1
-
-        return insert_count
-
-    def get_time_series(self, since=None, *args, **kwargs):
-        """Returns time series for this channel"""
-
-        # get allowed channels
-        allowed_channels = self.key.get_writable_channels()
-
-        # check access
-        if self.channel.channel_num not in allowed_channels:
-            # return empty list
-            return []
-
-        # empty where clause
-        where = []
-
-        # add channel
-        where.append("channel = {0}".format(self.channel.channel_num))
-
-        # threshold timestamp, in ms
-        if since is None:
-            # get default window
-            since = datetime.datetime.today() \
-            - datetime.timedelta(milliseconds=int(self.window))
-
-        # SQL since timestamp
-        since_timestamp = self.datetime_to_timestamp(since)
-
-        # create since command
-        where.append("timestamp >= {0}".format(since_timestamp))
-
-        # create full where command
-        sqlwhere = " AND ".join([str(clause) for clause in where])
-
-        # get rows
-        rows = self.db.select(self.TABLE_NAME, \
-        where=sqlwhere, order="timestamp ASC", *args, **kwargs)
-
-        # create timeseries from rows
-        return [[row.timestamp, row.value] for row in rows \
-        if row.channel in allowed_channels]
-
-    def get_time_series_js(self, *args, **kwargs):
-        return utils.stream_to_js(self.get_time_series(*args, **kwargs))
-
-    def get_last_time(self):
-        """Gets the time of the last data in the table"""
-
-        # get timestamp, in ms
-        timestamp = self.db.select_single_cell(self.TABLE_NAME, \
-        what="timestamp", order="timestamp DESC")
-
-        # return date object
-        return self.timestamp_to_datetime(timestamp)
-
-    def get_description(self):
-        """Returns a description string"""
-
-        return "{0} ({1})".format(self.channel.name, self.stream_type)
-
-class ChannelSampleTrends(DatabaseModel):
-    """Represents a data trend for a magnetometer data structure"""
-
-    """Channel"""
-    channel = None
-
-    """Stream type"""
-    stream_type = None
-
-    """Window"""
-    window = None
-
-    """Key"""
-    key = None
-
-    """Time average [ms]"""
-    timestamp_avg = None
-
-    def __init__(self, channel, stream_type, window, key, timestamp_avg, *args, \
-    **kwargs):
-        # initialise parent
-        super(ChannelSampleTrends, self).__init__(*args, **kwargs)
-
-        # set channel
-        self.channel = channel
-
-        self.stream_type = stream_type
-
-        self.window = window
-
-        # set key
-        self.key = key
-
-        # set time average
-        self.timestamp_avg = int(timestamp_avg)
-
-    def init_schema(self):
-        """Initialises the database schema"""
-
-        # create table
-        self.db.query("""
-            CREATE TABLE {0} (
-	            channel INTEGER UNSIGNED NOT NULL,
-                timestamp DATETIME(3) NOT NULL,
-	            value INTEGER NOT NULL,
-                FOREIGN KEY(channel) REFERENCES channels(channel),
-                CONSTRAINT sample_index UNIQUE (channel, timestamp)
-                ON CONFLICT IGNORE
-            )
-        """.format(self._table_name()))
-
-    def delete(self):
-        """Deletes this trend"""
-
-        # delete
-        with self.db.transaction():
-            self.db.query("""
-                DROP TABLE {0}
-            """.format(self._table_name()))
-
-    def _table_name(self):
-        """Returns the table name"""
-
-        return "{0}_trend_{1}_{2}".format(\
-        str(ChannelSamples.TABLE_NAME), self.channel.channel_num, self.timestamp_avg)
-
-    def _add_trend_data(self, times, values):
-        """Adds the trend data specified as times and values to the table"""
-
-        # create data: list of dicts representing rows
-        data = []
-
-        for time, value in zip(times, values):
-            data.append({"channel": self.channel.channel_num, "timestamp": time, \
-            "value": value})
-
-        # add data
-        with self.db.transaction():
-            row_ids = self.db.multiple_insert(self._table_name(), data)
-
-        # return number of rows inserted
-        return len(row_ids)
-
-    def update_trends(self, max_rows=1000):
-        """Updates the trends based on new data since latest computed trend"""
-
-        # calculate trends
-        try:
-            trend_times, trend_values = self._calculate_trends(max_rows)
-        except NoDataForTrendsException as e:
-            # no data available, so return 0 as the number of new trend points
-            print e
-            return 0
-
-        # insert into database, returning the number of new trend points
-        return self._add_trend_data(trend_times, trend_values)
-
-    def _calculate_trends(self, max_rows):
-        """Computes trends following the last computed trend value"""
-
-        # get last computed trend
-        last_trend_time = self.get_last_trend_time()
-
-        # create where clause
-        where = []
-
-        # add timestamp threshold
-        where.append("timestamp >= {0}".format( \
-        self.datetime_to_timestamp(last_trend_time)))
-
-        # add channel
-        where.append("channel == {0}".format(self.channel.channel_num))
-
-        # create SQL where clause
-        sqlwhere = " AND ".join(where)
-
-        # fetch unaveraged rows
-        rows = self.db.select(ChannelSamples.TABLE_NAME, where=sqlwhere, \
-        order="timestamp ASC", limit=int(max_rows)).list()
-
-        # check that spanned time is at least enough to make an average
-        if rows[-1].timestamp - rows[0].timestamp < self.timestamp_avg:
-            raise NoDataForTrendsException("The number of selected rows is not \
-large enough to span the specified trend time. If this happens frequently, \
-consider increasing max_rows parameter.")
-
-        # timestamp of previous row (by default, first row)
-        last_timestamp = rows[0].timestamp
-
-        # indices
-        index = 1
-        window_start_index = 0
-
-        # time since start of trend window
-        window_accumulated_time = 0
-
-        # trend times and values
-        trend_times = []
-        trend_values = []
-
-        for row in rows:
-            window_accumulated_time += row.timestamp - last_timestamp
-
-            # have we reached the trend time?
-            if window_accumulated_time >= self.timestamp_avg:
-                # compute trend with this window
-                trend_values.append(self._compute_trend(rows[window_start_index:index]))
-
-                # add time
-                trend_times.append(row.timestamp)
-
-                # reset the window start index, equal to the next row
-                window_start_index = index
-
-                # reset window accumulated time
-                window_accumulated_time = 0
-
-            # update last timestamp
-            last_timestamp = row.timestamp
-
-            # increment index
-            index += 1
-
-        return trend_times, trend_values
-
-    def _compute_trend(self, rows):
-        """Computes the trend value for the specified rows"""
-
-        return sum([row.value for row in rows]) / len(rows)
-
-    def get_last_trend_time(self):
-        """Fetches the time of the last computed trend"""
-
-        # get timestamp, in ms
-        timestamp = self.db.select_single_cell(self._table_name(), \
-        what="timestamp", order="timestamp DESC")
-
-        # return date object
-        return self.timestamp_to_datetime(timestamp)
-
-    def get_time_series(self, since=None, *args, **kwargs):
-        """Returns time series for this channel trend"""
-
-        # allowed channels
-        allowed_channels = self.key.get_writable_channels()
-
-        # check access
-        if self.channel.channel_num not in allowed_channels:
-            # return empty list
-            return []
-
-        # empty where clause
-        where = []
-
-        # add channel
-        where.append("channel = {0}".format(self.channel.channel_num))
-
-        # create since command (and convert timestamp from s to ms)
-        if since is not None:
-            # threshold timestamp, in ms
-            since_timestamp = self.datetime_to_timestamp(since)
-
-            where.append("timestamp >= {0}".format(since_timestamp))
-
-        # create full where command
-        sqlwhere = " AND ".join([str(clause) for clause in where])
-
-        # get rows
-        rows = self.db.select(self._table_name(), \
-        where=sqlwhere, order="timestamp ASC", *args, **kwargs)
-
-        # create timeseries from rows
-        return [[row.timestamp, row.value] for row in rows \
-        if row.channel in allowed_channels]
-
-    def get_time_series_js(self, *args, **kwargs):
-        return utils.stream_to_js(self.get_time_series(*args, **kwargs))
-
-    def get_description(self):
-        """Returns a description string"""
-
-        # trend description
-        trend_description = "{0}s {1}".format(self.timestamp_avg / 1000, \
-        self.stream_type)
-
-        return "{0} ({1})".format(self.channel.name, trend_description)
-
-class NoDataForTrendsException(Exception):
-    pass
+from __future__ import division
+
+import os
+import sys
+import errno
+import web.db
+import datetime
+import time
+import threading
+import numpy as np
+
+from picolog.data import Sample, Reading
+import picolog.constants
+import utils
+import downsample
+import archive
+import blocks
+import ringbuffer
+import metrics
+
+"""Data models"""
+
+class DatabaseModel(object):
+    """Represents a database model"""
+
+    """The database connection"""
+    db = None
+
+    """The configuration file"""
+    config = None
+
+    def __init__(self, db, config):
+        """Initialises the magnetometer data model
+
+        :param db: database object
+        """
+
+        # set database
+        self.db = db
+
+        # set config
+        self.config = config
+
+    @staticmethod
+    def datetime_to_timestamp(dateobj):
+        """Returns a timestamp for use in database queries
+
+        Assumes ms units, which should be used everywhere in the data models.
+        """
+
+        # subtract Unix epoch and convert to seconds, then multiply by 1000
+        return int(round(1000 \
+        * (dateobj - datetime.datetime(1970, 1, 1)).total_seconds()))
+
+    @staticmethod
+    def timestamp_to_datetime(timestamp):
+        """Returns a datetime object using a database timestamp
+
+        Assumes ms units for the timestamp
+        """
+
+        # check if it is valid
+        if timestamp is not None:
+            # convert to s
+            timestamp = int(timestamp) / 1000
+        else:
+            timestamp = 0
+
+        # return date object
+        return datetime.datetime.utcfromtimestamp(timestamp)
+
+    @classmethod
+    def to_timestamp(cls, value):
+        """Returns a database timestamp for a datetime or a ms timestamp"""
+
+        if isinstance(value, datetime.datetime):
+            return cls.datetime_to_timestamp(value)
+
+        return int(value)
+
+    def get_default_max_points(self):
+        """Returns the configured maximum number of points per plot"""
+
+        if self.config is not None \
+        and self.config.has_option('plot', 'max_points'):
+            return self.config.getint('plot', 'max_points')
+
+        return None
+
+    def _downsample_arrays(self, timestamps, values, max_points):
+        """Reduces a time series to at most max_points points
+
+        :param timestamps: array of timestamps
+        :param values: array of values
+        :param max_points: maximum number of points, or None for no limit
+        :return: (timestamps, values) arrays
+        """
+
+        if max_points is not None and len(timestamps) > int(max_points):
+            timestamps, values = downsample.downsample(timestamps, values, \
+            int(max_points), self.get_downsample_method())
+
+        return timestamps, values
+
+    @staticmethod
+    def _arrays_to_series(timestamps, values):
+        """Returns timestamp and value arrays as [timestamp, value] pairs"""
+
+        return [list(sample) for sample in \
+        zip(np.asarray(timestamps).tolist(), np.asarray(values).tolist())]
+
+    @staticmethod
+    def _empty_arrays():
+        """Returns empty timestamp and value arrays"""
+
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    def get_downsample_method(self):
+        """Returns the configured downsampling method"""
+
+        if self.config is not None \
+        and self.config.has_option('plot', 'downsample'):
+            return self.config.get('plot', 'downsample')
+
+        return downsample.METHOD_MINMAX
+
+class Channel(DatabaseModel):
+    """Represents a channel"""
+
+    """Channel"""
+    channel_num = None
+
+    """Name"""
+    name = None
+
+    """Days of raw samples kept, or None to keep them all"""
+    keep_raw = None
+
+    """Days of trend points and rollups kept, or None to keep them all"""
+    keep_trends = None
+
+    def __init__(self, channel_num, name, *args, **kwargs):
+        """Initialises a database channel model"""
+
+        super(Channel, self).__init__(*args, **kwargs)
+
+        # set channel
+        self.channel_num = int(channel_num)
+
+        # set name
+        self.name = name
+
+    @classmethod
+    def init_schema(cls, db):
+        """Initialises the database schema"""
+
+        # create table
+        with db.transaction():
+            db.query("""
+                CREATE TABLE channels (
+	               channel INTEGER UNSIGNED NOT NULL,
+                   name TEXT NOT NULL,
+                   CONSTRAINT channel_index UNIQUE (channel)
+                )
+            """)
+
+    def add(self, name):
+        """Adds a channel to the database
+
+        :param name: the name to add
+        :raises Exception: if channel is invalid
+        """
+
+        # check that channel is valid
+        if not picolog.constants.Channel.is_valid(self.channel_num):
+            raise Exception("Specified channel is not valid")
+
+        # start a transaction
+        with self.db.transaction():
+            # insert channel
+            self.db.insert('channels', channel=self.channel_num, name=name)
+
+class Key(DatabaseModel):
+    """Represents a key"""
+
+    """Key value"""
+    key_value = None
+
+    """Default lifetime of cached channel access [s]"""
+    DEFAULT_ACCESS_CACHE_TTL = 60
+
+    """Process-level access cache: (key, mode) -> (expiry, channel set)"""
+    _access_cache = {}
+
+    """Lock protecting the access cache"""
+    _access_cache_lock = threading.Lock()
+
+    """Access cache statistics"""
+    access_cache_hits = 0
+    access_cache_misses = 0
+
+    def __init__(self, key_value, *args, **kwargs):
+        super(Key, self).__init__(*args, **kwargs)
+
+        self.key_value = key_value
+
+    @classmethod
+    def init_schema(cls, db):
+        """Initialises the database schema"""
+
+        # create table
+        with db.transaction():
+            db.query("""
+                CREATE TABLE access_keys (
+	               key_id INTEGER PRIMARY KEY,
+                   key TEXT NOT NULL
+                )
+            """)
+
+    def add(self):
+        """Adds a new key"""
+
+        # start a transaction
+        with self.db.transaction():
+            # insert key
+            key_id = self.db.insert('access_keys', key=self.key_value)
+
+        # cached access for this key value is now stale
+        Key.invalidate_access_cache(self.key_value)
+
+        return key_id
+
+    def get_id(self):
+        """Returns the key id for the predefined key"""
+
+        return int(self.db.select_single_cell('access_keys', \
+        {"key": self.key_value}, what="key_id", where="key = $key"))
+
+    def get_writable_channels(self):
+        """Returns a set of writable channels for the specified key"""
+
+        return self._get_cached_channels(ChannelAccess.MODE_RW, """
+            SELECT channel
+            FROM channel_access
+            INNER JOIN access_keys
+            ON channel_access.key_id = access_keys.key_id
+            WHERE access_keys.key = $key AND mode = $mode
+        """)
+
+    def get_readable_channels(self):
+        """Returns a set of readable channels for the specified key"""
+
+        return self._get_cached_channels(ChannelAccess.MODE_R, """
+            SELECT channel
+            FROM channel_access
+            INNER JOIN access_keys
+            ON channel_access.key_id = access_keys.key_id
+            WHERE access_keys.key = $key AND mode >= $mode
+        """)
+
+    def _get_cached_channels(self, mode, sql):
+        """Returns the channels for the specified mode, using the cache
+
+        :param mode: access mode the query checks for
+        :param sql: query returning the channels for $key and $mode
+        """
+
+        cache_key = (self.key_value, mode)
+
+        # look for a cached entry that hasn't expired
+        with Key._access_cache_lock:
+            entry = Key._access_cache.get(cache_key)
+
+            if entry is not None and entry[0] > time.time():
+                Key.access_cache_hits += 1
+
+                return entry[1]
+
+            Key.access_cache_misses += 1
+
+        result = self.db.query(sql, {'key': self.key_value, 'mode': mode})
+
+        channels = frozenset([allowed_channel.channel \
+        for allowed_channel in result.list()])
+
+        # store, with an expiry time to pick up changes by other processes
+        with Key._access_cache_lock:
+            Key._access_cache[cache_key] = (time.time() \
+            + self._access_cache_ttl(), channels)
+
+        return channels
+
+    def _access_cache_ttl(self):
+        """Returns the access cache lifetime [s] from the configuration"""
+
+        if self.config is not None \
+        and self.config.has_option('cache', 'access_ttl'):
+            return self.config.getfloat('cache', 'access_ttl')
+
+        return self.DEFAULT_ACCESS_CACHE_TTL
+
+    @classmethod
+    def invalidate_access_cache(cls, key_value=None):
+        """Removes cached channel access
+
+        :param key_value: key to invalidate, or None to invalidate all keys
+        """
+
+        with cls._access_cache_lock:
+            if key_value is None:
+                cls._access_cache.clear()
+            else:
+                for cache_key in cls._access_cache.keys():
+                    if cache_key[0] == key_value:
+                        del cls._access_cache[cache_key]
+
+    @classmethod
+    def get_access_cache_stats(cls):
+        """Returns access cache hit and miss counts and its size"""
+
+        with cls._access_cache_lock:
+            return {"hits": cls.access_cache_hits, \
+            "misses": cls.access_cache_misses, \
+            "size": len(cls._access_cache)}
+
+class ChannelAccess(DatabaseModel):
+    """Represents the channel access model"""
+
+    # access modes, in ascending order of access
+    MODE_NONE = 0 # no access
+    MODE_R = 1 # read-only
+    MODE_RW = 2 # read and write
+
+    """Channel"""
+    channel = None
+
+    """Key"""
+    key = None
+
+    def __init__(self, channel, key, *args, **kwargs):
+        super(ChannelAccess, self).__init__(*args, **kwargs)
+
+        self.channel = channel
+        self.key = key
+
+    @classmethod
+    def init_schema(cls, db):
+        """Initialises the database schema"""
+
+        # create table
+        with db.transaction():
+            db.query("""
+                CREATE TABLE channel_access (
+	               channel INTEGER UNSIGNED NOT NULL,
+                   key_id INTEGER NOT NULL,
+                   mode TINYINT UNSIGNED NOT NULL,
+                   FOREIGN KEY(channel) REFERENCES channels(channel),
+                   FOREIGN KEY(key_id) REFERENCES access_keys(key_id)
+                )
+            """)
+
+    def add(self, mode):
+        """Allows channel access to the specified key"""
+
+        # start a transaction
+        with self.db.transaction():
+            # insert access
+            access_id = self.db.insert('channel_access', \
+            channel=self.channel.channel_num, key_id=self.key.get_id(), \
+            mode=mode)
+
+        # cached access for this key is now stale
+        Key.invalidate_access_cache(self.key.key_value)
+
+        return access_id
+
+class ChannelSamples(DatabaseModel):
+    """Represents the magnetometer data"""
+
+    """Channel"""
+    channel = None
+
+    """Stream type"""
+    stream_type = None
+
+    """Window"""
+    window = None
+
+    """Key"""
+    key = None
+
+    """Table name"""
+    TABLE_NAME = "samples"
+
+    """Default number of samples per second a channel buffer is sized for"""
+    DEFAULT_BUFFER_SAMPLE_RATE = 10
+
+    """In-memory buffers of the newest samples, by channel number"""
+    ring_buffers = {}
+
+    """Functions called with the set of channels given new samples by each
+    committed write"""
+    write_listeners = []
+
+    def __init__(self, channel, stream_type, window, key, *args, **kwargs):
+        super(ChannelSamples, self).__init__(*args, **kwargs)
+
+        self.channel = channel
+        self.stream_type = stream_type
+        self.window = window
+        self.key = key
+
+    @classmethod
+    def init_schema(cls, db):
+        """Initialises the database schema"""
+
+        # create table
+        cls.create_table(db, cls.TABLE_NAME)
+
+    @classmethod
+    def init_ring_buffers(cls, db, config, streams):
+        """Creates and warms an in-memory buffer for each raw stream's channel
+
+        Each buffer covers the largest raw stream window, holding as many
+        samples as arrive in that time at the [buffer] sample_rate. The
+        buffers are filled by write_rows, so they only stay complete if every
+        sample is written by this process.
+
+        :param streams: configured streams
+        """
+
+        raw_streams = [stream for stream in streams \
+        if isinstance(stream, ChannelSamples)]
+
+        if len(raw_streams) == 0:
+            return
+
+        # longest window [ms]
+        span = max([int(stream.window) for stream in raw_streams])
+
+        sample_rate = cls.DEFAULT_BUFFER_SAMPLE_RATE
+
+        if config.has_option('buffer', 'sample_rate'):
+            sample_rate = config.getfloat('buffer', 'sample_rate')
+
+        capacity = max(1, int(span * sample_rate / 1000))
+
+        since = cls.datetime_to_timestamp(datetime.datetime.today()) - span
+
+        for stream in raw_streams:
+            channel_num = stream.channel.channel_num
+
+            if channel_num in cls.ring_buffers:
+                continue
+
+            ring_buffer = ringbuffer.RingBuffer(capacity)
+            ring_buffer.reset(since)
+
+            # register before reading, so samples written meanwhile are kept
+            cls.ring_buffers[channel_num] = ring_buffer
+
+            ring_buffer.append(*cls.read_arrays(db, config, channel_num, \
+            since))
+
+    @classmethod
+    def get_ring_buffer_stats(cls):
+        """Returns each channel buffer's statistics, by channel number"""
+
+        return dict([(channel_num, ring_buffer.get_stats()) \
+        for channel_num, ring_buffer in cls.ring_buffers.iteritems()])
+
+    @staticmethod
+    def create_table(db, table_name):
+        """Creates a table of (channel, timestamp, value) samples
+
+        Timestamps are integer ms. Rows are stored in (channel, timestamp)
+        order, without a separate rowid, so each channel's time range is
+        contiguous on disk. Samples repeating a channel and timestamp are
+        ignored.
+
+        :param table_name: name of the table to create
+        """
+
+        db.query("""
+            CREATE TABLE {0} (
+	            channel INTEGER UNSIGNED NOT NULL,
+                timestamp INTEGER NOT NULL,
+	            value INTEGER NOT NULL,
+                FOREIGN KEY(channel) REFERENCES channels(channel),
+                PRIMARY KEY (channel, timestamp) ON CONFLICT IGNORE
+            ) WITHOUT ROWID
+        """.format(table_name))
+
+    @classmethod
+    def add_from_datastore(cls, db, key, datastore):
+        """Adds readings from a datastore to the database
+
+        :param datastore: the datastore object to add readings from
+        """
+
+        return cls.add_from_readings(db, key, datastore.readings)
+
+    @classmethod
+    def add_from_reading(cls, db, key, reading):
+        """Adds a reading to the database
+
+        :param reading: the reading to add
+        """
+
+        return cls.add_from_readings(db, key, [reading])
+
+    @classmethod
+    def add_from_readings(cls, db, key, readings):
+        """Adds a batch of readings to the database
+
+        Channel access is checked once for the whole batch, and every sample is
+        written in one transaction using a single batched statement.
+
+        :param readings: iterable of readings to add
+        :return: number of samples inserted (duplicates are ignored)
+        :raises Exception: if a sample's channel cannot be written to
+        """
+
+        rows = cls.collect_rows(key, readings)
+
+        return cls.write_rows(db, key.config, [rows])[0]
+
+    @classmethod
+    def collect_rows(cls, key, readings):
+        """Returns the samples in readings as rows, checking channel access
+
+        :param readings: iterable of readings
+        :return: list of (channel, timestamp, value) tuples
+        :raises Exception: if a sample's channel cannot be written to
+        """
+
+        # get allowed channels
+        allowed_channels = key.get_writable_channels()
+
+        # rows to insert, as (channel, timestamp, value)
+        rows = []
+
+        # collect samples, checking channel access
+        for reading in readings:
+            for sample in reading.sample_dict_gen():
+                if sample["channel"] not in allowed_channels:
+                    raise Exception("Channel {0} cannot be writen to with \
+specified key".format(sample["channel"]))
+
+                # timestamps are stored as integer ms
+                rows.append((sample["channel"], int(sample["timestamp"]), \
+                sample["value"]))
+
+        return rows
+
+    @classmethod
+    def collect_arrays(cls, key, channels, timestamps, values):
+        """Returns samples given as arrays as rows, checking channel access
+
+        :param channels: array of channel numbers
+        :param timestamps: array of timestamps [ms]
+        :param values: array of integer values
+        :return: integer array with a (channel, timestamp, value) row per
+        sample
+        :raises Exception: if a sample's channel cannot be written to
+        """
+
+        allowed_channels = key.get_writable_channels()
+
+        for channel_num in np.unique(channels).tolist():
+            if channel_num not in allowed_channels:
+                raise Exception("Channel {0} cannot be writen to with \
+specified key".format(channel_num))
+
+        return np.column_stack((np.asarray(channels, dtype=np.int64), \
+        np.asarray(timestamps, dtype=np.int64), \
+        np.asarray(values, dtype=np.int64)))
+
+    @classmethod
+    def write_rows(cls, db, config, row_sets):
+        """Writes sets of sample rows in a single transaction, then updates the
+        cached states and buffers and notifies listeners
+
+        Access must already have been checked, e.g. by collect_rows.
+
+        :param row_sets: list of lists of (channel, timestamp, value) tuples,
+        or of integer arrays with a (channel, timestamp, value) row per sample
+        :return: list of the number of samples inserted from each set
+        """
+
+        insert_counts, changes = cls.commit_rows(db, config, row_sets)
+
+        cls.after_commit(row_sets, changes)
+
+        return insert_counts
+
+    @classmethod
+    def commit_rows(cls, db, config, row_sets):
+        """Writes sets of sample rows in a single transaction
+
+        Nothing outside the database is changed: pass the result to
+        after_commit once the rows are committed.
+
+        :param row_sets: rows as accepted by write_rows
+        :return: (list of the number of samples inserted from each set, dict
+        of channel number to (samples inserted, latest timestamp, value at
+        the latest timestamp))
+        """
+
+        # time range of the samples for each channel, as [start, end], and
+        # the value at the end
+        channel_ranges = {}
+
+        # each set's rows by channel
+        channel_row_sets = []
+
+        for rows in row_sets:
+            channel_rows = {}
+
+            for channel_num, (rows, start, end, value) \
+            in cls._group_rows(rows).iteritems():
+                # repeats of compacted samples aren't inserted
+                channel_rows[channel_num] = ChannelBlocks.remove_compacted( \
+                db, config, channel_num, rows)
+
+                # extend channel time range
+                time_range = channel_ranges.setdefault(channel_num, \
+                [start, end, value])
+                time_range[0] = min(time_range[0], start)
+
+                if end > time_range[1]:
+                    time_range[1] = end
+                    time_range[2] = value
+
+            channel_row_sets.append(channel_rows)
+
+        # number of samples inserted for each channel
+        channel_counts = dict.fromkeys(channel_ranges, 0)
+
+        # start a transaction
+        with db.transaction():
+            insert_counts = []
+
+            for channel_rows in channel_row_sets:
+                insert_count = 0
+
+                # insert by channel to count each channel's new samples
+                for channel_num, rows in channel_rows.iteritems():
+                    channel_count = db.insert_many(cls.TABLE_NAME, \
+                    ("channel", "timestamp", "value"), rows)
+
+                    channel_counts[channel_num] += channel_count
+                    insert_count += channel_count
+
+                insert_counts.append(insert_count)
+
+            for channel_num, (start, end, value) in channel_ranges.iteritems():
+                # latest sample stored before these
+                last_timestamp = db.select_single_cell( \
+                ChannelState.TABLE_NAME, {"channel": channel_num}, \
+                what="last_timestamp", where="channel = $channel")
+
+                timestamps = [row[1] for channel_rows in channel_row_sets \
+                for row in channel_rows.get(channel_num, [])]
+
+                # update summaries for the new samples
+                ChannelRollups(channel_num, db, config).update_samples( \
+                timestamps, last_timestamp)
+
+                # update latest sample
+                ChannelState.update(db, channel_num, \
+                channel_counts[channel_num], end, value)
+
+        changes = dict([(channel_num, (channel_counts[channel_num], end, \
+        value)) for channel_num, (start, end, value) \
+        in channel_ranges.iteritems()])
+
+        return insert_counts, changes
+
+    @classmethod
+    def after_commit(cls, row_sets, changes):
+        """Updates the cached states and buffers with committed rows, and
+        notifies listeners
+
+        The samples are already stored, so a listener's error is logged
+        rather than raised.
+
+        :param row_sets: rows passed to commit_rows
+        :param changes: changes returned by commit_rows
+        """
+
+        for channel_num, (count, end, value) in changes.iteritems():
+            ChannelState.update_cache(channel_num, count, end, value)
+
+        metrics.samples_ingested.inc(sum([count for count, end, value \
+        in changes.itervalues()]))
+
+        # add the committed samples to the in-memory buffers
+        if len(cls.ring_buffers) > 0:
+            cls._append_to_ring_buffers(row_sets)
+
+        # notify listeners of the channels with new samples
+        changed_channels = set([channel_num for channel_num, (count, end, \
+        value) in changes.iteritems() if count > 0])
+
+        if len(changed_channels) > 0:
+            for listener in cls.write_listeners:
+                try:
+                    listener(changed_channels)
+                except Exception, e:
+                    print >> sys.stderr, \
+                    "Error notifying of new samples: {0}".format(e)
+
+    @staticmethod
+    def _group_rows(rows):
+        """Divides sample rows by channel
+
+        :param rows: list of (channel, timestamp, value) tuples, or an integer
+        array with a row per sample
+        :return: dict of channel number to (channel rows, earliest timestamp,
+        latest timestamp, value at the latest timestamp), where the first
+        sample at the latest timestamp gives the value
+        """
+
+        groups = {}
+
+        if isinstance(rows, np.ndarray):
+            for channel_num in np.unique(rows[:, 0]).tolist():
+                channel_rows = rows[rows[:, 0] == channel_num]
+
+                end = np.argmax(channel_rows[:, 1])
+
+                groups[channel_num] = (channel_rows.tolist(), \
+                int(channel_rows[:, 1].min()), int(channel_rows[end, 1]), \
+                int(channel_rows[end, 2]))
+
+            return groups
+
+        for row in rows:
+            channel_num, timestamp, value = row
+
+            if channel_num not in groups:
+                groups[channel_num] = ([row], timestamp, timestamp, value)
+
+                continue
+
+            channel_rows, start, end, end_value = groups[channel_num]
+            channel_rows.append(row)
+
+            if timestamp > end:
+                groups[channel_num] = (channel_rows, start, timestamp, value)
+            elif timestamp < start:
+                groups[channel_num] = (channel_rows, timestamp, end, end_value)
+
+        return groups
+
+    @classmethod
+    def _append_to_ring_buffers(cls, row_sets):
+        """Adds written sample rows to their channels' buffers"""
+
+        rows = np.concatenate([np.asarray(rows, dtype=np.int64).reshape(-1, \
+        3) for rows in row_sets])
+
+        for channel_num, ring_buffer in cls.ring_buffers.iteritems():
+            channel_rows = rows[rows[:, 0] == channel_num]
+
+            if len(channel_rows) > 0:
+                ring_buffer.append(channel_rows[:, 1], channel_rows[:, 2])
+
+    def get_time_series(self, since=None, until=None, max_points=None):
+        """Returns time series for this channel
+
+        See get_time_series_arrays for the arguments.
+
+        :return: list of [timestamp, value] pairs
+        """
+
+        return self._arrays_to_series(*self.get_time_series_arrays(since, \
+        until, max_points))
+
+    def get_time_series_arrays(self, since=None, until=None, max_points=None):
+        """Returns time series for this channel as arrays
+
+        Ranges the channel's in-memory buffer covers are read from it,
+        otherwise archived days are combined with the samples still in the
+        database.
+
+        :param since: datetime or ms timestamp to return samples from (default
+        the start of the stream's window)
+        :param until: datetime or ms timestamp to return samples up to
+        :param max_points: if specified, the series is downsampled to at most
+        this many points
+        :return: (timestamps, values) arrays
+        """
+
+        # get allowed channels
+        allowed_channels = self.key.get_writable_channels()
+
+        # check access
+        if self.channel.channel_num not in allowed_channels:
+            # return empty series
+            return self._empty_arrays()
+
+        since_timestamp, until_timestamp = self._get_range(since, until)
+
+        ring_buffer = self.ring_buffers.get(self.channel.channel_num)
+
+        if ring_buffer is not None:
+            arrays = ring_buffer.get(since_timestamp, until_timestamp)
+
+            if arrays is not None:
+                return self._downsample_arrays(arrays[0], arrays[1], \
+                max_points)
+
+        if max_points is not None:
+            # use summaries instead if they are detailed enough
+            arrays = self._get_rollup_time_series(since_timestamp, \
+            until_timestamp, int(max_points))
+
+            if arrays is not None:
+                return self._downsample_arrays(arrays[0], arrays[1], \
+                max_points)
+
+        # get samples
+        timestamps, values = self.read_arrays(self.db, self.config, \
+        self.channel.channel_num, since_timestamp, until_timestamp)
+
+        # reduce to the number of points that can be shown
+        return self._downsample_arrays(timestamps, values, max_points)
+
+    def iter_time_series_arrays(self, since=None, until=None, \
+    chunk_size=10000):
+        """Yields the time series for this channel in chunks
+
+        Rows are read from the database cursor a chunk at a time, so memory
+        use doesn't grow with the length of the series.
+
+        :param since: datetime or ms timestamp to return samples from (default
+        the start of the stream's window)
+        :param until: datetime or ms timestamp to return samples up to
+        :param chunk_size: maximum number of samples per chunk
+        :return: generator of (timestamps, values) arrays
+        """
+
+        # get allowed channels
+        allowed_channels = self.key.get_writable_channels()
+
+        # check access
+        if self.channel.channel_num not in allowed_channels:
+            return
+
+        since_timestamp, until_timestamp = self._get_range(since, until)
+
+        # archived days come first
+        channel_archive = archive.ChannelArchive.from_config( \
+        self.channel.channel_num, self.config)
+
+        if channel_archive is not None:
+            for timestamps, values in channel_archive.get_segments( \
+            since_timestamp, until_timestamp):
+                # samples written late into an archived day are still in the
+                # database
+                timestamps, values = archive.merge_segments([(timestamps, \
+                values), self._read_table_arrays(since_timestamp, \
+                int(timestamps[-1]))])
+
+                for start in range(0, len(timestamps), chunk_size):
+                    yield timestamps[start:start + chunk_size], \
+                    values[start:start + chunk_size]
+
+                since_timestamp = int(timestamps[-1]) + 1
+
+        # then compressed blocks
+        for timestamps, values in ChannelBlocks.get_segments(self.db, \
+        self.config, self.channel.channel_num, since_timestamp, \
+        until_timestamp):
+            # samples written late into a compacted span are in the samples
+            # table until they are merged into its block
+            timestamps, values = archive.merge_segments([(timestamps, \
+            values), self._read_table_arrays(since_timestamp, \
+            int(timestamps[-1]))])
+
+            for start in range(0, len(timestamps), chunk_size):
+                yield timestamps[start:start + chunk_size], \
+                values[start:start + chunk_size]
+
+            since_timestamp = int(timestamps[-1]) + 1
+
+        # where clause
+        where = ["channel = $channel", "timestamp >= $since"]
+
+        if until_timestamp is not None:
+            where.append("timestamp <= $until")
+
+        for chunk in self.db.iter_arrays("""
+            SELECT timestamp, value
+            FROM {0}
+            WHERE {1}
+            ORDER BY timestamp ASC
+        """.format(self.TABLE_NAME, " AND ".join(where)), \
+        {"channel": self.channel.channel_num, "since": since_timestamp, \
+        "until": until_timestamp}, dtypes=(np.int64, np.int64), \
+        chunk_size=chunk_size):
+            yield chunk
+
+    def _read_table_arrays(self, since_timestamp, until_timestamp):
+        """Returns this channel's rows in the samples table between two times
+
+        :param since_timestamp: earliest timestamp [ms]
+        :param until_timestamp: latest timestamp [ms]
+        :return: (timestamps, values) arrays
+        """
+
+        return self.db.query_arrays("""
+            SELECT timestamp, value
+            FROM {0}
+            WHERE channel = $channel AND timestamp >= $since
+            AND timestamp <= $until
+            ORDER BY timestamp ASC
+        """.format(self.TABLE_NAME), {"channel": self.channel.channel_num, \
+        "since": since_timestamp, "until": until_timestamp}, \
+        dtypes=(np.int64, np.int64))
+
+    def _get_range(self, since, until):
+        """Returns the since and until timestamps [ms] for a query
+
+        since defaults to the start of the stream's window, and until to None.
+        """
+
+        # threshold timestamp, in ms
+        if since is None:
+            # get default window
+            since = datetime.datetime.today() \
+            - datetime.timedelta(milliseconds=int(self.window))
+
+        # SQL until timestamp
+        until_timestamp = None
+
+        if until is not None:
+            until_timestamp = self.to_timestamp(until)
+
+        return self.to_timestamp(since), until_timestamp
+
+    @classmethod
+    def read_arrays(cls, db, config, channel_num, since=None, until=None, \
+    limit=None):
+        """Reads a channel's samples from the archive, blocks and samples table
+
+        :param channel_num: channel to read
+        :param since: earliest timestamp [ms], or None
+        :param until: latest timestamp [ms], or None
+        :param limit: maximum number of (earliest) samples to return, or None
+        :return: (timestamps, values) arrays, in time order
+        """
+
+        segments = []
+
+        # archived days come before the samples left in the database, and
+        # blocks before the samples table
+        channel_archive = archive.ChannelArchive.from_config(channel_num, \
+        config)
+
+        sources = [ChannelBlocks.get_segments(db, config, channel_num, since, \
+        until)]
+
+        if channel_archive is not None:
+            sources.insert(0, channel_archive.get_segments(since, until))
+
+        segment_count = 0
+
+        for source in sources:
+            for segment in source:
+                segments.append(segment)
+
+                segment_count += len(segment[0])
+
+                if limit is not None and segment_count >= limit:
+                    break
+
+            if limit is not None and segment_count >= limit:
+                break
+
+        # where clause
+        where = ["channel = $channel"]
+
+        if since is not None:
+            where.append("timestamp >= $since")
+
+        if until is not None:
+            where.append("timestamp <= $until")
+
+        sql = """
+            SELECT timestamp, value
+            FROM {0}
+            WHERE {1}
+            ORDER BY timestamp ASC
+        """.format(cls.TABLE_NAME, " AND ".join(where))
+
+        if limit is not None:
+            sql += "LIMIT $limit"
+
+        segments.append(db.query_arrays(sql, {"channel": channel_num, \
+        "since": since, "until": until, "limit": limit}, \
+        dtypes=(np.int64, np.int64)))
+
+        timestamps, values = archive.merge_segments(segments)
+
+        if limit is not None:
+            timestamps = timestamps[:limit]
+            values = values[:limit]
+
+        return timestamps, values
+
+    @classmethod
+    def read_matrix(cls, db, config, channel_nums, since=None, until=None):
+        """Reads several channels' samples aligned on their timestamps
+
+        The compressed blocks and samples table rows of every channel are
+        each read by a single query, rather than one per channel, and joined
+        on their timestamps with numpy.
+
+        :param channel_nums: channels to read, one column each
+        :param since: earliest timestamp [ms], or None
+        :param until: latest timestamp [ms], or None
+        :return: (timestamps, values) where values has a row per timestamp
+        and a column per channel, NaN where a channel has no sample at that
+        time
+        """
+
+        channel_nums = [int(channel_num) for channel_num in channel_nums]
+
+        if len(channel_nums) == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, 0))
+
+        # each channel's segments, archived days first
+        segments = dict([(channel_num, []) for channel_num in channel_nums])
+
+        for channel_num in channel_nums:
+            channel_archive = archive.ChannelArchive.from_config(channel_num, \
+            config)
+
+            if channel_archive is not None:
+                segments[channel_num].extend(channel_archive.get_segments( \
+                since, until))
+
+        for channel_num, timestamps, values in \
+        ChannelBlocks.get_channel_segments(db, config, channel_nums, since, \
+        until):
+            segments[channel_num].append((timestamps, values))
+
+        # where clause
+        where = ["channel IN $channels"]
+
+        if since is not None:
+            where.append("timestamp >= $since")
+
+        if until is not None:
+            where.append("timestamp <= $until")
+
+        # one range of the primary key per channel
+        channels, timestamps, values = db.query_arrays("""
+            SELECT channel, timestamp, value
+            FROM {0}
+            WHERE {1}
+            ORDER BY channel ASC, timestamp ASC
+        """.format(cls.TABLE_NAME, " AND ".join(where)), \
+        {"channels": channel_nums, "since": since, "until": until}, \
+        dtypes=(np.int64, np.int64, np.int64))
+
+        for channel_num in channel_nums:
+            start, end = np.searchsorted(channels, [channel_num, \
+            channel_num + 1])
+
+            segments[channel_num].append((timestamps[start:end], \
+            values[start:end]))
+
+        series = [archive.merge_segments(segments[channel_num]) \
+        for channel_num in channel_nums]
+
+        # every time any channel has a sample
+        times = np.unique(np.concatenate([channel_timestamps \
+        for channel_timestamps, channel_values in series]))
+
+        matrix = np.full((len(times), len(channel_nums)), np.nan)
+
+        for column, (channel_timestamps, channel_values) in enumerate(series):
+            matrix[np.searchsorted(times, channel_timestamps), column] = \
+            channel_values
+
+        return times.astype(np.int64), matrix
+
+    @classmethod
+    def read_readings(cls, db, config, channel_nums, since=None, until=None):
+        """Reconstructs readings from several channels' samples
+
+        Samples of the channels at the same time form one reading, as they
+        were logged.
+
+        See read_matrix for the arguments.
+
+        :return: list of readings, in time order
+        """
+
+        channel_nums = [int(channel_num) for channel_num in channel_nums]
+
+        times, matrix = cls.read_matrix(db, config, channel_nums, since, \
+        until)
+
+        present = ~np.isnan(matrix)
+
+        # values are stored as integers
+        rows = np.where(present, matrix, 0).astype(np.int64).tolist()
+        present = present.tolist()
+
+        readings = []
+
+        for timestamp, row, row_present in zip(times.tolist(), rows, present):
+            readings.append(Reading(timestamp, [channel_num for channel_num, \
+            is_present in zip(channel_nums, row_present) if is_present], \
+            [value for value, is_present in zip(row, row_present) \
+            if is_present]))
+
+        return readings
+
+    def _get_rollup_time_series(self, since_timestamp, until_timestamp, \
+    max_points):
+        """Returns the time series from the coarsest adequate summary level
+
+        :return: (timestamps, values) arrays, or None if even the finest level
+        is too coarse for max_points points in the specified range, or the
+        summaries don't cover every sample
+        """
+
+        rollups = ChannelRollups(self.channel.channel_num, self.db, \
+        self.config)
+
+        # plot extremes, taking two points per bucket, if spikes are wanted
+        extremes = self.get_downsample_method() == downsample.METHOD_MINMAX
+
+        # time between points
+        if until_timestamp is None:
+            span = self.datetime_to_timestamp(datetime.datetime.today()) \
+            - since_timestamp
+        else:
+            span = until_timestamp - since_timestamp
+
+        resolution = span / max_points
+
+        if extremes:
+            resolution *= 2
+
+        level = rollups.get_resolution_for(resolution)
+
+        if level is None or not rollups.is_complete():
+            return None
+
+        return rollups.get_time_series_arrays(since_timestamp, \
+        until_timestamp, level, extremes)
+
+    def get_time_series_js(self, *args, **kwargs):
+        # limit points to those that can be plotted by default
+        kwargs.setdefault('max_points', self.get_default_max_points())
+
+        return utils.arrays_to_js(*self.get_time_series_arrays(*args, \
+        **kwargs))
+
+    def get_last_time(self):
+        """Gets the time of this channel's last sample, or None"""
+
+        state = ChannelState.get(self.db, self.channel.channel_num)
+
+        if state is None:
+            return None
+
+        # return date object
+        return self.timestamp_to_datetime(state.last_timestamp)
+
+    def get_id(self):
+        """Returns an identifier for this stream, for use in URLs"""
+
+        return "{0}_{1}".format(self.stream_type, self.channel.channel_num)
+
+    def get_description(self):
+        """Returns a description string"""
+
+        return "{0} ({1})".format(self.channel.name, self.stream_type)
+
+class ChannelRollups(DatabaseModel):
+    """Represents the multi-resolution summaries of a channel's samples
+
+    Each level divides time into buckets of a fixed length, aligned to the
+    Unix epoch, and stores the count, sum, minimum and maximum of the samples
+    in each bucket. The finest level is computed from the samples and each
+    coarser level from the one below it, so bucket lengths must be multiples
+    of each other.
+    """
+
+    """Channel number"""
+    channel_num = None
+
+    """Table name"""
+    TABLE_NAME = "rollups"
+
+    """Default bucket lengths [ms]: 1 s, 10 s, 1 min, 15 min, 1 h, 1 day"""
+    DEFAULT_RESOLUTIONS = [1000, 10000, 60000, 900000, 3600000, 86400000]
+
+    def __init__(self, channel_num, *args, **kwargs):
+        super(ChannelRollups, self).__init__(*args, **kwargs)
+
+        self.channel_num = int(channel_num)
+
+    @classmethod
+    def init_schema(cls, db):
+        """Initialises the database schema"""
+
+        # create table if necessary
+        db.query("""
+            CREATE TABLE IF NOT EXISTS {0} (
+                channel INTEGER UNSIGNED NOT NULL,
+                resolution INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                total REAL NOT NULL,
+                minimum INTEGER NOT NULL,
+                maximum INTEGER NOT NULL,
+                PRIMARY KEY (channel, resolution, bucket)
+            )
+        """.format(cls.TABLE_NAME))
+
+    def get_resolutions(self):
+        """Returns the configured bucket lengths [ms], finest first"""
+
+        if self.config is not None \
+        and self.config.has_option('rollups', 'resolutions'):
+            resolutions = [int(resolution) for resolution \
+            in self.config.get('rollups', 'resolutions').split(',')]
+        else:
+            resolutions = self.DEFAULT_RESOLUTIONS
+
+        return sorted(resolutions)
+
+    def update(self, start, end, arrays=None):
+        """Recomputes the buckets covering the specified time range
+
+        Buckets are recomputed from their source rather than incremented, so
+        samples ignored as duplicates on insert are not counted twice. This
+        should be called within the transaction that inserted the samples.
+
+        :param start: earliest timestamp that changed [ms]
+        :param end: latest timestamp that changed [ms]
+        :param arrays: (timestamps, values) arrays holding every sample in the
+        finest buckets covering the range, summarised instead of the samples
+        table
+        """
+
+        source_resolution = None
+
+        for resolution in self.get_resolutions():
+            # range of this level's buckets containing the changes
+            bucket_start = int(start) // resolution * resolution
+            bucket_end = int(end) // resolution * resolution + resolution
+
+            if source_resolution is None and arrays is not None:
+                self._update_from_arrays(resolution, bucket_start, \
+                bucket_end, *arrays)
+            elif source_resolution is None:
+                # summarise samples
+                self.db.query("""
+                    INSERT OR REPLACE INTO {0}
+                    (channel, resolution, bucket, count, total, minimum, maximum)
+                    SELECT channel, $resolution,
+                    CAST(timestamp / $resolution AS INTEGER) * $resolution
+                    AS bucket, COUNT(*), SUM(value), MIN(value), MAX(value)
+                    FROM {1}
+                    WHERE channel = $channel AND timestamp >= $start
+                    AND timestamp < $end
+                    GROUP BY bucket
+                """.format(self.TABLE_NAME, ChannelSamples.TABLE_NAME), \
+                {"channel": self.channel_num, "resolution": resolution, \
+                "start": bucket_start, "end": bucket_end})
+            else:
+                # summarise the finer level
+                self.db.query("""
+                    INSERT OR REPLACE INTO {0}
+                    (channel, resolution, bucket, count, total, minimum, maximum)
+                    SELECT channel, $resolution,
+                    bucket / $resolution * $resolution AS coarse_bucket,
+                    SUM(count), SUM(total), MIN(minimum), MAX(maximum)
+                    FROM {0}
+                    WHERE channel = $channel AND resolution = $source
+                    AND bucket >= $start AND bucket < $end
+                    GROUP BY coarse_bucket
+                """.format(self.TABLE_NAME), {"channel": self.channel_num, \
+                "resolution": resolution, "source": source_resolution, \
+                "start": bucket_start, "end": bucket_end})
+
+            source_resolution = resolution
+
+    def update_samples(self, timestamps, last_timestamp):
+        """Recomputes the buckets containing newly inserted samples
+
+        Samples after the previous latest sample are summarised from the
+        samples table, as older samples are compacted or archived only once
+        later ones arrive. The buckets of late samples may also hold compacted
+        or archived samples, so they are summarised from every source, in runs
+        of buckets no further apart than the coarsest bucket length. This
+        should be called within the transaction that inserted the samples.
+
+        :param timestamps: times of the inserted samples [ms]
+        :param last_timestamp: latest sample stored before the insert [ms], or
+        None if there was none
+        """
+
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+
+        if len(timestamps) == 0:
+            return
+
+        if last_timestamp is None:
+            late = np.zeros(len(timestamps), dtype=bool)
+        else:
+            late = timestamps <= last_timestamp
+
+        new_timestamps = timestamps[~late]
+
+        if len(new_timestamps) > 0:
+            self.update(new_timestamps.min(), new_timestamps.max())
+
+        late_timestamps = np.unique(timestamps[late])
+
+        if len(late_timestamps) == 0:
+            return
+
+        resolutions = self.get_resolutions()
+
+        # divide the late samples where they are far apart
+        breaks = np.flatnonzero(np.diff(late_timestamps) > resolutions[-1]) + 1
+
+        for run in np.split(late_timestamps, breaks):
+            # every sample in the run's finest buckets
+            since = int(run[0]) // resolutions[0] * resolutions[0]
+            until = int(run[-1]) // resolutions[0] * resolutions[0] \
+            + resolutions[0] - 1
+
+            self.update(since, until, ChannelSamples.read_arrays(self.db, \
+            self.config, self.channel_num, since=since, until=until))
+
+    def _update_from_arrays(self, resolution, start, end, timestamps, values):
+        """Recomputes buckets between start and end from sample arrays
+
+        :param timestamps: time ordered timestamps [ms]
+        :param values: values
+        """
+
+        in_range = (timestamps >= start) & (timestamps < end)
+        timestamps = timestamps[in_range]
+        values = values[in_range]
+
+        self.db.delete(self.TABLE_NAME, where="channel = $channel \
+AND resolution = $resolution AND bucket >= $start AND bucket < $end", \
+        vars={"channel": self.channel_num, "resolution": resolution, \
+        "start": start, "end": end})
+
+        if len(timestamps) == 0:
+            return
+
+        buckets = timestamps // resolution * resolution
+
+        # index of each bucket's first sample
+        firsts = np.flatnonzero(np.concatenate(([True], \
+        buckets[1:] != buckets[:-1])))
+
+        counts = np.diff(np.append(firsts, len(timestamps)))
+        totals = np.add.reduceat(values.astype(np.float64), firsts)
+        minima = np.minimum.reduceat(values, firsts)
+        maxima = np.maximum.reduceat(values, firsts)
+
+        self.db.insert_many(self.TABLE_NAME, ("channel", "resolution", \
+        "bucket", "count", "total", "minimum", "maximum"), \
+        zip([self.channel_num] * len(firsts), [resolution] * len(firsts), \
+        buckets[firsts].tolist(), counts.tolist(), totals.tolist(), \
+        minima.tolist(), maxima.tolist()))
+
+    def rebuild(self):
+        """Recomputes every bucket from the archive, blocks and samples table
+
+        Samples are read a bucket of the coarsest level at a time, skipping
+        the time between them.
+        """
+
+        span = self.get_resolutions()[-1]
+
+        with self.db.transaction():
+            self.db.delete(self.TABLE_NAME, where="channel = $channel", \
+            vars={"channel": self.channel_num})
+
+            since = None
+
+            while True:
+                # next sample to summarise
+                timestamps, values = ChannelSamples.read_arrays(self.db, \
+                self.config, self.channel_num, since=since, limit=1)
+
+                if len(timestamps) == 0:
+                    break
+
+                since = int(timestamps[0]) // span * span
+
+                self.update(since, since + span - 1, \
+                ChannelSamples.read_arrays(self.db, self.config, \
+                self.channel_num, since=since, until=since + span - 1))
+
+                since += span
+
+    def is_complete(self):
+        """Returns whether the buckets cover every sample in the database
+
+        Samples stored before summaries were kept, or inserted other than by
+        write_rows, have no buckets until rebuild is run. Buckets also cover
+        archived samples, which the channel's sample count leaves out, so
+        complete buckets count at least as many samples.
+        """
+
+        state = ChannelState.get(self.db, self.channel_num)
+
+        if state is None:
+            return True
+
+        count = self.db.query("""
+            SELECT SUM(count) AS count
+            FROM {0}
+            WHERE channel = $channel AND resolution = $resolution
+        """.format(self.TABLE_NAME), {"channel": self.channel_num, \
+        "resolution": self.get_resolutions()[-1]})[0].count or 0
+
+        return count >= state.sample_count
+
+    def get_resolution_for(self, resolution):
+        """Returns the coarsest bucket length no longer than resolution
+
+        :param resolution: requested time between points [ms]
+        :return: bucket length [ms], or None if resolution is finer than the
+        finest level
+        """
+
+        suitable = [level for level in self.get_resolutions() \
+        if level <= resolution]
+
+        if len(suitable) > 0:
+            return suitable[-1]
+
+        return None
+
+    def get_time_series_arrays(self, since_timestamp, until_timestamp, \
+    resolution, extremes=False):
+        """Returns bucket summaries between the specified times
+
+        :param since_timestamp: earliest time [ms]
+        :param until_timestamp: latest time [ms], or None
+        :param resolution: bucket length [ms], one of the configured levels
+        :param extremes: if True, each bucket gives its minimum and maximum as
+        two points; otherwise it gives its mean
+        :return: (timestamps, values) arrays
+        """
+
+        # where clause
+        where = ["channel = $channel", "resolution = $resolution", \
+        "bucket >= $since"]
+
+        if until_timestamp is not None:
+            where.append("bucket <= $until")
+
+        buckets, counts, totals, minima, maxima = self.db.query_arrays("""
+            SELECT bucket, count, total, minimum, maximum
+            FROM {0}
+            WHERE {1}
+            ORDER BY bucket ASC
+        """.format(self.TABLE_NAME, " AND ".join(where)), \
+        {"channel": self.channel_num, "resolution": resolution, \
+        "since": int(since_timestamp) // resolution * resolution, \
+        "until": until_timestamp}, dtypes=(np.int64, np.int64, np.float64, \
+        np.int64, np.int64))
+
+        if not extremes:
+            return buckets, totals / counts
+
+        # bracket each bucket with its extremes
+        timestamps = np.empty(2 * len(buckets), dtype=np.int64)
+        timestamps[0::2] = buckets
+        timestamps[1::2] = buckets + resolution - 1
+
+        values = np.empty(2 * len(buckets), dtype=np.int64)
+        values[0::2] = minima
+        values[1::2] = maxima
+
+        return timestamps, values
+
+class ChannelBlocks(DatabaseModel):
+    """Represents a channel's older samples, compressed into blocks
+
+    Samples are written to the samples table. Once older than the [blocks]
+    keep period, each span of a channel's samples is moved into one row
+    holding them encoded by the blocks module, with their count, time range
+    and extremes. Reads combine the blocks with the samples table. A sample
+    written late into a span already compacted stays in the samples table
+    until the next compaction merges it into the span's block.
+    """
+
+    """Channel number"""
+    channel_num = None
+
+    """Table name"""
+    TABLE_NAME = "sample_blocks"
+
+    """Default time span of each block [ms]"""
+    DEFAULT_SPAN = 3600000
+
+    """Default time newer samples are left uncompressed [ms]"""
+    DEFAULT_KEEP = 86400000
+
+    def __init__(self, channel_num, *args, **kwargs):
+        super(ChannelBlocks, self).__init__(*args, **kwargs)
+
+        self.channel_num = int(channel_num)
+
+    @classmethod
+    def init_schema(cls, db):
+        """Initialises the database schema"""
+
+        db.query("""
+            CREATE TABLE IF NOT EXISTS {0} (
+                channel INTEGER UNSIGNED NOT NULL,
+                start INTEGER NOT NULL,
+                first_timestamp INTEGER NOT NULL,
+                last_timestamp INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                minimum INTEGER NOT NULL,
+                maximum INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (channel, start)
+            ) WITHOUT ROWID
+        """.format(cls.TABLE_NAME))
+
+    @classmethod
+    def get_span(cls, config):
+        """Returns the configured block span [ms]
+
+        :raises Exception: if the span doesn't divide a day, as archived days
+        must consist of whole blocks
+        """
+
+        span = cls.DEFAULT_SPAN
+
+        if config is not None and config.has_option('blocks', 'span'):
+            span = config.getint('blocks', 'span')
+
+        if span <= 0 or archive.DAY % span != 0:
+            raise Exception("Block span must divide a day")
+
+        return span
+
+    @classmethod
+    def get_segments(cls, db, config, channel_num, since=None, until=None):
+        """Yields a channel's compressed samples within a time range
+
+        :param since: earliest timestamp [ms], or None
+        :param until: latest timestamp [ms], or None
+        :return: generator of (timestamps, values) arrays, a block at a time
+        """
+
+        for channel_num, timestamps, values in cls.get_channel_segments(db, \
+        config, [channel_num], since, until):
+            yield timestamps, values
+
+    @classmethod
+    def remove_compacted(cls, db, config, channel_num, rows):
+        """Removes sample rows already stored in a channel's blocks
+
+        Samples in the samples table repeating one in a block would be merged
+        away at the next compaction, but counted as new until then. Only rows
+        no later than the channel's latest block are looked up, each block
+        containing one being decoded once.
+
+        :param rows: list of (channel, timestamp, value) rows of the channel
+        :return: list of the rows whose timestamps aren't in a block
+        """
+
+        last_timestamp = db.select_single_cell(cls.TABLE_NAME, \
+        {"channel": channel_num}, what="last_timestamp", \
+        where="channel = $channel", order="start DESC")
+
+        if last_timestamp is None:
+            return rows
+
+        timestamps = np.array([row[1] for row in rows], dtype=np.int64)
+        late = timestamps <= last_timestamp
+
+        if not late.any():
+            return rows
+
+        span = cls.get_span(config)
+        stored = []
+
+        for start in np.unique(timestamps[late] // span * span).tolist():
+            data = db.select_single_cell(cls.TABLE_NAME, \
+            {"channel": channel_num, "start": start}, what="data", \
+            where="channel = $channel AND start = $start")
+
+            if data is not None:
+                stored.append(blocks.decode(data)[0])
+
+        if len(stored) == 0:
+            return rows
+
+        keep = ~np.in1d(timestamps, np.concatenate(stored))
+
+        return [row for row, is_kept in zip(rows, keep.tolist()) if is_kept]
+
+    @classmethod
+    def get_channel_segments(cls, db, config, channel_nums, since=None, \
+    until=None):
+        """Yields several channels' compressed samples from one query
+
+        :param channel_nums: channels to read
+        :param since: earliest timestamp [ms], or None
+        :param until: latest timestamp [ms], or None
+        :return: generator of (channel number, timestamps, values), a block
+        at a time, in channel and then time order
+        """
+
+        # blocks are found by their start time, on the primary key
+        where = ["channel IN $channels"]
+
+        if since is not None:
+            where.append("start >= $first_start")
+
+        if until is not None:
+            where.append("start <= $until")
+
+        first_start = None
+
+        if since is not None:
+            first_start = int(since) // cls.get_span(config) \
+            * cls.get_span(config)
+
+        for row in db.query("""
+            SELECT channel, first_timestamp, last_timestamp, data
+            FROM {0}
+            WHERE {1}
+            ORDER BY channel ASC, start ASC
+        """.format(cls.TABLE_NAME, " AND ".join(where)), \
+        {"channels": [int(channel_num) for channel_num in channel_nums], \
+        "first_start": first_start, "until": until}).list():
+            if since is not None and row.last_timestamp < since:
+                continue
+
+            if until is not None and row.first_timestamp > until:
+                continue
+
+            timestamps, values = blocks.decode(row.data)
+
+            # slice to the range
+            start = 0
+            end = len(timestamps)
+
+            if since is not None:
+                start = np.searchsorted(timestamps, since, side="left")
+
+            if until is not None:
+                end = np.searchsorted(timestamps, until, side="right")
+
+            if end > start:
+                yield row.channel, timestamps[start:end], values[start:end]
+
+    def compact(self, until, pause=0):
+        """Moves the samples before a time from the samples table to blocks
+
+        Each block is written in its own transaction.
+
+        :param until: samples before the start of the block containing this
+        time are compacted [ms]
+        :param pause: time to wait between blocks, letting writers in [s]
+        :return: (number of blocks written, number of samples compacted)
+        """
+
+        span = self.get_span(self.config)
+        until = int(until) // span * span
+
+        block_count = 0
+        sample_count = 0
+
+        while True:
+            # oldest sample left to compact
+            first = self.db.select_single_cell(ChannelSamples.TABLE_NAME, \
+            {"channel": self.channel_num, "until": until}, what="timestamp", \
+            where="channel = $channel AND timestamp < $until", \
+            order="timestamp ASC")
+
+            if first is None:
+                break
+
+            with self.db.transaction():
+                sample_count += self._compact_span(int(first) // span * span, \
+                span)
+
+            # merging may have corrected the sample count
+            ChannelState.invalidate_cache()
+
+            block_count += 1
+
+            if pause > 0:
+                time.sleep(pause)
+
+        return block_count, sample_count
+
+    def _compact_span(self, start, span):
+        """Moves one span's samples into its block
+
+        This should be called within a transaction.
+
+        :return: number of samples moved
+        """
+
+        vars = {"channel": self.channel_num, "start": start, \
+        "end": start + span}
+
+        timestamps, values = self.db.query_arrays("""
+            SELECT timestamp, value
+            FROM {0}
+            WHERE channel = $channel AND timestamp >= $start
+            AND timestamp < $end
+            ORDER BY timestamp ASC
+        """.format(ChannelSamples.TABLE_NAME), vars, \
+        dtypes=(np.int64, np.int64))
+
+        existing = self.db.select_single_cell(self.TABLE_NAME, vars, \
+        what="data", where="channel = $channel AND start = $start")
+
+        if existing is not None:
+            existing = blocks.decode(existing)
+
+            # merge samples written late, keeping those already in the block
+            block_timestamps, block_values = archive.merge_segments( \
+            [existing, (timestamps, values)])
+        else:
+            block_timestamps, block_values = timestamps, values
+
+        self.db.query("""
+            INSERT OR REPLACE INTO {0}
+            (channel, start, first_timestamp, last_timestamp, count, minimum,
+            maximum, data)
+            VALUES ($channel, $start, $first, $last, $count, $minimum,
+            $maximum, $data)
+        """.format(self.TABLE_NAME), dict(vars, \
+        first=int(block_timestamps[0]), last=int(block_timestamps[-1]), \
+        count=len(block_timestamps), minimum=int(block_values.min()), \
+        maximum=int(block_values.max()), \
+        data=buffer(blocks.encode(block_timestamps, block_values))))
+
+        self.db.delete(ChannelSamples.TABLE_NAME, where="channel = $channel \
+AND timestamp >= $start AND timestamp < $end", vars=vars)
+
+        if existing is not None:
+            # the summaries of the late samples were computed without the
+            # block's samples
+            ChannelRollups(self.channel_num, self.db, self.config).update( \
+            timestamps[0], timestamps[-1], (block_timestamps, block_values))
+
+            # late samples repeating a time in the block were counted on
+            # insert, but are dropped
+            duplicate_count = len(existing[0]) + len(timestamps) \
+            - len(block_timestamps)
+
+            if duplicate_count > 0:
+                ChannelState.remove(self.db, self.channel_num, duplicate_count)
+
+        return len(timestamps)
+
+    def delete_before(self, limit, max_blocks):
+        """Deletes the oldest blocks ending before a time
+
+        The channel's sample count is reduced in the same transaction.
+
+        :param limit: time before which blocks' samples all lie [ms]
+        :param max_blocks: maximum number of blocks to delete
+        :return: number of samples deleted
+        """
+
+        vars = {"channel": self.channel_num, "limit": limit}
+
+        with self.db.transaction():
+            starts = [row.start for row in self.db.select(self.TABLE_NAME, \
+            vars, what="start", where="channel = $channel \
+AND last_timestamp < $limit", order="start ASC", limit=max_blocks)]
+
+            if len(starts) == 0:
+                return 0
+
+            vars.update(first=starts[0], last=starts[-1])
+
+            where = "channel = $channel AND start >= $first AND start <= $last \
+AND last_timestamp < $limit"
+
+            count = self.db.query("""
+                SELECT SUM(count) AS count
+                FROM {0}
+                WHERE {1}
+            """.format(self.TABLE_NAME, where), vars)[0].count
+
+            self.db.delete(self.TABLE_NAME, where=where, vars=vars)
+
+            ChannelState.remove(self.db, self.channel_num, count)
+
+        ChannelState.invalidate_cache()
+
+        return count
+
+    @classmethod
+    def get_stats(cls, db):
+        """Returns the number of blocks, samples they hold and their size"""
+
+        row = db.query("""
+            SELECT COUNT(*) AS blocks, COALESCE(SUM(count), 0) AS samples,
+            COALESCE(SUM(LENGTH(data)), 0) AS bytes
+            FROM {0}
+        """.format(cls.TABLE_NAME))[0]
+
+        return {"blocks": row.blocks, "samples": row.samples, \
+        "bytes": row.bytes}
+
+class ChannelState(DatabaseModel):
+    """Represents the latest sample and sample count of each channel
+
+    The table is updated in the same transaction as the samples, so a
+    channel's watermark is found without searching the samples. The states
+    are also cached in memory once read.
+    """
+
+    """Table name"""
+    TABLE_NAME = "channel_state"
+
+    """Cached states by channel number, or None if not yet read"""
+    _cache = None
+
+    """Lock for the cache"""
+    _cache_lock = threading.Lock()
+
+    """Whether states are cached; writes by other processes don't update the
+    cache, so it is turned off when several processes write"""
+    cache_enabled = True
+
+    @classmethod
+    def init_schema(cls, db):
+        """Initialises the database schema
+
+        A new table is filled from the samples already stored.
+        """
+
+        exists = db.select_single_cell("sqlite_master", \
+        {"name": cls.TABLE_NAME}, what="name", \
+        where="type = 'table' AND name = $name") is not None
+
+        if exists:
+            return
+
+        db.query("""
+            CREATE TABLE {0} (
+                channel INTEGER UNSIGNED NOT NULL PRIMARY KEY,
+                last_timestamp INTEGER,
+                sample_count INTEGER NOT NULL,
+                last_value INTEGER
+            )
+        """.format(cls.TABLE_NAME))
+
+        cls.rebuild(db)
+
+    @classmethod
+    def rebuild(cls, db):
+        """Recomputes every channel's state from the samples and blocks
+
+        Samples already moved to the archive are not counted.
+        """
+
+        with db.transaction():
+            db.delete(cls.TABLE_NAME, where="1")
+
+            db.query("""
+                INSERT INTO {0} (channel, last_timestamp, sample_count)
+                SELECT channel, MAX(last_timestamp), SUM(sample_count)
+                FROM (
+                    SELECT channel, MAX(timestamp) AS last_timestamp,
+                    COUNT(*) AS sample_count
+                    FROM {1}
+                    GROUP BY channel
+                    UNION ALL
+                    SELECT channel, MAX(last_timestamp), SUM(count)
+                    FROM {2}
+                    GROUP BY channel
+                )
+                GROUP BY channel
+            """.format(cls.TABLE_NAME, ChannelSamples.TABLE_NAME, \
+            ChannelBlocks.TABLE_NAME))
+
+            # the latest sample is normally in the samples table
+            db.query("""
+                UPDATE {0}
+                SET last_value = (
+                    SELECT value
+                    FROM {1}
+                    WHERE channel = {0}.channel
+                    AND timestamp = {0}.last_timestamp
+                )
+            """.format(cls.TABLE_NAME, ChannelSamples.TABLE_NAME))
+
+        cls.invalidate_cache()
+
+    @classmethod
+    def update(cls, db, channel_num, count, timestamp, value):
+        """Records new samples of a channel
+
+        This doesn't start a transaction, so it is part of the caller's.
+
+        :param count: number of samples inserted
+        :param timestamp: time of the latest sample written [ms]
+        :param value: value of the latest sample written
+        """
+
+        db.query("""
+            INSERT OR IGNORE INTO {0} (channel, sample_count)
+            VALUES ($channel, 0)
+        """.format(cls.TABLE_NAME), vars={"channel": channel_num})
+
+        # as in the samples table, an existing sample at the same time is kept
+        db.query("""
+            UPDATE {0}
+            SET last_value = CASE
+                WHEN last_timestamp IS NULL OR $timestamp > last_timestamp
+                THEN $value ELSE last_value END,
+            last_timestamp = CASE
+                WHEN last_timestamp IS NULL OR $timestamp > last_timestamp
+                THEN $timestamp ELSE last_timestamp END,
+            sample_count = sample_count + $count
+            WHERE channel = $channel
+        """.format(cls.TABLE_NAME), vars={"channel": channel_num, \
+        "count": count, "timestamp": timestamp, "value": value})
+
+    @classmethod
+    def remove(cls, db, channel_num, count):
+        """Records the deletion of old samples of a channel
+
+        The latest sample is not affected. This doesn't start a transaction,
+        so it is part of the caller's; invalidate the cache once it commits.
+
+        :param count: number of samples deleted
+        """
+
+        db.query("""
+            UPDATE {0}
+            SET sample_count = MAX(0, sample_count - $count)
+            WHERE channel = $channel
+        """.format(cls.TABLE_NAME), vars={"channel": channel_num, \
+        "count": count})
+
+    @classmethod
+    def update_cache(cls, channel_num, count, timestamp, value):
+        """Applies an update to the cached state, once it is committed
+
+        See update for the arguments.
+        """
+
+        with cls._cache_lock:
+            if cls._cache is None:
+                return
+
+            state = cls._cache.setdefault(channel_num, \
+            web.utils.storage(channel=channel_num, last_timestamp=None, \
+            sample_count=0, last_value=None))
+
+            if state.last_timestamp is None or timestamp > state.last_timestamp:
+                state.last_timestamp = timestamp
+                state.last_value = value
+
+            state.sample_count += count
+
+    @classmethod
+    def invalidate_cache(cls):
+        """Discards the cached states, so they are read again"""
+
+        with cls._cache_lock:
+            cls._cache = None
+
+    @classmethod
+    def get_all(cls, db):
+        """Returns every channel's state
+
+        :return: dict of channel number to state, with channel,
+        last_timestamp, sample_count and last_value
+        """
+
+        if not cls.cache_enabled:
+            return dict([(row.channel, row) \
+            for row in db.select(cls.TABLE_NAME)])
+
+        with cls._cache_lock:
+            if cls._cache is None:
+                cls._cache = dict([(row.channel, row) \
+                for row in db.select(cls.TABLE_NAME)])
+
+            # copy, as the cached states change with each write
+            return dict([(channel_num, web.utils.storage(state)) \
+            for channel_num, state in cls._cache.iteritems()])
+
+    @classmethod
+    def get(cls, db, channel_num):
+        """Returns a channel's state, or None if it has no samples"""
+
+        return cls.get_all(db).get(channel_num)
+
+    @classmethod
+    def watch(cls, db, interval, callback):
+        """Reports channels given new samples by any process
+
+        Polls each channel's latest sample time, and doesn't return.
+
+        :param interval: time between polls [ms]
+        :param callback: function called with a list of the channels whose
+        latest sample changed
+        """
+
+        last_timestamps = {}
+
+        while True:
+            changed = []
+
+            for row in db.select(cls.TABLE_NAME, \
+            what="channel, last_timestamp"):
+                if last_timestamps.get(row.channel) != row.last_timestamp:
+                    last_timestamps[row.channel] = row.last_timestamp
+                    changed.append(row.channel)
+
+            if len(changed) > 0:
+                callback(changed)
+
+            time.sleep(interval / 1000.0)
+
+class ChannelSampleTrends(DatabaseModel):
+    """Represents a data trend for a magnetometer data structure"""
+
+    """Channel"""
+    channel = None
+
+    """Stream type"""
+    stream_type = None
+
+    """Window"""
+    window = None
+
+    """Key"""
+    key = None
+
+    """Time average [ms]"""
+    timestamp_avg = None
+
+    """Trend progress table name"""
+    STATE_TABLE_NAME = "trend_state"
+
+    """Table of trends being filled by backfill.py, and the process doing so"""
+    BACKFILL_TABLE_NAME = "trend_backfill"
+
+    def __init__(self, channel, stream_type, window, key, timestamp_avg, *args, \
+    **kwargs):
+        # initialise parent
+        super(ChannelSampleTrends, self).__init__(*args, **kwargs)
+
+        # set channel
+        self.channel = channel
+
+        self.stream_type = stream_type
+
+        self.window = window
+
+        # set key
+        self.key = key
+
+        # set time average
+        self.timestamp_avg = int(timestamp_avg)
+
+    def init_schema(self):
+        """Initialises the database schema"""
+
+        # create progress table if necessary
+        self.init_state_schema(self.db)
+
+        # create table
+        ChannelSamples.create_table(self.db, self._table_name())
+
+    def delete(self):
+        """Deletes this trend"""
+
+        # make sure the progress table exists for older databases
+        self.init_state_schema(self.db)
+
+        # delete
+        with self.db.transaction():
+            self.db.query("""
+                DROP TABLE {0}
+            """.format(self._table_name()))
+
+            # forget progress
+            self.db.delete(self.STATE_TABLE_NAME, where="trend = $trend", \
+            vars={"trend": self._table_name()})
+
+            self.db.delete(self.BACKFILL_TABLE_NAME, where="trend = $trend", \
+            vars={"trend": self._table_name()})
+
+    def _table_name(self):
+        """Returns the table name"""
+
+        return "{0}_trend_{1}_{2}".format(\
+        str(ChannelSamples.TABLE_NAME), self.channel.channel_num, self.timestamp_avg)
+
+    def _add_trend_data(self, times, values):
+        """Adds the trend data specified as times and values to the table
+
+        This should be called within a transaction.
+        """
+
+        # rows as (channel, timestamp, value)
+        rows = [(self.channel.channel_num, time, value) \
+        for time, value in zip(times, values)]
+
+        # add data, returning number of rows inserted
+        return self.db.insert_many(self._table_name(), \
+        ("channel", "timestamp", "value"), rows)
+
+    @classmethod
+    def init_state_schema(cls, db):
+        """Initialises the schema holding each trend's progress
+
+        For each trend table, this stores the timestamp of the last raw sample
+        consumed and the count and sum of the samples in the (incomplete)
+        window it belongs to.
+        """
+
+        db.query("""
+            CREATE TABLE IF NOT EXISTS {0} (
+                trend TEXT NOT NULL PRIMARY KEY,
+                last_timestamp INTEGER NOT NULL,
+                partial_count INTEGER NOT NULL,
+                partial_total REAL NOT NULL
+            )
+        """.format(cls.STATE_TABLE_NAME))
+
+        db.query("""
+            CREATE TABLE IF NOT EXISTS {0} (
+                trend TEXT NOT NULL PRIMARY KEY,
+                pid INTEGER NOT NULL
+            )
+        """.format(cls.BACKFILL_TABLE_NAME))
+
+    def get_backfill_pid(self):
+        """Returns the process filling this trend, or None
+
+        A mark left by a process that has stopped is ignored.
+        """
+
+        pid = self.db.select_single_cell(self.BACKFILL_TABLE_NAME, \
+        {"trend": self._table_name()}, what="pid", where="trend = $trend")
+
+        if pid is None:
+            return None
+
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                # stopped without removing its mark
+                return None
+
+        return pid
+
+    def _check_not_backfilling(self):
+        """Raises TrendBackfillingException if another process fills this trend
+        """
+
+        pid = self.get_backfill_pid()
+
+        if pid is not None and pid != os.getpid():
+            raise TrendBackfillingException("Trend {0} is being backfilled by \
+process {1}".format(self.get_id(), pid))
+
+    def start_backfill(self):
+        """Marks this trend as being filled by this process
+
+        Trend updates leave a marked trend alone until the mark is removed.
+
+        :return: False if another process is already filling the trend
+        """
+
+        with self.db.transaction():
+            # wait for any trend update in progress to commit
+            self.db.begin_write()
+
+            pid = self.get_backfill_pid()
+
+            if pid is not None and pid != os.getpid():
+                return False
+
+            self.db.query("""
+                INSERT OR REPLACE INTO {0} (trend, pid) VALUES ($trend, $pid)
+            """.format(self.BACKFILL_TABLE_NAME), \
+            {"trend": self._table_name(), "pid": os.getpid()})
+
+        return True
+
+    def end_backfill(self):
+        """Removes this process's backfill mark from this trend"""
+
+        self.db.delete(self.BACKFILL_TABLE_NAME, \
+        vars={"trend": self._table_name(), "pid": os.getpid()}, \
+        where="trend = $trend AND pid = $pid")
+
+    def _get_trend_state(self):
+        """Returns the stored trend progress
+
+        Trends computed before progress was stored continue from their last
+        trend point.
+        """
+
+        state = self.db.select_single_row(self.STATE_TABLE_NAME, \
+        {"trend": self._table_name()}, where="trend = $trend")
+
+        if state is None:
+            # continue after the last trend point, if there is one
+            last_timestamp = self.db.select_single_cell(self._table_name(), \
+            what="timestamp", order="timestamp DESC")
+
+            if last_timestamp is None:
+                last_timestamp = -1
+
+            state = web.utils.storage(last_timestamp=last_timestamp, \
+            partial_count=0, partial_total=0)
+
+        return state
+
+    def _set_trend_state(self, state):
+        """Stores the trend progress"""
+
+        self.db.query("""
+            INSERT OR REPLACE INTO {0}
+            (trend, last_timestamp, partial_count, partial_total)
+            VALUES ($trend, $last_timestamp, $partial_count, $partial_total)
+        """.format(self.STATE_TABLE_NAME), {"trend": self._table_name(), \
+        "last_timestamp": int(state.last_timestamp), \
+        "partial_count": int(state.partial_count), \
+        "partial_total": float(state.partial_total)})
+
+    def update_trends(self, max_rows=1000):
+        """Updates the trends based on new data since latest computed trend
+
+        At most max_rows raw samples are read per call. Samples in a window
+        that is not yet complete are kept as a partial count and sum, so each
+        raw sample is read only once whatever the value of max_rows.
+        """
+
+        # make sure the progress table exists for older databases
+        self.init_state_schema(self.db)
+
+        try:
+            sample_count, insert_count = self._update_trends(max_rows)
+        except (NoDataForTrendsException, TrendBackfillingException) as e:
+            # no data available, so return 0 as the number of new trend points
+            print e
+            return 0
+
+        # return the number of new trend points
+        return insert_count
+
+    def catch_up(self, max_rows=1000):
+        """Updates the trends until every stored sample has been used
+
+        The state table must already exist.
+
+        :param max_rows: maximum number of samples read per transaction
+        :return: number of new trend points
+        """
+
+        total_insert_count = 0
+
+        while True:
+            try:
+                sample_count, insert_count = self._update_trends(max_rows)
+            except (NoDataForTrendsException, TrendBackfillingException):
+                break
+
+            total_insert_count += insert_count
+
+            # fewer samples than requested means there are no more
+            if sample_count < int(max_rows):
+                break
+
+        return total_insert_count
+
+    def _update_trends(self, max_rows):
+        """Updates the trends using at most max_rows new samples
+
+        :return: (number of samples read, number of new trend points)
+        :raises NoDataForTrendsException: if there are no new samples
+        :raises TrendBackfillingException: if the trend is being backfilled
+        """
+
+        self._check_not_backfilling()
+
+        state = self._get_trend_state()
+
+        # fetch unaveraged samples after the last one used
+        times, values = ChannelSamples.read_arrays(self.db, self.config, \
+        self.channel.channel_num, since=int(state.last_timestamp) + 1, \
+        limit=int(max_rows))
+
+        values = values.astype(np.float64)
+
+        last_timestamp = state.last_timestamp
+
+        # calculate trends
+        trend_times, trend_values, state = self._calculate_trends(times, \
+        values, self.timestamp_avg, state)
+
+        # insert into database along with the new progress
+        with self.db.transaction():
+            # a backfill may have started, or moved the progress on, since the
+            # state was read; holding the write lock stops either until commit
+            self.db.begin_write()
+            self._check_not_backfilling()
+
+            if self._get_trend_state().last_timestamp != last_timestamp:
+                # another update got here first, so discard these points
+                return 0, 0
+
+            insert_count = self._add_trend_data(trend_times.tolist(), \
+            trend_values.tolist())
+
+            self._set_trend_state(state)
+
+        metrics.trend_points.inc(insert_count)
+
+        return len(times), insert_count
+
+    @staticmethod
+    def _calculate_trends(times, values, timestamp_avg, state):
+        """Computes trends for new samples, continuing from a stored state
+
+        Trend windows are consecutive spans of timestamp_avg ms aligned to the
+        Unix epoch. Each complete window gives one trend point: the mean of its
+        samples, at the time of its last sample. A window is complete once a
+        sample in a later window has been seen.
+
+        :param times: array of sample timestamps, in ascending order
+        :param values: array of sample values
+        :param timestamp_avg: window length [ms]
+        :param state: progress with last_timestamp, partial_count and
+        partial_total of the window containing the last consumed sample
+        :return: trend times, trend values and the new state
+        :raises NoDataForTrendsException: if there are no new samples
+        """
+
+        if len(times) == 0:
+            raise NoDataForTrendsException("No new samples to compute trends \
+from.")
+
+        # window of each sample
+        windows = times // timestamp_avg
+
+        # find where each window starts
+        unique_windows = np.unique(windows)
+        starts = np.searchsorted(times, unique_windows * timestamp_avg)
+
+        # window sums, counts and the time of their last sample
+        totals = np.add.reduceat(values, starts)
+        counts = np.diff(np.append(starts, len(times)))
+        last_times = times[np.append(starts[1:], len(times)) - 1]
+
+        if state.partial_count > 0:
+            if state.last_timestamp // timestamp_avg == unique_windows[0]:
+                # continue the stored window
+                totals[0] += state.partial_total
+                counts[0] += state.partial_count
+            else:
+                # the stored window is now complete, so add it first
+                totals = np.insert(totals, 0, state.partial_total)
+                counts = np.insert(counts, 0, state.partial_count)
+                last_times = np.insert(last_times, 0, state.last_timestamp)
+
+        # the last window may still receive samples, so keep it as the state
+        new_state = web.utils.storage(last_timestamp=int(times[-1]), \
+        partial_count=int(counts[-1]), partial_total=float(totals[-1]))
+
+        return last_times[:-1], totals[:-1] / counts[:-1], new_state
+
+    def get_last_trend_time(self):
+        """Fetches the time of the last computed trend"""
+
+        # get timestamp, in ms
+        timestamp = self.db.select_single_cell(self._table_name(), \
+        what="timestamp", order="timestamp DESC")
+
+        # return date object
+        return self.timestamp_to_datetime(timestamp)
+
+    def get_time_series(self, since=None, until=None, max_points=None):
+        """Returns time series for this channel trend
+
+        See get_time_series_arrays for the arguments.
+
+        :return: list of [timestamp, value] pairs
+        """
+
+        return self._arrays_to_series(*self.get_time_series_arrays(since, \
+        until, max_points))
+
+    def get_time_series_arrays(self, since=None, until=None, max_points=None):
+        """Returns time series for this channel trend as arrays
+
+        :param since: datetime or ms timestamp to return trend points from
+        (default the start of the stream's window)
+        :param until: datetime or ms timestamp to return trend points up to
+        :param max_points: if specified, the series is downsampled to at most
+        this many points
+        :return: (timestamps, values) arrays
+        """
+
+        chunks = list(self.iter_time_series_arrays(since, until, \
+        chunk_size=None))
+
+        if len(chunks) == 0:
+            return self._empty_arrays()
+
+        # reduce to the number of points that can be shown
+        return self._downsample_arrays(chunks[0][0], chunks[0][1], max_points)
+
+    def iter_time_series_arrays(self, since=None, until=None, \
+    chunk_size=10000):
+        """Yields the time series for this channel trend in chunks
+
+        :param since: datetime or ms timestamp to return trend points from
+        (default the start of the stream's window)
+        :param until: datetime or ms timestamp to return trend points up to
+        :param chunk_size: maximum number of points per chunk, or None to
+        return all points in one chunk
+        :return: generator of (timestamps, values) arrays
+        """
+
+        # allowed channels
+        allowed_channels = self.key.get_writable_channels()
+
+        # check access
+        if self.channel.channel_num not in allowed_channels:
+            return
+
+        # where clause
+        where = ["channel = $channel", "timestamp >= $since"]
+
+        # threshold timestamp, in ms
+        if since is None:
+            # get default window
+            since = datetime.datetime.today() \
+            - datetime.timedelta(milliseconds=int(self.window))
+
+        # create until command
+        if until is not None:
+            where.append("timestamp <= $until")
+            until = self.to_timestamp(until)
+
+        sql = """
+            SELECT timestamp, value
+            FROM {0}
+            WHERE {1}
+            ORDER BY timestamp ASC
+        """.format(self._table_name(), " AND ".join(where))
+
+        sql_vars = {"channel": self.channel.channel_num, \
+        "since": self.to_timestamp(since), "until": until}
+
+        if chunk_size is None:
+            yield self.db.query_arrays(sql, sql_vars, \
+            dtypes=(np.int64, np.float64))
+        else:
+            for chunk in self.db.iter_arrays(sql, sql_vars, \
+            dtypes=(np.int64, np.float64), chunk_size=chunk_size):
+                yield chunk
+
+    def get_time_series_js(self, *args, **kwargs):
+        # limit points to those that can be plotted by default
+        kwargs.setdefault('max_points', self.get_default_max_points())
+
+        return utils.arrays_to_js(*self.get_time_series_arrays(*args, \
+        **kwargs))
+
+    def get_last_timestamp(self):
+        """Returns the time of the latest trend point [ms], or None"""
+
+        return self.db.select_single_cell(self._table_name(), \
+        {"channel": self.channel.channel_num}, what="MAX(timestamp)", \
+        where="channel = $channel")
+
+    def get_id(self):
+        """Returns an identifier for this stream, for use in URLs"""
+
+        return "{0}_{1}_{2}".format(self.stream_type, \
+        self.channel.channel_num, self.timestamp_avg)
+
+    def get_description(self):
+        """Returns a description string"""
+
+        # trend description
+        trend_description = "{0}s {1}".format(self.timestamp_avg / 1000, \
+        self.stream_type)
+
+        return "{0} ({1})".format(self.channel.name, trend_description)
+
+class NoDataForTrendsException(Exception):
+    pass
+
+class TrendBackfillingException(Exception):
+    pass
@@ -1,51 +1,69 @@
 import sys
+import os
 import web
 import models
 
-from config import get_config
-from database import Database
+from config import get_config, get_database_pragmas, parse_channels
+from database import Database, SCHEMA_VERSION
 from picolog.data import DataStore, Reading, Sample
 
-###
-# get config
+def populate(db, config, channel_config):
+    """Creates the schema, the configured key and the configured channels
 
-# path to config file, if specified
-config_path = None
+    The channels are made writable with the key.
 
-if len(sys.argv) > 1:
-    config_path = sys.argv[1]
+    :return: key
+    """
 
-config = get_config(config_path)
+    models.Key.init_schema(db)
+    models.Channel.init_schema(db)
+    models.ChannelAccess.init_schema(db)
+    models.ChannelSamples.init_schema(db)
+    models.ChannelRollups.init_schema(db)
+    models.ChannelBlocks.init_schema(db)
+    models.ChannelState.init_schema(db)
+    models.ChannelSampleTrends.init_state_schema(db)
 
-###
-# populate database
+    key = models.Key(config.get('general', 'key'), db, config)
+    key.add()
 
-db = Database(config)
-key = config.get('general', 'key')
+    # add configured channels, writable with the key
+    for channel in parse_channels(channel_config, db=db, config=config):
+        channel.add(channel.name)
 
-keys = models.AccessKeyModel(db, config)
-keys.init_schema()
-key_id = keys.add_key(key)
+        models.ChannelAccess(channel, key, db, config).add( \
+        models.ChannelAccess.MODE_RW)
 
-channels = models.MagnetometerChannelModel(db, config)
-channels.init_schema()
+    db.set_schema_version(SCHEMA_VERSION)
 
-channels.add_channel(13, "Channel 13")
-channels.add_channel(14, "Channel 14")
-channels.add_channel(15, "Channel 15")
-channels.add_channel(16, "Channel 16")
+    return key
 
-channel_access = models.ChannelAccessModel(db, config)
-channel_access.init_schema()
-channel_access.add_channel_access(13, key_id, models.ChannelAccessModel.MODE_RW)
-channel_access.add_channel_access(14, key_id, models.ChannelAccessModel.MODE_RW)
-channel_access.add_channel_access(15, key_id, models.ChannelAccessModel.MODE_RW)
-channel_access.add_channel_access(16, key_id, models.ChannelAccessModel.MODE_RW)
+if __name__ == "__main__":
+    ###
+    # get config
 
-magnetometer = models.MagnetometerDataModel(db, config)
-magnetometer.init_schema()
+    # path to config files, if specified
+    config_path = None
+    channel_config_path = None
 
-# example of adding data
-#datastore = DataStore(100)
-#datastore.insert([Reading(0, [1,2,3], [10, 20, 30]), Reading(1, [1,2,3], [11, 21, 31])])
-#magnetometer.add_data(datastore, key)
+    if len(sys.argv) > 1:
+        config_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        channel_config_path = sys.argv[2]
+
+    config = get_config(config_path, "config" + os.path.sep + "config.default")
+    channel_config = get_config(channel_config_path, \
+    "config" + os.path.sep + "channel_config.default")
+
+    ###
+    # populate database
+
+    db = Database(config.get('database', 'path'), \
+    pragmas=get_database_pragmas(config))
+
+    key = populate(db, config, channel_config)
+
+    # example of adding data
+    #datastore = DataStore(100)
+    #datastore.insert([Reading(0, [13, 14, 15], [10, 20, 30]), Reading(1, [13, 14, 15], [11, 21, 31])])
+    #models.ChannelSamples.add_from_datastore(db, key, datastore)
@@ -0,0 +1,199 @@
+import sys
+import os
+import time
+import signal
+import argparse
+import multiprocessing
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    # checked before starting: production mode needs gunicorn
+    BaseApplication = object
+
+from config import get_configs_from_argv, init_settings
+import services
+
+"""Production server: pools of pre-forked worker processes
+
+The site is served by gunicorn from two pools of worker processes, each with
+its own address, so logger uploads to /api and page reads don't wait for
+each other: point the loggers at the api pool, or route /api to it from a
+reverse proxy. Both pools serve the whole site. Workers load the site once
+forked, so each opens its own database connections, and SQLite's WAL mode
+lets their reads continue while another process commits.
+
+Trend updates, compaction and retention run once, in this launcher's
+process, finding new samples by polling the channel states. Sending SIGHUP
+to the launcher re-reads the [server] settings and gracefully replaces each
+pool's workers; SIGTERM or SIGINT stops them.
+
+Set mode = production in the [server] section to have server.py start this.
+
+Usage: python production.py [--pool api|pages|services] [config]
+[channel config] [stream config]
+"""
+
+"""Pools of worker processes"""
+POOLS = ("api", "pages")
+
+"""Default settings of each pool: address, worker processes and threads per
+worker"""
+DEFAULT_POOL_SETTINGS = {
+    "api": {"bind": "0.0.0.0:50001", "workers": 2, "threads": 4},
+    "pages": {"bind": "0.0.0.0:50000", "workers": 4, "threads": 8}
+}
+
+"""Default maximum number of connections waiting to be accepted"""
+DEFAULT_BACKLOG = 64
+
+"""Default time a worker may be unresponsive before it is restarted [s]"""
+DEFAULT_TIMEOUT = 30
+
+"""Default time workers have to finish their requests when replaced or
+stopped [s]"""
+DEFAULT_GRACEFUL_TIMEOUT = 30
+
+"""Default number of requests after which a worker is replaced, or 0 for
+never"""
+DEFAULT_MAX_REQUESTS = 0
+
+def get_pool_options(config, pool):
+    """Returns the gunicorn settings of a pool
+
+    :param pool: api or pages
+    :return: dict of gunicorn setting names to values
+    """
+
+    options = dict(DEFAULT_POOL_SETTINGS[pool])
+    options.update({"backlog": DEFAULT_BACKLOG, "timeout": DEFAULT_TIMEOUT, \
+    "graceful_timeout": DEFAULT_GRACEFUL_TIMEOUT, \
+    "max_requests": DEFAULT_MAX_REQUESTS})
+
+    # settings of this pool
+    if config.has_option('server', pool + '_bind'):
+        options["bind"] = config.get('server', pool + '_bind')
+
+    for name in ("workers", "threads"):
+        if config.has_option('server', pool + '_' + name):
+            options[name] = config.getint('server', pool + '_' + name)
+
+    # settings of both pools
+    for name in ("backlog", "timeout", "graceful_timeout", "max_requests"):
+        if config.has_option('server', name):
+            options[name] = config.getint('server', name)
+
+    # threads serve a worker's requests, including event streams, which
+    # each hold one
+    options["worker_class"] = "gthread"
+    options["proc_name"] = "magnetometer-{0}".format(pool)
+
+    return options
+
+class PoolApplication(BaseApplication):
+    """gunicorn application serving the site from one pool of workers"""
+
+    def __init__(self, pool):
+        """Initialises the application
+
+        :param pool: api or pages
+        """
+
+        self.pool = pool
+
+        super(PoolApplication, self).__init__()
+
+    def load_config(self):
+        # read again on reload, so changed settings apply to the new workers
+        config = get_configs_from_argv()[0]
+
+        for name, value in get_pool_options(config, self.pool).iteritems():
+            self.cfg.set(name, value)
+
+    def load(self):
+        # imported in each worker once forked, so none share a connection
+        import server
+
+        return server.app.wsgifunc()
+
+def run_pool(pool):
+    """Serves the site from a pool of workers until stopped"""
+
+    PoolApplication(pool).run()
+
+def run_services():
+    """Runs the background services until stopped"""
+
+    config, db, server_key, channels, streams = \
+    init_settings(*get_configs_from_argv())
+
+    services.start_background_services(db, config, channels, streams, \
+    watch=True)
+
+    while True:
+        time.sleep(60)
+
+def run(pools):
+    """Starts pools of workers, then runs the background services
+
+    The launcher forwards SIGHUP to the pools, and stops them on SIGTERM or
+    SIGINT.
+
+    :param pools: names of the pools to start
+    """
+
+    processes = [multiprocessing.Process(target=run_pool, args=(pool,), \
+    name=pool) for pool in pools]
+
+    # start the pools before this process opens any database connection
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+        if signum != signal.SIGHUP:
+            for process in processes:
+                process.join()
+
+            sys.exit(0)
+
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, forward)
+
+    try:
+        run_services()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves the site from pools \
+of worker processes")
+    parser.add_argument("--pool", choices=POOLS + ("services",), \
+    help="run only this pool, or only the background services (default \
+everything)")
+    parser.add_argument("configs", nargs="*", help="config, channel config and \
+stream config files")
+
+    args = parser.parse_args()
+
+    # leave only the config paths for the settings, as the workers read them
+    sys.argv = sys.argv[:1] + args.configs
+
+    if args.pool != "services" and BaseApplication is object:
+        sys.exit("Production mode needs gunicorn: pip install gunicorn")
+
+    if args.pool == "services":
+        run_services()
+    elif args.pool is not None:
+        run_pool(args.pool)
+    else:
+        config = get_configs_from_argv()[0]
+
+        # a pool without workers is not started
+        run([pool for pool in POOLS \
+        if get_pool_options(config, pool)["workers"] > 0])
@@ -0,0 +1,365 @@
+from __future__ import division
+
+import sys
+import time
+import threading
+
+import models
+import archive
+
+"""Deletion of data older than each channel's retention periods
+
+A channel's keep_raw and keep_trends settings in the channel config give the
+number of days of raw samples, and of trend points and rollups, to keep.
+Raw samples, in the database or the archive, are only deleted once every
+trend of the channel has consumed them; rollups are maintained on ingest, so
+they always cover them. Rows are deleted oldest first in small transactions
+with pauses between them, so writers are never held up for long.
+
+Deleted pages are returned to the file system a few at a time with
+incremental_vacuum, which needs the database's auto_vacuum mode to be
+INCREMENTAL. New databases are created that way; existing ones are converted
+once with a full VACUUM by running this module with --vacuum.
+
+Usage: python retention.py [--vacuum] [config] [channel config]
+[stream config]
+"""
+
+"""Day length [ms]"""
+DAY = 86400000
+
+"""auto_vacuum mode allowing incremental_vacuum"""
+AUTO_VACUUM_INCREMENTAL = 2
+
+class RetentionService(object):
+    """Deletes expired data periodically in a background thread"""
+
+    """Default interval between runs [s]"""
+    DEFAULT_INTERVAL = 3600
+
+    """Default maximum number of rows deleted per transaction"""
+    DEFAULT_BATCH_ROWS = 10000
+
+    """Default pause between transactions and vacuum steps [ms]"""
+    DEFAULT_BATCH_PAUSE = 100
+
+    """Default maximum number of pages freed per vacuum step"""
+    DEFAULT_VACUUM_PAGES = 1000
+
+    def __init__(self, db, config, channels, streams):
+        """Initialises the service
+
+        :param channels: channels, with their retention periods
+        :param streams: streams, whose trends must cover raw samples before
+        they are deleted
+        """
+
+        self.db = db
+        self.config = config
+        self.channels = channels
+
+        self.interval = self.DEFAULT_INTERVAL
+        self.batch_rows = self.DEFAULT_BATCH_ROWS
+        self.batch_pause = self.DEFAULT_BATCH_PAUSE
+        self.vacuum_pages = self.DEFAULT_VACUUM_PAGES
+
+        if config.has_option('retention', 'interval'):
+            self.interval = config.getfloat('retention', 'interval')
+
+        if config.has_option('retention', 'batch_rows'):
+            self.batch_rows = config.getint('retention', 'batch_rows')
+
+        if config.has_option('retention', 'batch_pause'):
+            self.batch_pause = config.getfloat('retention', 'batch_pause')
+
+        if config.has_option('retention', 'vacuum_pages'):
+            self.vacuum_pages = config.getint('retention', 'vacuum_pages')
+
+        # trends by channel
+        self.channel_trends = {}
+
+        for stream in streams:
+            if stream.stream_type == "trend":
+                self.channel_trends.setdefault(stream.channel.channel_num, \
+                []).append(stream)
+
+        # statistics
+        self.last_run = None
+        self.raw_count = 0
+        self.trend_count = 0
+        self.rollup_count = 0
+        self.archive_day_count = 0
+        self.page_count = 0
+        self.error_count = 0
+
+    def start(self):
+        """Starts the background thread"""
+
+        thread = threading.Thread(target=self._work, name="retention")
+
+        # don't keep the process alive for the thread
+        thread.daemon = True
+        thread.start()
+
+    def _work(self):
+        while True:
+            try:
+                self.run()
+            except Exception, e:
+                print >> sys.stderr, "Error applying retention: {0}".format(e)
+
+                self.error_count += 1
+
+            time.sleep(self.interval)
+
+    def run(self, now=None):
+        """Deletes every channel's expired data, then frees the space
+
+        :param now: current time [ms], default the system time
+        """
+
+        if now is None:
+            now = int(time.time() * 1000)
+
+        for channel in self.channels:
+            if channel.keep_raw is not None:
+                self.prune_raw(channel, now - int(channel.keep_raw * DAY))
+
+            if channel.keep_trends is not None:
+                self.prune_trends(channel, now - int(channel.keep_trends * DAY))
+
+        self.vacuum()
+
+        self.last_run = now
+
+    def get_raw_limit(self, channel_num, cutoff):
+        """Returns the time before which a channel's raw samples can go [ms]
+
+        This is the cutoff, or the earliest trend progress if that is
+        earlier.
+        """
+
+        limit = cutoff
+
+        for trend in self.channel_trends.get(channel_num, []):
+            limit = min(limit, int(trend._get_trend_state().last_timestamp) \
+            + 1)
+
+        return limit
+
+    def prune_raw(self, channel, cutoff):
+        """Deletes a channel's raw samples before the cutoff [ms]
+
+        :return: number of samples deleted from the database
+        """
+
+        channel_num = channel.channel_num
+        limit = self.get_raw_limit(channel_num, cutoff)
+
+        # whole archived days before the limit
+        channel_archive = archive.ChannelArchive.from_config(channel_num, \
+        self.config)
+
+        if channel_archive is not None:
+            for day in channel_archive.get_days():
+                if day + DAY > limit:
+                    break
+
+                if channel_archive.delete_day(day):
+                    self.archive_day_count += 1
+
+        def remove_samples(count):
+            models.ChannelState.remove(self.db, channel_num, count)
+
+        count = self._delete_before(models.ChannelSamples.TABLE_NAME, \
+        "timestamp", "channel = $channel", {"channel": channel_num}, limit, \
+        remove_samples)
+
+        # compressed blocks, as many per transaction as cover batch_rows
+        # seconds
+        channel_blocks = models.ChannelBlocks(channel_num, self.db, \
+        self.config)
+        max_blocks = max(1, self.batch_rows * 1000 \
+        // channel_blocks.get_span(self.config))
+
+        while True:
+            block_sample_count = channel_blocks.delete_before(limit, \
+            max_blocks)
+
+            if block_sample_count == 0:
+                break
+
+            count += block_sample_count
+
+            time.sleep(self.batch_pause / 1000)
+
+        if count > 0:
+            # the sample counts changed
+            models.ChannelState.invalidate_cache()
+
+            print "Deleted {0} samples of channel {1}".format(count, \
+            channel_num)
+
+        self.raw_count += count
+
+        return count
+
+    def prune_trends(self, channel, cutoff):
+        """Deletes a channel's trend points and rollups before the cutoff [ms]
+
+        :return: number of rows deleted
+        """
+
+        channel_num = channel.channel_num
+
+        count = 0
+
+        for trend in self.channel_trends.get(channel_num, []):
+            trend_count = self._delete_before(trend._table_name(), \
+            "timestamp", "channel = $channel", {"channel": channel_num}, \
+            cutoff)
+
+            self.trend_count += trend_count
+            count += trend_count
+
+        rollups = models.ChannelRollups(channel_num, self.db, self.config)
+
+        for resolution in rollups.get_resolutions():
+            # buckets ending before the cutoff
+            rollup_count = self._delete_before(rollups.TABLE_NAME, "bucket", \
+            "channel = $channel AND resolution = $resolution", \
+            {"channel": channel_num, "resolution": resolution}, \
+            cutoff - resolution + 1)
+
+            self.rollup_count += rollup_count
+            count += rollup_count
+
+        if count > 0:
+            print "Deleted {0} trend points and rollups of channel {1}" \
+            .format(count, channel_num)
+
+        return count
+
+    def _delete_before(self, table_name, column, where, vars, limit, \
+    callback=None):
+        """Deletes rows before a time in batches, oldest first
+
+        Each batch is deleted in its own transaction.
+
+        :param column: time column, the last column of the table's key
+        :param where: condition selecting the rows by the rest of the key
+        :param vars: values of the condition's variables
+        :param limit: rows with earlier times are deleted [ms]
+        :param callback: function called with the number of rows deleted
+        within each batch's transaction
+        :return: number of rows deleted
+        """
+
+        vars = dict(vars, limit=limit)
+
+        count = 0
+
+        while True:
+            # the batch ends at the time of the first row not in it
+            end = self.db.select_single_cell(table_name, vars, what=column, \
+            where="{0} AND {1} < $limit".format(where, column), \
+            order="{0} ASC".format(column), offset=self.batch_rows)
+
+            if end is None:
+                end = limit
+
+            with self.db.transaction():
+                batch_count = self.db.delete(table_name, \
+                where="{0} AND {1} < $end".format(where, column), \
+                vars=dict(vars, end=end))
+
+                if callback is not None and batch_count > 0:
+                    callback(batch_count)
+
+            count += batch_count
+
+            if end == limit or batch_count == 0:
+                return count
+
+            # let writers in
+            time.sleep(self.batch_pause / 1000)
+
+    def vacuum(self):
+        """Returns free pages to the file system, a few at a time
+
+        :return: number of pages freed
+        """
+
+        if get_auto_vacuum(self.db) != AUTO_VACUUM_INCREMENTAL:
+            return 0
+
+        count = 0
+
+        while True:
+            free_count = self.db.query("PRAGMA freelist_count")[0] \
+            .freelist_count
+
+            if free_count == 0:
+                break
+
+            self.db.incremental_vacuum(self.vacuum_pages)
+
+            freed = free_count - self.db.query("PRAGMA freelist_count")[0] \
+            .freelist_count
+
+            if freed <= 0:
+                break
+
+            count += freed
+
+            time.sleep(self.batch_pause / 1000)
+
+        self.page_count += count
+
+        return count
+
+    def get_stats(self):
+        """Returns the time of the last run and the amounts deleted"""
+
+        return {"last_run": self.last_run, "samples": self.raw_count, \
+        "trend_points": self.trend_count, "rollups": self.rollup_count, \
+        "archive_days": self.archive_day_count, "pages": self.page_count, \
+        "errors": self.error_count}
+
+def get_auto_vacuum(db):
+    """Returns the database's auto_vacuum mode: 0 none, 1 full, 2 incremental"""
+
+    return db.query("PRAGMA auto_vacuum")[0].auto_vacuum
+
+def enable_incremental_vacuum(db):
+    """Switches an existing database to incremental vacuuming
+
+    This rebuilds the whole database file, blocking other connections.
+    """
+
+    db.query("PRAGMA auto_vacuum = INCREMENTAL")
+    db.query("VACUUM")
+
+if __name__ == "__main__":
+    from config import init_settings_from_argv
+
+    vacuum = "--vacuum" in sys.argv
+
+    # leave only the config paths
+    sys.argv = [argument for argument in sys.argv if argument != "--vacuum"]
+
+    config, db, server_key, channels, streams = init_settings_from_argv()
+
+    if get_auto_vacuum(db) != AUTO_VACUUM_INCREMENTAL:
+        if vacuum:
+            print "Rebuilding the database for incremental vacuuming"
+
+            enable_incremental_vacuum(db)
+        else:
+            print "Space is only freed for incremental databases: run with \
+--vacuum once to convert this one"
+
+    service = RetentionService(db, config, channels, streams)
+    service.run()
+
+    print service.get_stats()
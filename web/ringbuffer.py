@@ -0,0 +1,178 @@
+import threading
+import numpy as np
+
+"""In-memory buffers of each channel's newest samples
+
+A channel's buffer holds up to a fixed number of its newest samples in
+preallocated arrays twice that size. Samples are appended at the end, and
+when the end is reached the newest samples are moved back to the start, so
+the held samples are always one contiguous, time-ordered slice and a time
+range is found by binary search.
+
+The buffer records the time from which it holds every sample. It starts as
+the time it was reset to, and moves forward as old samples are dropped to
+make room. Requests for ranges starting before it must go to the database.
+"""
+
+class RingBuffer(object):
+    """Fixed-size buffer of a channel's newest samples"""
+
+    """Maximum number of samples held"""
+    capacity = None
+
+    """Time from which every sample is held [ms], or None if not reset"""
+    covered_since = None
+
+    def __init__(self, capacity):
+        """Initialises the buffer
+
+        :param capacity: maximum number of samples to hold
+        """
+
+        self.capacity = int(capacity)
+
+        if self.capacity < 1:
+            raise ValueError("Buffer capacity must be positive")
+
+        self._timestamps = np.empty(2 * self.capacity, dtype=np.int64)
+        self._values = np.empty(2 * self.capacity, dtype=np.int64)
+
+        # held samples are [_start, _end)
+        self._start = 0
+        self._end = 0
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._end - self._start
+
+    def reset(self, since):
+        """Empties the buffer, to hold every sample from a time onwards
+
+        The samples already stored from that time should then be appended.
+
+        :param since: covered time [ms]
+        """
+
+        with self._lock:
+            self._start = 0
+            self._end = 0
+            self.covered_since = int(since)
+
+    def append(self, timestamps, values):
+        """Adds newly stored samples
+
+        As in the samples table, a sample with the same time as one already
+        held is ignored. Samples before the covered time are ignored too.
+
+        :param timestamps: sample timestamps [ms], in any order
+        :param values: sample values
+        """
+
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.int64)
+
+        with self._lock:
+            if self.covered_since is None:
+                return
+
+            # order by time, keeping the first of any repeated timestamp
+            timestamps, indices = np.unique(timestamps, return_index=True)
+            values = values[indices]
+
+            # drop samples from before the covered time
+            first = np.searchsorted(timestamps, self.covered_since, \
+            side="left")
+            timestamps = timestamps[first:]
+            values = values[first:]
+
+            if len(timestamps) == 0:
+                return
+
+            if len(self) > 0 \
+            and timestamps[0] <= self._timestamps[self._end - 1]:
+                # late samples: merge with those held, existing ones first
+                timestamps = np.concatenate((self._timestamps[self._start:\
+                self._end], timestamps))
+                values = np.concatenate((self._values[self._start:self._end], \
+                values))
+
+                timestamps, indices = np.unique(timestamps, return_index=True)
+                values = values[indices]
+
+                self._start = 0
+                self._end = 0
+
+            self._append(timestamps, values)
+
+    def _append(self, timestamps, values):
+        """Appends time-ordered samples newer than those held
+
+        The lock must be held.
+        """
+
+        if len(timestamps) > self.capacity:
+            # only the newest samples fit
+            self._drop(timestamps[-self.capacity - 1])
+
+            timestamps = timestamps[-self.capacity:]
+            values = values[-self.capacity:]
+
+        count = len(timestamps)
+
+        # make room by dropping the oldest samples
+        excess = len(self) + count - self.capacity
+
+        if excess > 0:
+            self._drop(self._timestamps[self._start + excess - 1])
+            self._start += excess
+
+        # move the held samples back to the start if they don't fit after
+        if self._end + count > len(self._timestamps):
+            held = len(self)
+
+            self._timestamps[:held] = self._timestamps[self._start:self._end]
+            self._values[:held] = self._values[self._start:self._end]
+
+            self._start = 0
+            self._end = held
+
+        self._timestamps[self._end:self._end + count] = timestamps
+        self._values[self._end:self._end + count] = values
+        self._end += count
+
+    def _drop(self, timestamp):
+        """Records that samples up to timestamp are no longer all held"""
+
+        self.covered_since = max(self.covered_since, int(timestamp) + 1)
+
+    def get(self, since, until=None):
+        """Returns the samples within a time range, if they are all held
+
+        :param since: earliest timestamp [ms]
+        :param until: latest timestamp [ms], or None
+        :return: (timestamps, values) arrays, or None if samples from since
+        may not all be held
+        """
+
+        with self._lock:
+            if self.covered_since is None or since < self.covered_since:
+                return None
+
+            timestamps = self._timestamps[self._start:self._end]
+            values = self._values[self._start:self._end]
+
+            start = np.searchsorted(timestamps, since, side="left")
+            end = len(timestamps)
+
+            if until is not None:
+                end = np.searchsorted(timestamps, until, side="right")
+
+            # copy, as the arrays are reused by later appends
+            return timestamps[start:end].copy(), values[start:end].copy()
+
+    def get_stats(self):
+        """Returns the number of samples held and the covered time"""
+
+        return {"samples": len(self), "capacity": self.capacity, \
+        "covered_since": self.covered_since}
@@ -1,29 +1,50 @@
 import sys
 import os
+import time
 import web
 import datetime
 
-from config import init_settings_from_argv
+from config import init_settings_from_argv, get_configs_from_argv, \
+get_server_mode
+
+if __name__ == "__main__" \
+and get_server_mode(get_configs_from_argv()[0]) == "production":
+    # replace this process before api starts any thread or opens any file, so
+    # no worker inherits them
+    os.execv(sys.executable, [sys.executable, "production.py"] \
+    + sys.argv[1:])
+
 import utils
 import models
 import database
 import api
+import metrics
+import cache
 from picolog.data import DataStore
 
 config, db, server_key, channels, streams = init_settings_from_argv()
 
+# time the site was started, when the page last changed [s]
+start_time = time.time()
+
 ###
 # Start web application
 
 # URL routing
 urls = (
     "/api", api.app_api,
+    "/series/(.+)", "Series",
+    "/events", "Events",
+    "/(.+)/metrics", "Metrics",
     "/?", "List"
 )
 
 # create application object
 app = web.application(urls, globals())
 
+# time each request
+app.add_processor(metrics.request_processor(app))
+
 # create template renderer
 render = web.template.render("templates", base='base')
 
@@ -31,7 +52,25 @@ class BaseController:
     pass
 
 class List(BaseController):
+    """Rendered page and its ETag; the page only depends on the config, so it
+    is rendered once"""
+    page = None
+
     def GET(self):
+        if List.page is None:
+            List.page = self.render()
+
+        body, etag = List.page
+
+        web.header('Cache-Control', 'no-cache')
+
+        cache.check_modified(etag, start_time)
+
+        return body
+
+    def render(self):
+        """Returns the page and its ETag"""
+
         # raw data streams
         raw_streams = [stream for stream in streams if stream.stream_type == "raw"]
 
@@ -41,7 +80,63 @@ class List(BaseController):
         stream_sets = [{"description": "Measurements", "streams": raw_streams}, \
         {"description": "Trends", "streams": trend_streams}]
 
-        return render.index(stream_sets=stream_sets)
+        # live updates, if enabled
+        events_url = "/events" if api.event_hub is not None else ""
+
+        with metrics.render_seconds.time("index"):
+            body = str(render.index(stream_sets=stream_sets, \
+            refresh=config.getint('plot', 'refresh'), events_url=events_url))
+
+        return body, cache.get_etag(body)
+
+class Series(BaseController):
+    def GET(self, stream_id):
+        # find stream
+        stream = api.get_stream(streams, stream_id)
+
+        if stream is None:
+            return web.notfound()
+
+        return api.series_json(stream)
+
+class Events(BaseController):
+    def GET(self):
+        if api.event_hub is None:
+            return web.notfound()
+
+        params = web.input(streams=None)
+
+        # every stream by default
+        if params.streams:
+            stream_ids = params.streams.split(",")
+        else:
+            stream_ids = [stream.get_id() for stream in streams]
+
+        for stream_id in stream_ids:
+            if api.get_stream(streams, stream_id) is None:
+                return web.notfound()
+
+        subscription = api.event_hub.subscribe(stream_ids)
+
+        if subscription is None:
+            # too many clients: they poll instead
+            web.ctx.status = '503 Service Unavailable'
+            return "Too many clients"
+
+        web.header('Content-Type', 'text/event-stream')
+        web.header('Cache-Control', 'no-cache')
+
+        return api.event_hub.iter_events(subscription)
+
+class Metrics(BaseController):
+    def GET(self, key):
+        # statement timings are labelled with the statements
+        if not api.is_server_key(key):
+            return web.forbidden()
+
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+
+        return metrics.render()
 
 if __name__ == "__main__":
     web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", 50000))
@@ -0,0 +1,64 @@
+import threading
+
+import models
+import trendservice
+import retention
+import compaction
+
+"""Background services maintaining the stored data
+
+Trend updates, compaction of older samples and deletion of expired data each
+run in their own threads. They run once per database: in the API process
+when served by server.py's simple server, or in production.py's own process
+when served by its pools of worker processes.
+"""
+
+def start_background_services(db, config, channels, streams, watch=False):
+    """Starts the services enabled in the config
+
+    :param watch: if True, trends are updated as samples written by other
+    processes are found, rather than as this process writes them
+    :return: (trend service, compactor, retention service), each None if
+    disabled
+    """
+
+    # trend updates as samples arrive, if enabled
+    trend_service = None
+
+    if config.has_option('trends', 'mode') \
+    and config.get('trends', 'mode') == "service":
+        trend_service = trendservice.TrendService(db, config, \
+        [stream for stream in streams if stream.stream_type == "trend"])
+        trend_service.start()
+
+        if watch:
+            thread = threading.Thread(target=trend_service.watch, \
+            name="trend-watch")
+
+            # don't keep the process alive for the thread
+            thread.daemon = True
+            thread.start()
+        else:
+            models.ChannelSamples.write_listeners.append(trend_service.notify)
+
+        # catch up with samples written while stopped
+        trend_service.notify_all()
+
+    # compression of older samples, if enabled
+    compactor = None
+
+    if config.has_option('blocks', 'enabled') \
+    and config.getboolean('blocks', 'enabled'):
+        compactor = compaction.BlockCompactor(db, config, channels)
+        compactor.start()
+
+    # deletion of expired data, if enabled
+    retention_service = None
+
+    if config.has_option('retention', 'enabled') \
+    and config.getboolean('retention', 'enabled'):
+        retention_service = retention.RetentionService(db, config, channels, \
+        streams)
+        retention_service.start()
+
+    return trend_service, compactor, retention_service
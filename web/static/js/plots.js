@@ -0,0 +1,229 @@
+/*
+ * Stream plots
+ *
+ * Fetches each stream's series from the server and plots it. New points are
+ * then pushed by the server as Server-Sent Events where the browser and
+ * server support them, otherwise the plots periodically fetch only the
+ * samples newer than the last one held. Plots also poll while the event
+ * stream reconnects, and fetch what they missed once it is back.
+ *
+ * Where the browser supports typed arrays, series are requested in the binary
+ * format (see utils.arrays_to_binary) and read without parsing any text.
+ */
+(function ($) {
+  "use strict";
+
+  // plot options shared by every stream
+  var options = {
+    xaxis: {mode: "time"}
+  };
+
+  // binary series header: "MGTS", version, value type, uint64 count
+  var HEADER_SIZE = 16;
+  var BINARY_VERSION = 1;
+
+  var binarySupported = typeof DataView !== "undefined";
+
+  var eventsSupported = typeof EventSource !== "undefined";
+
+  // decodes a binary series into [timestamp, value] pairs
+  function decodeSeries(buffer) {
+    var view = new DataView(buffer);
+    var count;
+    var valueType;
+    var valueOffset;
+    var points;
+    var i;
+
+    if (view.getUint8(4) !== BINARY_VERSION) {
+      throw new Error("Unsupported binary series version");
+    }
+
+    valueType = view.getUint8(5);
+
+    // counts and ms timestamps fit within 2^53
+    count = view.getUint32(8, true) + view.getInt32(12, true) * 4294967296;
+    valueOffset = HEADER_SIZE + 8 * count;
+
+    points = new Array(count);
+
+    for (i = 0; i < count; i++) {
+      points[i] = [
+        view.getUint32(HEADER_SIZE + 8 * i, true)
+          + view.getInt32(HEADER_SIZE + 8 * i + 4, true) * 4294967296,
+        valueType === 0
+          ? view.getInt32(valueOffset + 4 * i, true)
+          : view.getFloat64(valueOffset + 8 * i, true)
+      ];
+    }
+
+    return points;
+  }
+
+  // requests a series in the binary format
+  function getBinary(url, params, done, always) {
+    var request = new XMLHttpRequest();
+
+    request.open("GET", url + "?" + $.param($.extend({format: "binary"},
+      params)));
+    request.responseType = "arraybuffer";
+
+    request.onload = function () {
+      try {
+        if (request.status === 200) {
+          done(decodeSeries(request.response));
+        }
+      } finally {
+        always();
+      }
+    };
+
+    request.onerror = always;
+
+    request.send();
+  }
+
+  function StreamPlot(element) {
+    this.element = $(element);
+    this.id = this.element.data("stream-id");
+    this.url = this.element.data("series-url");
+    this.window = parseInt(this.element.data("window"), 10);
+    this.data = [];
+    this.pending = false;
+  }
+
+  // appends points newer than those held, drops those outside the window,
+  // and redraws
+  StreamPlot.prototype.append = function (points) {
+    var start;
+    var first = 0;
+
+    // pushed and fetched points may overlap
+    if (this.data.length > 0) {
+      start = this.data[this.data.length - 1][0];
+
+      while (first < points.length && points[first][0] <= start) {
+        first++;
+      }
+
+      points = points.slice(first);
+      first = 0;
+    }
+
+    if (points.length > 0) {
+      this.data = this.data.concat(points);
+
+      // keep the window ending at the newest point
+      start = this.data[this.data.length - 1][0] - this.window;
+
+      while (first < this.data.length && this.data[first][0] < start) {
+        first++;
+      }
+
+      this.data = this.data.slice(first);
+    }
+
+    $.plot(this.element, [this.data], options);
+  };
+
+  // fetches the whole window, or the points after the last one held
+  StreamPlot.prototype.fetch = function () {
+    var self = this;
+    var params = {};
+
+    // don't stack requests if the server is slow
+    if (self.pending) {
+      return;
+    }
+
+    if (self.data.length > 0) {
+      params.since = self.data[self.data.length - 1][0] + 1;
+    }
+
+    self.pending = true;
+
+    function done(points) {
+      self.append(points);
+    }
+
+    function always() {
+      self.pending = false;
+    }
+
+    if (binarySupported) {
+      getBinary(self.url, params, done, always);
+    } else {
+      $.getJSON(self.url, params).done(function (response) {
+        done(response.data);
+      }).always(always);
+    }
+  };
+
+  // appends points pushed by the server to the plots of their streams
+  function listen(url, plots, opened, failed) {
+    var plotsById = {};
+    var source;
+
+    $.each(plots, function (index, plot) {
+      plotsById[plot.id] = plot;
+    });
+
+    source = new EventSource(url + "?" + $.param({
+      streams: $.map(plots, function (plot) {
+        return plot.id;
+      }).join(",")
+    }));
+
+    source.addEventListener("points", function (event) {
+      var message = JSON.parse(event.data);
+
+      if (plotsById.hasOwnProperty(message.stream)) {
+        plotsById[message.stream].append(message.data);
+      }
+    });
+
+    source.onopen = opened;
+
+    // the browser reconnects by itself, unless the server refused
+    source.onerror = failed;
+  }
+
+  $.fn.streamPlots = function (refresh, eventsUrl) {
+    var polling = null;
+
+    var plots = this.map(function () {
+      return new StreamPlot(this);
+    }).get();
+
+    function fetchAll() {
+      $.each(plots, function (index, plot) {
+        plot.fetch();
+      });
+    }
+
+    function startPolling() {
+      if (polling === null) {
+        polling = setInterval(fetchAll, refresh);
+      }
+    }
+
+    // requests run in parallel
+    fetchAll();
+
+    if (eventsUrl && eventsSupported && plots.length > 0) {
+      listen(eventsUrl, plots, function () {
+        if (polling !== null) {
+          clearInterval(polling);
+          polling = null;
+        }
+
+        // points written while disconnected
+        fetchAll();
+      }, startPolling);
+    } else {
+      startPolling();
+    }
+
+    return this;
+  };
+}(jQuery));
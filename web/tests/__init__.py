@@ -0,0 +1,6 @@
+"""Tests
+
+Run from the web directory:
+
+    python -m unittest discover tests
+"""
@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+import unittest
+import ConfigParser
+
+import numpy as np
+import web
+
+from database import Database
+import models
+import blocks
+
+class CodecTest(unittest.TestCase):
+    """Encoding and decoding of blocks"""
+
+    def assert_round_trip(self, timestamps, values):
+        decoded_timestamps, decoded_values = blocks.decode(blocks.encode( \
+        timestamps, values))
+
+        self.assertEqual(decoded_timestamps.tolist(), list(timestamps))
+        self.assertEqual(decoded_values.tolist(), list(values))
+
+    def test_zigzag(self):
+        values = np.array([0, -1, 1, -2, 2, -2 ** 63, 2 ** 63 - 1], \
+        dtype=np.int64)
+
+        self.assertEqual(blocks.zigzag_encode(values[:5]).tolist(), \
+        [0, 1, 2, 3, 4])
+        self.assertEqual(blocks.zigzag_decode(blocks.zigzag_encode( \
+        values)).tolist(), values.tolist())
+
+    def test_varint(self):
+        values = np.array([0, 1, 127, 128, 16383, 16384, 2 ** 64 - 1], \
+        dtype=np.uint64)
+
+        data = blocks.varint_encode(values)
+
+        # one byte per 7 bits
+        self.assertEqual(len(data), 1 + 1 + 1 + 2 + 2 + 3 + 10)
+        self.assertEqual(blocks.varint_decode(data).tolist(), values.tolist())
+
+    def test_regular_cadence(self):
+        timestamps = range(1000000, 2000000, 1000)
+
+        self.assert_round_trip(timestamps, [i % 50 for i in timestamps])
+
+    def test_negative_deltas(self):
+        # irregular timestamps give negative delta-of-deltas, and falling
+        # values negative differences
+        self.assert_round_trip([5, 1000, 1001, 3000, 3002, 10 ** 12], \
+        [100, -7, -2 ** 31, 2 ** 31 - 1, 0, -1])
+
+    def test_repeated_values(self):
+        self.assert_round_trip(range(0, 100, 10), [42] * 10)
+
+    def test_single_sample(self):
+        self.assert_round_trip([1234567890123], [-5])
+
+    def test_empty(self):
+        self.assert_round_trip([], [])
+
+class CompactionTest(unittest.TestCase):
+    """Moving samples into blocks, and merging samples written late"""
+
+    """Channel the samples are written to"""
+    CHANNEL_NUM = 13
+
+    """Block span [ms]"""
+    SPAN = 3600000
+
+    def setUp(self):
+        web.config.debug = False
+
+        self.directory = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.directory, "test.db"))
+
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section('blocks')
+        self.config.set('blocks', 'span', str(self.SPAN))
+
+        for model in [models.Channel, models.ChannelSamples, \
+        models.ChannelRollups, models.ChannelBlocks, models.ChannelState]:
+            model.init_schema(self.db)
+
+        self.db.insert('channels', channel=self.CHANNEL_NUM, name="Test")
+
+        self.blocks = models.ChannelBlocks(self.CHANNEL_NUM, self.db, \
+        self.config)
+
+        # two spans of samples a second apart
+        self.timestamps = range(0, 2 * self.SPAN, 1000)
+        self.write(self.timestamps, 1)
+
+    def tearDown(self):
+        models.ChannelState.invalidate_cache()
+
+        self.db.ctx.db.close()
+
+        shutil.rmtree(self.directory)
+
+    def write(self, timestamps, value):
+        rows = [(self.CHANNEL_NUM, timestamp, value) \
+        for timestamp in timestamps]
+
+        return models.ChannelSamples.write_rows(self.db, self.config, \
+        [rows])[0]
+
+    def read(self):
+        return models.ChannelSamples.read_arrays(self.db, self.config, \
+        self.CHANNEL_NUM)
+
+    def get_sample_count(self):
+        models.ChannelState.invalidate_cache()
+
+        return models.ChannelState.get(self.db, self.CHANNEL_NUM).sample_count
+
+    def test_compact(self):
+        self.assertEqual(self.blocks.compact(2 * self.SPAN), \
+        (2, len(self.timestamps)))
+
+        timestamps, values = self.read()
+
+        self.assertEqual(timestamps.tolist(), self.timestamps)
+        self.assertEqual(self.db.select_single_cell( \
+        models.ChannelSamples.TABLE_NAME, what="COUNT(*)"), 0)
+        self.assertEqual(self.get_sample_count(), len(self.timestamps))
+
+    def test_merge_late_samples(self):
+        self.blocks.compact(2 * self.SPAN)
+
+        # between two compacted samples
+        late = [500, self.SPAN + 500]
+        self.assertEqual(self.write(late, 2), 2)
+
+        self.assertEqual(self.blocks.compact(2 * self.SPAN), (2, 2))
+
+        timestamps, values = self.read()
+
+        self.assertEqual(timestamps.tolist(), sorted(self.timestamps + late))
+        self.assertEqual(values[np.in1d(timestamps, late)].tolist(), [2, 2])
+        self.assertEqual(self.get_sample_count(), len(self.timestamps) + 2)
+
+    def test_late_repeat_not_counted(self):
+        self.blocks.compact(2 * self.SPAN)
+
+        # one repeat of a compacted sample and one new sample
+        self.assertEqual(self.write([1000, 1500], 2), 1)
+        self.assertEqual(self.get_sample_count(), len(self.timestamps) + 1)
+
+        self.blocks.compact(2 * self.SPAN)
+
+        timestamps, values = self.read()
+
+        # the stored value is kept
+        self.assertEqual(values[timestamps == 1000].tolist(), [1])
+        self.assertEqual(len(timestamps), len(self.timestamps) + 1)
+        self.assertEqual(self.get_sample_count(), len(self.timestamps) + 1)
+
+    def test_single_sample_block(self):
+        self.write([2 * self.SPAN + 5], 3)
+
+        self.assertEqual(self.blocks.compact(3 * self.SPAN), \
+        (3, len(self.timestamps) + 1))
+
+        timestamps, values = self.read()
+
+        self.assertEqual(timestamps[-1], 2 * self.SPAN + 5)
+        self.assertEqual(values[-1], 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+import ConfigParser
+
+import numpy as np
+import web
+
+from database import Database
+import models
+import archive
+
+class ChannelSamplesTest(unittest.TestCase):
+    """Reading samples stored in the archive, blocks and samples table"""
+
+    """Channel the samples are written to"""
+    CHANNEL_NUM = 13
+
+    """Access key"""
+    KEY = "test"
+
+    def setUp(self):
+        web.config.debug = False
+
+        self.directory = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.directory, "test.db"))
+
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section('archive')
+        self.config.set('archive', 'path', os.path.join(self.directory, \
+        "archive"))
+
+        for model in [models.Channel, models.Key, models.ChannelAccess, \
+        models.ChannelSamples, models.ChannelRollups, models.ChannelBlocks, \
+        models.ChannelState]:
+            model.init_schema(self.db)
+
+        self.db.insert('channels', channel=self.CHANNEL_NUM, name="Test")
+        key_id = self.db.insert('access_keys', key=self.KEY)
+        self.db.insert('channel_access', channel=self.CHANNEL_NUM, \
+        key_id=key_id, mode=models.ChannelAccess.MODE_RW)
+
+        channel = models.Channel(self.CHANNEL_NUM, "Test", db=self.db, \
+        config=self.config)
+        key = models.Key(self.KEY, db=self.db, config=self.config)
+
+        self.stream = models.ChannelSamples(channel, stream_type="raw", \
+        window=86400000, key=key, db=self.db, config=self.config)
+
+        # a day of samples a minute apart, three days ago
+        today = archive.ChannelArchive.day_start( \
+        models.DatabaseModel.datetime_to_timestamp( \
+        datetime.datetime.utcnow()))
+        self.day = today - 3 * archive.DAY
+
+        self.write(range(self.day, self.day + archive.DAY, 60000))
+
+    def tearDown(self):
+        models.ChannelState.invalidate_cache()
+
+        self.db.ctx.db.close()
+
+        shutil.rmtree(self.directory)
+
+    def write(self, timestamps):
+        models.ChannelSamples.write_rows(self.db, self.config, \
+        [[(self.CHANNEL_NUM, timestamp, timestamp // 1000 % 1000) \
+        for timestamp in timestamps]])
+
+    def iter_all(self):
+        chunks = list(self.stream.iter_time_series_arrays(since=0, \
+        chunk_size=100))
+
+        return np.concatenate([chunk[0] for chunk in chunks]), \
+        np.concatenate([chunk[1] for chunk in chunks])
+
+    def assert_iter_matches_read(self):
+        timestamps, values = models.ChannelSamples.read_arrays(self.db, \
+        self.config, self.CHANNEL_NUM)
+
+        iter_timestamps, iter_values = self.iter_all()
+
+        self.assertEqual(iter_timestamps.tolist(), timestamps.tolist())
+        self.assertEqual(iter_values.tolist(), values.tolist())
+
+    def test_late_sample_in_archived_day(self):
+        self.assertEqual(archive.archive_channel(self.db, self.config, \
+        self.CHANNEL_NUM, 1), 1440)
+
+        late = self.day + 30000
+        self.write([late])
+
+        timestamps, values = self.iter_all()
+
+        self.assertIn(late, timestamps.tolist())
+        self.assertEqual(len(timestamps), 1441)
+        self.assert_iter_matches_read()
+
+    def test_late_sample_in_block(self):
+        blocks = models.ChannelBlocks(self.CHANNEL_NUM, self.db, self.config)
+        self.assertEqual(blocks.compact(self.day + archive.DAY)[1], 1440)
+
+        # one sample between two in a block, and one before the first block
+        late = [self.day + 30000, self.day - 60000]
+        self.write(late)
+
+        timestamps, values = self.iter_all()
+
+        for timestamp in late:
+            self.assertIn(timestamp, timestamps.tolist())
+
+        self.assertEqual(len(timestamps), 1442)
+        self.assert_iter_matches_read()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+import ConfigParser
+
+import web
+
+from database import Database
+import retention
+
+class IncrementalVacuumTest(unittest.TestCase):
+    """Freeing of deleted pages with incremental_vacuum"""
+
+    """Rows inserted, then deleted to leave free pages"""
+    ROW_COUNT = 20000
+
+    def setUp(self):
+        web.config.debug = False
+
+        self.directory = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.directory, "test.db"))
+
+        self.db.query("CREATE TABLE filler (id INTEGER PRIMARY KEY, \
+data TEXT)")
+
+        with self.db.transaction():
+            self.db.insert_many("filler", ("data",), \
+            [("x" * 200,) for i in xrange(self.ROW_COUNT)])
+
+        self.db.query("DELETE FROM filler")
+
+    def tearDown(self):
+        self.db.ctx.db.close()
+
+        shutil.rmtree(self.directory)
+
+    def get_free_count(self):
+        return self.db.query("PRAGMA freelist_count")[0].freelist_count
+
+    def test_incremental_vacuum_frees_requested_pages(self):
+        self.assertEqual(retention.get_auto_vacuum(self.db), \
+        retention.AUTO_VACUUM_INCREMENTAL)
+
+        free_count = self.get_free_count()
+        self.assertGreater(free_count, 100)
+
+        self.db.incremental_vacuum(100)
+
+        self.assertEqual(self.get_free_count(), free_count - 100)
+
+    def test_vacuum_frees_all_pages(self):
+        config = ConfigParser.RawConfigParser()
+        config.add_section('retention')
+        config.set('retention', 'vacuum_pages', '100')
+        config.set('retention', 'batch_pause', '0')
+
+        service = retention.RetentionService(self.db, config, [], [])
+
+        free_count = self.get_free_count()
+
+        self.assertEqual(service.vacuum(), free_count)
+        self.assertEqual(self.get_free_count(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
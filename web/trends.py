@@ -1,6 +1,8 @@
 import sys
 import web
 import models
+import trendservice
+import backfill
 
 from config import init_settings_from_argv
 from database import Database
@@ -14,6 +16,14 @@ def update_trends(max_rows=2500):
 
         print "{0} rows inserted for trend {1}".format(inserted_row_count, trend)
 
+def serve():
+    # update trends as samples are written by the API process
+    service = trendservice.TrendService(db, config, \
+    [trend for trend in streams if trend.stream_type == "trend"])
+    service.start()
+
+    service.watch()
+
 def add_trend(channel_num, window, timestamp_avg):
     # channel
     channel = models.Channel(channel_num, "Default", db, config)
@@ -25,6 +35,34 @@ def add_trend(channel_num, window, timestamp_avg):
     # initialise trend
     trend.init_schema()
 
+def rebuild_rollups(channel_num=None):
+    # channels to rebuild
+    if channel_num is None:
+        channel_nums = [channel.channel_num for channel in channels]
+    else:
+        channel_nums = [int(channel_num)]
+
+    for channel_num in channel_nums:
+        models.ChannelRollups(channel_num, db, config).rebuild()
+
+        print "Rollups rebuilt for channel {0}".format(channel_num)
+
+def backfill_trend(channel_num, window, timestamp_avg, workers=None):
+    # channel
+    channel = models.Channel(channel_num, "Default", db, config)
+
+    # trend
+    trend = models.ChannelSampleTrends(channel, "trend", window, server_key, \
+    timestamp_avg, db=db, config=config)
+
+    if workers is not None:
+        workers = int(workers)
+
+    # compute the trend over the stored samples
+    point_count = backfill.backfill(db, config, trend, workers=workers)
+
+    print "{0} rows inserted for trend {1}".format(point_count, trend)
+
 def delete_trend(channel_num, window, timestamp_avg):
     # channel
     channel = models.Channel(channel_num, "Default", db, config)
@@ -46,6 +84,12 @@ if __name__ == "__main__":
             delete_trend(*sys.argv[2:])
 
             print "Trend deleted"
+        elif sys.argv[1] == "rollups":
+            rebuild_rollups(*sys.argv[2:])
+        elif sys.argv[1] == "backfill":
+            backfill_trend(*sys.argv[2:])
+        elif sys.argv[1] == "serve":
+            serve()
         else:
             print "Unrecognised command"
     else:
@@ -1,7 +1,5 @@
 #!/bin/bash
 
-while true
-do
-    python trends.py
-    sleep 60
-done
\ No newline at end of file
+# update trends as new samples arrive, for when the API doesn't run the trend
+# service itself
+exec python trends.py serve
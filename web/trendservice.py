@@ -0,0 +1,174 @@
+import time
+import threading
+import Queue
+
+import models
+
+"""Trend updates driven by new samples
+
+Channels given new samples are marked dirty, and each of their trends is
+queued once, however many writes arrive before it is updated. A pool of
+worker threads brings queued trends up to date, holding a lock per trend so
+it is never updated by two workers at once. Nothing runs while no samples
+arrive.
+
+In the API process, the service is notified by ChannelSamples.write_rows.
+Run on its own (trends.py serve), it watches the channel_state table instead.
+"""
+
+class TrendService(object):
+    """Pool of threads updating trends of channels with new samples"""
+
+    """Default number of worker threads"""
+    DEFAULT_WORKERS = 4
+
+    """Default maximum number of samples read per trend transaction"""
+    DEFAULT_MAX_ROWS = 2500
+
+    """Default interval between checks for new samples when run alone [ms]"""
+    DEFAULT_POLL_INTERVAL = 1000
+
+    def __init__(self, db, config, trends):
+        """Initialises the service
+
+        :param trends: trend streams to keep up to date
+        """
+
+        self.db = db
+        self.config = config
+
+        self.workers = self.DEFAULT_WORKERS
+        self.max_rows = self.DEFAULT_MAX_ROWS
+        self.poll_interval = self.DEFAULT_POLL_INTERVAL
+
+        if config.has_option('trends', 'workers'):
+            self.workers = config.getint('trends', 'workers')
+
+        if config.has_option('trends', 'max_rows'):
+            self.max_rows = config.getint('trends', 'max_rows')
+
+        if config.has_option('trends', 'poll_interval'):
+            self.poll_interval = config.getfloat('trends', 'poll_interval')
+
+        # trends by id, and trend ids by channel
+        self.trends = {}
+        self.channel_trends = {}
+
+        for trend in trends:
+            self.trends[trend.get_id()] = trend
+            self.channel_trends.setdefault(trend.channel.channel_num, \
+            []).append(trend.get_id())
+
+        # one lock per trend
+        self._trend_locks = dict([(trend_id, threading.Lock()) \
+        for trend_id in self.trends])
+
+        # queued trend ids, and the time each was first marked dirty
+        self.queue = Queue.Queue()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+        # functions called with the ids of trends given new points
+        self.listeners = []
+
+        # statistics
+        self.update_count = 0
+        self.point_count = 0
+        self.error_count = 0
+        self.last_lag = 0
+
+    def start(self):
+        """Starts the worker threads"""
+
+        # make sure the progress table exists for older databases
+        models.ChannelSampleTrends.init_state_schema(self.db)
+
+        for number in range(self.workers):
+            worker = threading.Thread(target=self._work, \
+            name="trend-worker-{0}".format(number))
+
+            # don't keep the process alive for the workers
+            worker.daemon = True
+            worker.start()
+
+    def notify(self, channel_nums):
+        """Marks channels as having new samples
+
+        :param channel_nums: iterable of channel numbers
+        """
+
+        now = time.time()
+
+        with self._pending_lock:
+            for channel_num in channel_nums:
+                for trend_id in self.channel_trends.get(channel_num, []):
+                    # queue each trend once until a worker takes it
+                    if trend_id not in self._pending:
+                        self._pending[trend_id] = now
+                        self.queue.put(trend_id)
+
+    def notify_all(self):
+        """Marks every channel as having new samples"""
+
+        self.notify(self.channel_trends.keys())
+
+    def _work(self):
+        while True:
+            trend_id = self.queue.get()
+
+            # later samples queue the trend again
+            with self._pending_lock:
+                dirty_time = self._pending.pop(trend_id)
+
+            with self._trend_locks[trend_id]:
+                try:
+                    point_count = self.trends[trend_id].catch_up(self.max_rows)
+                except Exception, e:
+                    print "Error updating trend {0}: {1}".format(trend_id, e)
+
+                    with self._pending_lock:
+                        self.error_count += 1
+
+                    continue
+
+            with self._pending_lock:
+                self.update_count += 1
+                self.point_count += point_count
+                self.last_lag = int((time.time() - dirty_time) * 1000)
+
+            if point_count > 0:
+                for listener in self.listeners:
+                    # the points are stored, so keep the worker running
+                    try:
+                        listener([trend_id])
+                    except Exception, e:
+                        print "Error notifying of new points of trend {0}: \
+{1}".format(trend_id, e)
+
+    def watch(self):
+        """Notifies the service of new samples written by other processes
+
+        Polls each channel's latest sample time, and doesn't return.
+        """
+
+        models.ChannelState.watch(self.db, self.poll_interval, self.notify)
+
+    def get_stats(self):
+        """Returns the queue depth, lag and update counts
+
+        The lag is the time the longest waiting queued trend has waited, or
+        if none are waiting, the time the last update took from its first
+        notification [ms].
+        """
+
+        with self._pending_lock:
+            queue_depth = len(self._pending)
+
+            if queue_depth > 0:
+                lag = int((time.time() - min(self._pending.values())) * 1000)
+            else:
+                lag = self.last_lag
+
+        return {"queue_depth": queue_depth, "lag": lag, \
+        "updates": self.update_count, "points": self.point_count, \
+        "errors": self.error_count}
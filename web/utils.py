@@ -1,6 +1,8 @@
 from __future__ import division
 
 import datetime
+import struct
+import numpy as np
 
 def format_date_time(dateobj, config):
     """Formats the specified date
@@ -13,11 +15,114 @@ def format_date_time(dateobj, config):
     config.get('general', 'date_format'), config.get('general', 'time_format')))
 
 def stream_to_js(stream):
-    js_str = ""
+    """Formats a list of [timestamp, value] pairs as a JavaScript array"""
 
-    if len(stream) > 0:
-        # convert entries to JavaScript format
-        js_str += ",".join(["[{0}, {1}]".format(str(sample[0]), str(sample[1])) \
-        for sample in stream])
+    if len(stream) == 0:
+        return "[]"
 
-    return "[" + js_str + "]"
+    timestamps, values = zip(*[(sample[0], sample[1]) for sample in stream])
+
+    return arrays_to_js(np.asarray(timestamps), np.asarray(values))
+
+def arrays_to_js(timestamps, values):
+    """Formats timestamp and value arrays as a JavaScript array of pairs"""
+
+    return "".join(arrays_to_js_chunks([(timestamps, values)]))
+
+def arrays_to_js_chunks(chunks):
+    """Yields a JavaScript (and JSON) array of pairs in pieces
+
+    Each chunk's pairs are formatted together by NumPy, rather than per sample
+    in Python, and only one chunk's text exists at a time.
+
+    :param chunks: iterable of (timestamps, values) arrays
+    :return: generator of strings forming "[[t, v],[t, v],...]"
+    """
+
+    yield "["
+
+    first = True
+
+    for timestamps, values in chunks:
+        if len(timestamps) == 0:
+            continue
+
+        if not first:
+            yield ","
+
+        first = False
+
+        yield ",".join(np.char.add(np.char.add(np.char.add(np.char.add("[", \
+        np.asarray(timestamps).astype(str)), ", "), \
+        np.asarray(values).astype(str)), "]").tolist())
+
+    yield "]"
+
+"""Binary series header: magic, format version, value type, sample count"""
+BINARY_HEADER_FORMAT = "<4sBBxxQ"
+BINARY_HEADER_SIZE = struct.calcsize(BINARY_HEADER_FORMAT)
+BINARY_MAGIC = "MGTS"
+BINARY_VERSION = 1
+
+"""Binary value types"""
+BINARY_INT32 = 0
+BINARY_FLOAT64 = 1
+
+def arrays_to_binary(timestamps, values):
+    """Encodes timestamp and value arrays in the binary series format
+
+    The header is followed by the timestamps as little-endian int64 ms and
+    then the values as little-endian int32, or float64 if they are not
+    integers. The header is 16 bytes, so both arrays are aligned for typed
+    array views in the browser.
+
+    :return: encoded series
+    """
+
+    return "".join(arrays_to_binary_chunks(timestamps, values))
+
+def arrays_to_binary_chunks(timestamps, values):
+    """Yields the binary series format in pieces (see arrays_to_binary)"""
+
+    values = np.asarray(values)
+
+    if np.issubdtype(values.dtype, np.integer):
+        value_type = BINARY_INT32
+        values = values.astype("<i4")
+    else:
+        value_type = BINARY_FLOAT64
+        values = values.astype("<f8")
+
+    yield struct.pack(BINARY_HEADER_FORMAT, BINARY_MAGIC, BINARY_VERSION, \
+    value_type, len(timestamps))
+    yield np.asarray(timestamps).astype("<i8").tostring()
+    yield values.tostring()
+
+def binary_to_arrays(data):
+    """Decodes the binary series format
+
+    :param data: encoded series
+    :return: (timestamps, values) arrays
+    """
+
+    magic, version, value_type, count = struct.unpack(BINARY_HEADER_FORMAT, \
+    data[:BINARY_HEADER_SIZE])
+
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("Not a version {0} binary series".format( \
+        BINARY_VERSION))
+
+    timestamps = np.frombuffer(data, dtype="<i8", count=count, \
+    offset=BINARY_HEADER_SIZE)
+
+    if value_type == BINARY_INT32:
+        value_dtype = "<i4"
+    elif value_type == BINARY_FLOAT64:
+        value_dtype = "<f8"
+    else:
+        raise ValueError("Unknown value type {0}".format(value_type))
+
+    values = np.frombuffer(data, dtype=value_dtype, count=count, \
+    offset=BINARY_HEADER_SIZE + 8 * count)
+
+    return timestamps, values